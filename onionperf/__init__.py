@@ -6,6 +6,7 @@
 
 __all__ = [
    'analysis',
+   'archive',
    'measurement',
    'model',
    'monitor',
@@ -4,16 +4,16 @@
   See LICENSE for licensing information
 '''
 
-import sys, os, re, json, datetime, logging
+import sys, os, re, json, datetime, logging, cPickle, hashlib, sqlite3, tempfile, shutil, time
 
-from multiprocessing import Pool, cpu_count
+from multiprocessing import Pool, cpu_count, TimeoutError
 from signal import signal, SIGINT, SIG_IGN
 from socket import gethostname
 from abc import ABCMeta, abstractmethod
+from collections import Mapping, MutableMapping
 
 # stem imports
 from stem import CircEvent, CircStatus, CircPurpose, StreamStatus
-from stem.response.events import CircuitEvent, CircMinorEvent, StreamEvent, BandwidthEvent, BuildTimeoutSetEvent
 from stem.response import ControlMessage, convert
 
 # onionperf imports
@@ -25,6 +25,8 @@ class Analysis(object):
         self.nickname = nickname
         self.measurement_ip = ip_address
         self.hostname = gethostname().split('.')[0]
+        # a ColumnarDB, JSONSectionDB, or SQLiteDB that reads sections of a loaded analysis on demand
+        self.section_db = None
         self.json_db = {'type':'onionperf', 'version':1.0, 'data':{}}
         self.tgen_filepaths = []
         self.torctl_filepaths = []
@@ -37,65 +39,241 @@ class Analysis(object):
     def add_torctl_file(self, filepath):
         self.torctl_filepaths.append(filepath)
 
+    @property
+    def json_db(self):
+        # a lazily loaded database is only read in full when all of its data is needed
+        if self.__json_db is None and self.section_db is not None:
+            self.__json_db = self.section_db.get_json_db()
+        return self.__json_db
+
+    @json_db.setter
+    def json_db(self, db):
+        self.__json_db = db
+        self.__query_db = None
+
+    def __get_query_db(self):
+        # an analysis that was not loaded from sqlite is copied into an in-memory database for queries
+        if self.__json_db is None and isinstance(self.section_db, SQLiteDB):
+            return self.section_db
+        if self.__query_db is None:
+            connection = sqlite3.connect(":memory:")
+            write_sqlite_db(connection, self.json_db)
+            self.__query_db = SQLiteDB(connection)
+        return self.__query_db
+
+    def query_transfers(self, node=None, start=None, end=None, filesize=None, error_code=None, is_error=None):
+        '''
+        returns the (node, transfer) pairs of the transfers that started in [start, end) and match
+        all of the other given filters, e.g., the failed 5 MiB transfers of a node on a given day:
+        query_transfers(node=nickname, start=day_ts, end=day_ts+86400, filesize=5242880, is_error=True)
+        '''
+        return self.__get_query_db().query_transfers(node=node, start=start, end=end, filesize=filesize, error_code=error_code, is_error=is_error)
+
+    def query_circuits(self, node=None, start=None, end=None, relay=None, is_failed=None):
+        ''' like query_transfers, where relay is the fingerprint or nickname of a relay in the circuit path '''
+        return self.__get_query_db().query_circuits(node=node, start=start, end=end, relay=relay, is_failed=is_failed)
+
+    def query_streams(self, node=None, start=None, end=None, circuit_id=None, target=None, is_failed=None):
+        ''' like query_transfers, for the streams of the circuit circuit_id or to target "host:port" '''
+        return self.__get_query_db().query_streams(node=node, start=start, end=end, circuit_id=circuit_id, target=target, is_failed=is_failed)
+
+    def query_bandwidth(self, node=None, start=None, end=None):
+        ''' returns (node, unix_ts, bytes_read, bytes_written) tuples for the bandwidth samples in [start, end) '''
+        return self.__get_query_db().query_bandwidth(node=node, start=start, end=end)
+
+    def get_section(self, node, parent_key, section_key):
+        '''
+        returns json_db['data'][node][parent_key][section_key], raising KeyError if it does not exist;
+        a lazily loaded analysis only reads that section
+        '''
+        if self.__json_db is None and self.section_db is not None:
+            return self.section_db.get_section(node, parent_key, section_key)
+        return self.json_db['data'][node][parent_key][section_key]
+
     def get_nodes(self):
+        if self.__json_db is None and self.section_db is not None:
+            return self.section_db.get_nodes()
         return self.json_db['data'].keys()
 
+    def iter_node_dbs(self, node):
+        '''
+        yields parts of the db of node, which merge_node_db combines into the whole; an analysis that was
+        loaded lazily from a file with an index reads each section on its own, and does not keep it
+        '''
+        if self.__json_db is None and isinstance(self.section_db, IndexedJSONDB):
+            for node_db in self.section_db.iter_node_dbs(node):
+                yield node_db
+        else:
+            yield self.json_db['data'][node]
+
     def get_tor_bandwidth_summary(self, node, direction):
         try:
-            return self.json_db['data'][node]['tor']['bandwidth_summary'][direction]
+            return self.get_section(node, 'tor', 'bandwidth_summary')[direction]
         except:
             return None
 
     def get_tgen_transfers_summary(self, node):
         try:
-            return self.json_db['data'][node]['tgen']['transfers_summary']
+            return self.get_section(node, 'tgen', 'transfers_summary')
         except:
             return None
 
-    def analyze(self, do_simple=True, date_filter=None):
+    def analyze(self, do_simple=True, date_filter=None, fast_decode=False, num_chunks=1, do_resume=False, parse_cache=None, memory_budget=None, num_procs=1,
+                skip_events=None, num_threads=1):
+        '''
+        num_chunks > 1 splits each uncompressed log file without a date_filter into that many byte ranges,
+        which are parsed in a process pool of their own, see Parser.parse_chunked; num_threads > 1 decompresses
+        the blocks of multi-block xz log files on that many threads;
+        skip_events is a list of torctl event types that are dropped before decoding, see TorCtlParser;
+        if parse_cache is a ParseCache, each log file that is parsed as a whole is parsed into a chunk that is
+        kept there, and the cached chunks of files that did not change are merged instead of parsing them again;
+        if memory_budget is given, the completed transfers, circuits, and streams are spilled to a temporary
+        file once the process uses more than memory_budget MiB, and are read back one at a time when saving;
+        num_procs > 1 parses the tgen and torctl log files at the same time in up to that many worker
+        processes, and merges the results of each kind in file order, so they match those of a serial parse;
+        the workers parse with the same memory_budget, and spill their results to files that are read one
+        at a time as they are merged; the pool is stopped if a worker fails or returns no result in time
+        '''
         if self.did_analysis:
             return
 
         self.date_filter = date_filter
-        tgen_parser = TGenParser(date_filter=self.date_filter)
-        torctl_parser = TorCtlParser(date_filter=self.date_filter)
+        tgen_parser = TGenParser(date_filter=self.date_filter, memory_budget=memory_budget)
+        torctl_parser = TorCtlParser(date_filter=self.date_filter, fast_decode=fast_decode, skip_events=skip_events, memory_budget=memory_budget)
 
+        parse_jobs = []
         for (filepaths, parser, json_db_key) in [(self.tgen_filepaths, tgen_parser, 'tgen'), (self.torctl_filepaths, torctl_parser, 'tor')]:
             if len(filepaths) > 0:
-                for filepath in filepaths:
-                    logging.info("parsing log file at {0}".format(filepath))
-                    parser.parse(util.DataSource(filepath), do_simple=do_simple)
-
-                if self.nickname is None:
-                    parsed_name = parser.get_name()
-                    if parsed_name is not None:
-                        self.nickname = parsed_name
-                    elif self.hostname is not None:
-                        self.nickname = self.hostname
-                    else:
-                        self.nickname = "unknown"
-
-                if self.measurement_ip is None:
-                    self.measurement_ip = "unknown"
-
-                self.json_db['data'].setdefault(self.nickname, {'measurement_ip': self.measurement_ip}).setdefault(json_db_key, parser.get_data())
+                parse_jobs.append((filepaths, parser, json_db_key))
+
+        # files that are split into chunks or resumed from a checkpoint are parsed here, the others
+        # are parsed as a whole into a chunk, in the pool if there is one
+        file_modes = {}
+        for (filepaths, parser, json_db_key) in parse_jobs:
+            for (i, filepath) in enumerate(filepaths):
+                mode = self.__get_parse_mode(filepath, filepaths, num_chunks, do_resume)
+                if mode in ['date_seek', 'parse'] and filepath != '-':
+                    file_modes[(parser, i)] = mode
+
+        # the workers spill their chunks to files, or to the cache, so we only hold the chunk that we merge
+        pool, file_results, spill_dir = None, {}, None
+        try:
+            if num_procs > 1 and len(file_modes) > 1:
+                spill_dir = tempfile.mkdtemp(prefix="onionperf.spill.")
+                pool = Pool(min(num_procs, len(file_modes)))
+                file_jobs = [(parser, i, filepaths[i]) for (filepaths, parser, json_db_key) in parse_jobs
+                             for i in xrange(len(filepaths)) if (parser, i) in file_modes]
+                # the pool starts the jobs in order, so the largest files start first
+                for (parser, i, filepath) in sorted(file_jobs, key=lambda job: -os.path.getsize(job[2])):
+                    job_args = (parser.new_chunk_parser(), filepath, do_simple, file_modes[(parser, i)], num_threads, parse_cache, spill_dir, None)
+                    file_results[(parser, i)] = pool.apply_async(subproc_parse_job_func, [job_args])
+                pool.close()
+
+            for (filepaths, parser, json_db_key) in parse_jobs:
+                for (i, filepath) in enumerate(filepaths):
+                    chunk = None
+                    if (parser, i) in file_results:
+                        (job_index, chunk_path, is_cached, job_seconds) = wait_for_result(file_results.pop((parser, i)).get)
+                        chunk = load_chunk_file(chunk_path, is_cached, parse_cache)
+                    elif (parser, i) in file_modes and parse_cache is not None:
+                        # the file is parsed here, but still into a chunk so that it can be cached
+                        entry_path = parse_cache.find(filepath, parser, do_simple)
+                        if entry_path is not None:
+                            chunk = parse_cache.load(entry_path)
+                        else:
+                            chunk = parse_file_chunk(parser.new_chunk_parser(), filepath, do_simple, file_modes[(parser, i)], num_threads, parse_cache)
+
+                    if chunk is not None:
+                        if parser.merge_chunk(chunk, do_simple):
+                            continue
+                        # the file reused an id that was still open at the end of the previous file
+                        logging.info("re-parsing log file at {0} serially".format(filepath))
+                    self.__parse_file(parser, filepath, filepaths, do_simple, num_chunks, do_resume, num_threads)
+
+                self.store_parser_data(parser, json_db_key)
+        except KeyboardInterrupt:
+            if pool is not None:
+                logging.info("interrupted, terminating process pool")
+            sys.exit()
+        finally:
+            # the workers are also stopped if a job failed
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+            if spill_dir is not None:
+                shutil.rmtree(spill_dir, ignore_errors=True)
 
         self.did_analysis = True
 
-    def merge(self, analysis):
-        for nickname in analysis.json_db['data']:
-            if nickname in self.json_db['data']:
-                raise Exception("Merge does not yet support multiple Analysis objects from the same node \
-                (add multiple files from the same node to the same Analysis object before calling analyze instead)")
+    def __get_parse_mode(self, filepath, filepaths, num_chunks, do_resume):
+        # only uncompressed files can be resumed, searched, and split at byte offsets
+        # a checkpoint holds the state of a parser that has seen a single file
+        if do_resume and len(filepaths) == 1 and util.is_seekable_file(filepath):
+            return 'resume'
+        elif self.date_filter is not None and util.is_seekable_file(filepath):
+            return 'date_seek'
+        elif num_chunks > 1 and util.is_seekable_file(filepath):
+            return 'chunked'
+        else:
+            return 'parse'
+
+    def __parse_file(self, parser, filepath, filepaths, do_simple, num_chunks, do_resume, num_threads):
+        logging.info("parsing log file at {0}".format(filepath))
+        mode = self.__get_parse_mode(filepath, filepaths, num_chunks, do_resume)
+        if mode == 'resume':
+            parser.parse_resumable(filepath, do_simple=do_simple)
+        elif mode == 'date_seek':
+            parser.parse_date_seek(filepath, do_simple=do_simple)
+        elif mode == 'chunked':
+            parser.parse_chunked(filepath, do_simple=do_simple, num_chunks=num_chunks)
+        else:
+            # the blocks of a compressed file can still be decompressed in parallel
+            parser.parse(util.DataSource(filepath, num_threads=num_threads), do_simple=do_simple)
+
+    def store_parser_data(self, parser, json_db_key):
+        if self.nickname is None:
+            parsed_name = parser.get_name()
+            if parsed_name is not None:
+                self.nickname = parsed_name
+            elif self.hostname is not None:
+                self.nickname = self.hostname
             else:
-                self.json_db['data'][nickname] = analysis.json_db['data'][nickname]
-
-    def save(self, filename=None, output_prefix=os.getcwd(), do_compress=True, version=1.0):
+                self.nickname = "unknown"
+
+        if self.measurement_ip is None:
+            self.measurement_ip = "unknown"
+
+        self.json_db['data'].setdefault(self.nickname, {'measurement_ip': self.measurement_ip}).setdefault(json_db_key, parser.get_data())
+        self.__query_db = None
+
+    def merge(self, analysis, memory_budget=None):
+        '''
+        adds the data of analysis to ours, which may share objects with it afterwards;
+        the data of a node that both analyses hold is combined with merge_node_db, which
+        spills the merged records to disk if memory_budget is given; an analysis that was
+        loaded lazily from a file with an index is merged a section at a time
+        '''
+        for nickname in analysis.get_nodes():
+            new_ids = {}
+            for node_db in analysis.iter_node_dbs(nickname):
+                merge_node_db(self.json_db['data'].setdefault(nickname, {}), node_db, memory_budget=memory_budget, new_ids=new_ids)
+        self.__query_db = None
+
+    def save(self, filename=None, output_prefix=os.getcwd(), do_compress=True, version=1.0, do_columnar=False, do_index=False, do_sqlite=False, num_threads=1):
+        '''
+        each call writes a single file in one format, so save once per format that is wanted;
+        do_columnar writes only the numpy archive of save_columnar_db, not the json file;
+        do_index also writes an index of the byte ranges of every node and section next to the json file,
+        and compresses it in independent blocks, so that a section can be loaded without the rest of the file;
+        do_sqlite writes an uncompressed sqlite database instead, which the query methods can filter in place;
+        num_threads > 1 compresses the blocks of the json file on that many threads
+        '''
         if filename is None:
+            extension = "sqlite" if do_sqlite else "npz" if do_columnar else "json.xz"
             if self.date_filter is None:
-                filename = "onionperf.analysis.json.xz"
+                filename = "onionperf.analysis.{}".format(extension)
             else:
-                filename = "{}.onionperf.analysis.json.xz".format(util.date_to_string(self.date_filter))
+                filename = "{}.onionperf.analysis.{}".format(util.date_to_string(self.date_filter), extension)
 
         filepath = os.path.abspath(os.path.expanduser("{0}/{1}".format(output_prefix, filename)))
         if not os.path.exists(output_prefix):
@@ -103,14 +281,29 @@ class Analysis(object):
 
         logging.info("saving analysis results to {0}".format(filepath))
 
-        outf = util.FileWritable(filepath, do_compress=do_compress)
-        json.dump(self.json_db, outf, sort_keys=True, separators=(',', ': '), indent=2)
-        outf.close()
+        if do_sqlite:
+            save_sqlite_db(self.json_db, filepath)
+        elif do_columnar:
+            save_columnar_db(self.json_db, filepath, do_compress=do_compress)
+        else:
+            offsets = {} if do_index else None
+            outf = util.FileWritable(filepath, do_compress=do_compress, do_truncate=do_index,
+                                     xz_block_size=util.XZ_BLOCK_SIZE if do_index else None, num_threads=num_threads)
+            # each transfer, circuit, and stream is encoded on its own and written out in large chunks
+            util.write_json(self.json_db, outf, sort_keys=True, indent=2, index=offsets, index_depth=4)
+            outf.close()
+            if do_index:
+                save_analysis_index(self.json_db, offsets, outf.filename)
 
         logging.info("done!")
 
     @classmethod
-    def load(cls, filename="onionperf.analysis.json.xz", input_prefix=os.getcwd(), version=1.0):
+    def load(cls, filename="onionperf.analysis.json.xz", input_prefix=os.getcwd(), version=1.0, sections=None, nodes=None):
+        '''
+        if sections is a list of (parent_key, section_key) pairs such as ('tgen', 'transfers_summary'),
+        only those sections are read from the file and any other section is read when it is first
+        accessed; if nodes is a list of nicknames, the other nodes are left out
+        '''
         filepath = os.path.abspath(os.path.expanduser("{0}".format(filename)))
         if not os.path.exists(filepath):
             filepath = os.path.abspath(os.path.expanduser("{0}/{1}".format(input_prefix, filename)))
@@ -120,10 +313,27 @@ class Analysis(object):
 
         logging.info("loading analysis results from {0}".format(filepath))
 
-        inf = util.DataSource(filepath)
-        inf.open()
-        db = json.load(inf.get_file_handle())
-        inf.close()
+        section_db = None
+        if is_columnar_file(filepath):
+            # the columns are read when they are first needed
+            section_db = ColumnarDB(filepath, nodes=nodes)
+            db = section_db.meta
+        elif is_sqlite_file(filepath):
+            # the tables are queried in place, and sections are read when they are first needed
+            section_db = SQLiteDB(sqlite3.connect(filepath, check_same_thread=False), nodes=nodes)
+            db = section_db.meta
+        elif sections is not None or nodes is not None:
+            index = load_analysis_index(filepath)
+            if index is not None:
+                section_db = IndexedJSONDB(filepath, index, nodes=nodes)
+            else:
+                section_db = JSONSectionDB(filepath, sections=sections, nodes=nodes)
+            db = section_db.meta
+        else:
+            inf = util.DataSource(filepath)
+            inf.open()
+            db = json.load(inf.get_file_handle())
+            inf.close()
 
         logging.info("done!")
 
@@ -135,10 +345,14 @@ class Analysis(object):
             return None
         else:
             analysis_instance = cls()
-            analysis_instance.json_db = db
+            if section_db is not None:
+                analysis_instance.section_db = section_db
+                analysis_instance.json_db = None
+            else:
+                analysis_instance.json_db = db
             return analysis_instance
 
-    def export_torperf_version_1_1(self, output_prefix=os.getcwd(), do_compress=False):
+    def export_torperf_version_1_1(self, output_prefix=os.getcwd(), do_compress=False, num_threads=1):
         # export file in `@type torperf 1.0` format: https://collector.torproject.org/#type-torperf
         if not os.path.exists(output_prefix):
             os.makedirs(output_prefix)
@@ -147,17 +361,19 @@ class Analysis(object):
             if 'tgen' not in self.json_db['data'][nickname] or 'transfers' not in self.json_db['data'][nickname]['tgen']:
                 continue
 
-            xfers_by_filesize = {}
-            for xfer_db in self.json_db['data'][nickname]['tgen']['transfers'].values():
-                xfers_by_filesize.setdefault(xfer_db['filesize_bytes'], []).append(xfer_db)
+            # only ids are collected, so records that were spilled to disk are read one at a time
+            transfers, xfers_by_filesize = self.json_db['data'][nickname]['tgen']['transfers'], {}
+            for (xfer_id, xfer_db) in transfers.iteritems():
+                xfers_by_filesize.setdefault(xfer_db['filesize_bytes'], []).append(xfer_id)
 
-            streams_by_srcport, circuits = {}, []
+            streams, streams_by_srcport, circuits = {}, {}, {}
             if 'tor' in self.json_db['data'][nickname]:
                 if 'streams' in self.json_db['data'][nickname]['tor']:
-                    for streams_db in self.json_db['data'][nickname]['tor']['streams'].values():
+                    streams = self.json_db['data'][nickname]['tor']['streams']
+                    for (stream_id, streams_db) in streams.iteritems():
                         if 'source' in streams_db:
                             srcport = int(streams_db['source'].split(':')[1])
-                            streams_by_srcport[srcport] = streams_db
+                            streams_by_srcport[srcport] = stream_id
                 if 'circuits' in self.json_db['data'][nickname]['tor']:
                     circuits = self.json_db['data'][nickname]['tor']['circuits']
 
@@ -173,10 +389,11 @@ class Analysis(object):
                 logging.info("saving analysis results to {0}".format(filepath))
 
                 # always append instead of truncating file
-                output = util.FileWritable(filepath, do_compress=do_compress, do_truncate=False)
+                output = util.FileWritable(filepath, do_compress=do_compress, do_truncate=False, num_threads=num_threads)
                 output.open()
 
-                for xfer_db in xfers_by_filesize[filesize]:
+                for xfer_id in xfers_by_filesize[filesize]:
+                    xfer_db = transfers[xfer_id]
                     # if any keys are missing, log a warning
                     try:
                         d = {}
@@ -246,17 +463,16 @@ class Analysis(object):
                         # now get the tor parts
                         srcport = int(xfer_db['endpoint_local'].split(':')[2])
                         if srcport in streams_by_srcport:
-                            stream_db = streams_by_srcport[srcport]
-                            circid = int(stream_db['circuit_id'] or 0)
-                            if circid in circuits:
-                                circuit_db = circuits[circid]
+                            stream_db = streams[streams_by_srcport[srcport]]
+                            circuit_db = find_circuit(circuits, stream_db['circuit_id'])
+                            if circuit_db is not None:
 
                                 d['LAUNCH'] = circuit_db['unix_ts_start']
                                 d['PATH'] = ','.join([item[0].split('~')[0] for item in circuit_db['path']])
                                 d['BUILDTIMES'] = ','.join([str(item[1]) for item in circuit_db['path']])
                                 d['TIMEOUT'] = circuit_db['build_timeout'] if 'build_timeout' in circuit_db else None
                                 d['QUANTILE'] = circuit_db['build_quantile'] if 'build_quantile' in circuit_db else None
-                                d['CIRC_ID'] = circid
+                                d['CIRC_ID'] = circuit_db['circuit_id']
                                 d['USED_AT'] = stream_db['unix_ts_end']
                                 d['USED_BY'] = int(stream_db['stream_id'])
 
@@ -270,50 +486,940 @@ class Analysis(object):
                 output.close()
                 logging.info("done!")
 
-def subproc_analyze_func(analysis_args):
-    signal(SIGINT, SIG_IGN)  # ignore interrupts
-    a = analysis_args[0]
-    do_simple = analysis_args[1]
-    a.analyze(do_simple=do_simple)
-    return a
+def find_circuit(circuits, circuit_id):
+    '''
+    returns the circuit that a stream refers to with circuit_id, or None; circuits are keyed by int ids when
+    they are parsed, by strings once they are loaded from json, and by the new ids that merge_records gave them
+    '''
+    if circuit_id is None:
+        return None
+    for key in [circuit_id, int(circuit_id) if str(circuit_id).isdigit() else None]:
+        if key is not None and key in circuits:
+            return circuits[key]
+    return None
+
+# how often ParallelAnalysis logs its progress while it waits for a result, in seconds
+PROGRESS_LOG_INTERVAL = 60
 
 class ParallelAnalysis(Analysis):
 
     def analyze(self, search_path, do_simple=True, nickname=None, tgen_search_expressions=["tgen.*\.log"],
-                torctl_search_expressions=["torctl.*\.log"], num_subprocs=cpu_count()):
-
-        pathpairs = util.find_file_paths_pairs(search_path, tgen_search_expressions, torctl_search_expressions)
+                torctl_search_expressions=["torctl.*\.log"], num_subprocs=cpu_count(), cache_dir=None, do_hash=False, manifest_path=None):
+        '''
+        the tgen and torctl logs of each node below search_path, see util.find_file_paths_pairs, are analyzed
+        together like the files of a single Analysis: each log file is parsed into a chunk by a worker, and
+        the chunks of a node are merged in file order, so the results match those of a serial analysis;
+        the logs of the server of a measurement name the same host as those of its client, so the nickname
+        of a node whose data directories have another role than client gets that role appended, e.g. op-ab-server;
+        if manifest_path is set, the directory listings of search_path are kept in a util.DirectoryManifest
+        there, and only the directories that changed since the last run are listed again;
+        if cache_dir is set, the parsed chunk of each log file is kept in a ParseCache there, see
+        Analysis.analyze, and the entries of log files that no longer exist are removed at the end;
+        the workers spill their chunks to files, which are merged one at a time in the order in which
+        the files were found, so that the results do not depend on which job finished first;
+        the largest files are parsed first, so that no large file is left parsing alone at the end
+        '''
+        parse_cache = ParseCache(cache_dir, do_hash=do_hash) if cache_dir is not None else None
+
+        pathpairs = util.find_file_paths_pairs(search_path, tgen_search_expressions, torctl_search_expressions, manifest_path=manifest_path)
         logging.info("processing input from {0} nodes...".format(len(pathpairs)))
+        node_roles = [util.get_log_node((tgen_filepaths + torctl_filepaths)[0])[1] for (tgen_filepaths, torctl_filepaths) in pathpairs]
+
+        # the job index is the order in which the files were found, and the order of the merges
+        spill_dir = tempfile.mkdtemp(prefix="onionperf.spill.")
+        parse_jobs, job_files = [], []
+        for (node_index, (tgen_filepaths, torctl_filepaths)) in enumerate(pathpairs):
+            for (filepaths, parser, json_db_key) in [(tgen_filepaths, TGenParser(), 'tgen'), (torctl_filepaths, TorCtlParser(), 'tor')]:
+                for filepath in filepaths:
+                    parse_jobs.append((parser.new_chunk_parser(), filepath, do_simple, 'parse', 1, parse_cache, spill_dir, len(parse_jobs)))
+                    job_files.append((node_index, json_db_key, filepath))
+        job_sizes = [os.path.getsize(filepath) if os.path.isfile(filepath) else 0 for (node_index, json_db_key, filepath) in job_files]
+        progress = AnalysisProgress([filepath for (node_index, json_db_key, filepath) in job_files], job_sizes)
+        started_jobs = sorted(parse_jobs, key=lambda job_args: job_sizes[job_args[7]], reverse=True)
 
-        analysis_jobs = []
-        for (tgen_filepaths, torctl_filepaths) in pathpairs:
-            a = Analysis()
-            for tgen_filepath in tgen_filepaths:
-                a.add_tgen_file(tgen_filepath)
-            for torctl_filepath in torctl_filepaths:
-                a.add_torctl_file(torctl_filepath)
-            analysis_args = [a, do_simple]
-            analysis_jobs.append(analysis_args)
-
-        analyses = None
         pool = Pool(num_subprocs if num_subprocs > 0 else cpu_count())
         try:
-            mr = pool.map_async(subproc_analyze_func, analysis_jobs)
+            # one job at a time, so that the small jobs at the end are spread over all workers
+            results = pool.imap_unordered(subproc_parse_job_func, started_jobs, chunksize=1)
             pool.close()
-            while not mr.ready(): mr.wait(1)
-            analyses = mr.get()
+            # the chunks of files that were parsed before the files found before them wait for their turn
+            chunk_paths, next_index, node_parsers = {}, 0, {}
+            log_progress = lambda waited: progress.log() if waited % PROGRESS_LOG_INTERVAL == 0 else None
+            for i in xrange(len(parse_jobs)):
+                job_index, chunk_path, is_cached, job_seconds = wait_for_result(results.next, on_wait=log_progress)
+                chunk_paths[job_index] = (chunk_path, is_cached)
+                while next_index in chunk_paths:
+                    self.__merge_chunk_file(job_files, next_index, chunk_paths.pop(next_index), node_parsers, node_roles, parse_cache, do_simple)
+                    next_index += 1
+                progress.add_done(job_index, job_seconds)
+                progress.log()
         except KeyboardInterrupt:
             logging.info("interrupted, terminating process pool")
+            sys.exit()
+        finally:
+            # the workers are also stopped if a job failed
             pool.terminate()
             pool.join()
-            sys.exit()
+            shutil.rmtree(spill_dir, ignore_errors=True)
 
-        logging.info("merging {0} analysis results now...".format(len(analyses)))
-        while analyses is not None and len(analyses) > 0:
-            self.merge(analyses.pop())
+        progress.log_report()
+        if parse_cache is not None:
+            logging.info("removed {0} parse cache entries of log files that no longer exist".format(parse_cache.prune()))
         logging.info("done merging results: {0} total nicknames present in json db".format(len(self.json_db['data'])))
 
+    def __merge_chunk_file(self, job_files, job_index, chunk_path, node_parsers, node_roles, parse_cache, do_simple):
+        node_index, json_db_key, filepath = job_files[job_index]
+        chunk = load_chunk_file(chunk_path[0], chunk_path[1], parse_cache)
+
+        parsers = node_parsers.setdefault(node_index, {})
+        if json_db_key not in parsers:
+            parsers[json_db_key] = TGenParser() if json_db_key == 'tgen' else TorCtlParser()
+        parser = parsers[json_db_key]
+        if not parser.merge_chunk(chunk, do_simple):
+            # the file reused an id that was still open at the end of the previous file
+            logging.info("re-parsing log file at {0} serially".format(filepath))
+            parser.parse(util.DataSource(filepath), do_simple=do_simple)
+
+        # the results of a node are added to ours once its last file is merged
+        if job_index + 1 == len(job_files) or job_files[job_index + 1][0] != node_index:
+            a = Analysis()
+            for key in ['tgen', 'tor']:
+                if key in parsers:
+                    a.store_parser_data(parsers[key], key)
+            role = node_roles[node_index]
+            if role is not None and role != 'client':
+                a.json_db['data'] = {"{0}-{1}".format(name, role): node_db for (name, node_db) in a.json_db['data'].items()}
+            self.merge(a)
+            del node_parsers[node_index]
+
+class AnalysisProgress(object):
+    ''' tracks the log files of a ParallelAnalysis that are parsed, and estimates when the rest will be parsed '''
+
+    def __init__(self, job_filepaths, job_sizes):
+        self.job_filepaths = job_filepaths
+        self.job_sizes = job_sizes
+        self.total_bytes = sum(job_sizes)
+        self.done_bytes = 0
+        self.timings = []
+        self.start = time.time()
+
+    def add_done(self, job_index, seconds):
+        self.done_bytes += self.job_sizes[job_index]
+        self.timings.append((seconds, self.job_sizes[job_index], self.job_filepaths[job_index]))
+
+    def log(self):
+        elapsed = time.time() - self.start
+        rate = self.done_bytes / elapsed if elapsed > 0 else 0.0
+        eta = "{0:.0f}s".format((self.total_bytes - self.done_bytes) / rate) if rate > 0 else "unknown"
+        logging.info("parsed {0} of {1} files, {2:.1f} of {3:.1f} MiB in {4:.0f}s ({5:.2f} MiB/s), eta {6}".format(
+            len(self.timings), len(self.job_filepaths), self.done_bytes / 1048576.0, self.total_bytes / 1048576.0,
+            elapsed, rate / 1048576.0, eta))
+
+    def log_report(self):
+        # the slowest files first
+        logging.info("file timing report (seconds, MiB, MiB/s, file):")
+        for (seconds, size, filepath) in sorted(self.timings, reverse=True):
+            rate = size / seconds / 1048576.0 if seconds > 0 else 0.0
+            logging.info("{0:.1f}s {1:.1f} MiB {2:.2f} MiB/s {3}".format(seconds, size / 1048576.0, rate, filepath))
+
+# incremented when the contents of parse cache entries change
+PARSE_CACHE_VERSION = 2
+
+class ParseCache(object):
+    '''
+    a directory of the ParseChunks of single log files, which are reused while a file keeps the same
+    path, size, and modification time (and content hash if do_hash is set), and the parser the same settings;
+    each entry starts with a small header, so that it can be checked without reading the chunk
+    '''
+
+    def __init__(self, cache_dir, do_hash=False):
+        self.cache_dir = os.path.abspath(os.path.expanduser(cache_dir))
+        self.do_hash = do_hash
+        # created here, before workers that share the cache could race to create it
+        util.make_dir_path(self.cache_dir)
+
+    def __get_file_key(self, filepath):
+        st = os.stat(filepath)
+        return (os.path.abspath(filepath), st.st_size, st.st_mtime, util.hash_file(filepath) if self.do_hash else None)
+
+    def __get_entry_path(self, filepath, parser, do_simple):
+        # a changed file replaces the entry of its previous version
+        name = repr((os.path.abspath(filepath), parser.get_settings(do_simple)))
+        return os.path.join(self.cache_dir, "{0}.parsecache".format(hashlib.sha1(name).hexdigest()))
+
+    def __load_header(self, entry_path):
+        try:
+            with open(entry_path, 'rb') as f:
+                return cPickle.load(f)
+        except Exception as e:
+            logging.warning("ignoring unreadable parse cache entry at {0}: {1}".format(entry_path, repr(e)))
+            return None
+
+    def find(self, filepath, parser, do_simple):
+        ''' returns the path of the entry for parsing filepath with parser, or None if there is no valid one '''
+        entry_path = self.__get_entry_path(filepath, parser, do_simple)
+        if not os.path.exists(entry_path):
+            return None
+
+        header = self.__load_header(entry_path)
+        if header is None or header['version'] != PARSE_CACHE_VERSION or header['settings'] != parser.get_settings(do_simple):
+            return None
+        elif header['file'] != self.__get_file_key(filepath):
+            logging.info("ignoring parse cache entry at {0} because {1} changed".format(entry_path, filepath))
+            return None
+
+        logging.info("using parse cache entry at {0} for {1}".format(entry_path, filepath))
+        return entry_path
+
+    def load(self, entry_path):
+        ''' returns the ParseChunk of the entry at entry_path, which find returned '''
+        with open(entry_path, 'rb') as f:
+            cPickle.load(f)
+            return cPickle.load(f)
+
+    def put(self, filepath, parser, do_simple, chunk):
+        '''
+        saves chunk, the results of parsing filepath with a chunk parser of the same settings as parser,
+        and returns the path of its entry
+        '''
+        entry_path = self.__get_entry_path(filepath, parser, do_simple)
+        header = {'version': PARSE_CACHE_VERSION, 'settings': parser.get_settings(do_simple), 'file': self.__get_file_key(filepath)}
+
+        # write to a temporary file first, so a crash never leaves a half-written entry
+        tmp_path = "{0}.{1}.tmp".format(entry_path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            cPickle.dump(header, f, cPickle.HIGHEST_PROTOCOL)
+            cPickle.dump(chunk, f, cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, entry_path)
+        return entry_path
+
+    def prune(self):
+        ''' removes the entries of log files that no longer exist, and returns how many were removed '''
+        num_removed = 0
+        if not os.path.exists(self.cache_dir):
+            return num_removed
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(".parsecache"):
+                continue
+            entry_path = os.path.join(self.cache_dir, name)
+            header = self.__load_header(entry_path)
+            if header is None or header.get('version') != PARSE_CACHE_VERSION or not os.path.exists(header['file'][0]):
+                os.remove(entry_path)
+                num_removed += 1
+        return num_removed
+
+# numpy .npz archives are zip files
+COLUMNAR_MAGIC = 'PK\x03\x04'
+
+# the sections of a node's json db that are stored as columns, as (parent key, section key, depth, is_list);
+# each entry of a section is a tree of dicts nested depth levels deep, whose leaves are lists if is_list
+COLUMNAR_SECTIONS = [('tgen', 'transfers_summary', 2, True), ('tor', 'bandwidth_summary', 1, False),
+                     ('tor', 'circuits_summary', 0, True), ('tor', 'streams_summary', 1, True)]
+
+# the fields of a transfer in the json db, by the type of their column
+TRANSFER_STR_FIELDS = ['transfer_id', 'endpoint_local', 'endpoint_proxy', 'endpoint_remote', 'hostname_local',
+                       'hostname_remote', 'method', 'error_code']
+TRANSFER_INT_FIELDS = ['filesize_bytes', 'total_bytes_read', 'total_bytes_write', 'payload_bytes_status']
+TRANSFER_BOOL_FIELDS = ['is_success', 'is_error', 'is_complete', 'is_commander']
+TRANSFER_FLOAT_FIELDS = ['unix_ts_start', 'unix_ts_end']
+
+def is_columnar_file(filepath):
+    with open(filepath, 'rb') as f:
+        return f.read(len(COLUMNAR_MAGIC)) == COLUMNAR_MAGIC
+
+def encode_str_column(numpy, values):
+    # numpy byte string columns hold utf-8, while json db strings may be unicode
+    if not all([isinstance(v, basestring) for v in values]):
+        raise ValueError("expected strings")
+    return numpy.array([v.encode('utf-8') if isinstance(v, unicode) else v for v in values], dtype=str)
+
+def decode_str_column(column):
+    return [v.decode('utf-8') for v in column.tolist()]
+
+def encode_number_column(numpy, values):
+    # json keeps ints and floats apart, so a column must hold only one of them
+    if all([isinstance(v, (int, long)) and not isinstance(v, bool) for v in values]) and len(values) > 0:
+        return numpy.array(values, dtype=numpy.int64)
+    elif all([isinstance(v, float) for v in values]):
+        return numpy.array(values, dtype=numpy.float64)
+    raise ValueError("expected either ints or floats")
+
+def encode_key_column(numpy, keys):
+    # json turns integer keys like seconds and file sizes into strings, but we can keep them typed
+    if all([isinstance(k, (int, long)) or (isinstance(k, basestring) and k.isdigit() and str(int(k)) == k) for k in keys]):
+        return numpy.array([int(k) for k in keys], dtype=numpy.int64)
+    return encode_str_column(numpy, keys)
+
+def decode_key_column(column):
+    # keys are always strings in a json db
+    if column.dtype.kind in 'iu':
+        return column.astype(str).tolist()
+    return decode_str_column(column)
+
+def flatten_db_tree(tree, depth, is_list):
+    '''
+    flattens a tree of dicts nested depth levels deep into one list of keys per level and a list
+    of leaf values, with a row for each item of list leaves; raises ValueError for trees that
+    unflatten_db_tree could not restore
+    '''
+    keys, values = [[] for _ in xrange(depth)], []
+    def visit(node, level, path):
+        if level == depth:
+            if is_list and (not isinstance(node, list) or (level > 0 and len(node) == 0)):
+                raise ValueError("expected a non-empty list at {0}".format(path))
+            for value in (node if is_list else [node]):
+                for i in xrange(depth):
+                    keys[i].append(path[i])
+                values.append(value)
+        elif not isinstance(node, dict) or (level > 0 and len(node) == 0):
+            raise ValueError("expected a non-empty dict at {0}".format(path))
+        else:
+            for key in node:
+                visit(node[key], level + 1, path + [key])
+    visit(tree, 0, [])
+    return keys, values
+
+def unflatten_db_tree(keys, values, depth, is_list):
+    if depth == 0:
+        return values
+    elif depth == 1 and not is_list:
+        return dict(zip(keys[0], values))
+    tree = {}
+    for row in zip(*(keys + [values])):
+        d = tree
+        for k in row[:depth - 1]:
+            d = d.setdefault(k, {})
+        if is_list:
+            d.setdefault(row[depth - 1], []).append(row[depth])
+        else:
+            d[row[depth - 1]] = row[depth]
+    return tree
+
+def encode_transfers(numpy, prefix, transfers):
+    fields = TRANSFER_STR_FIELDS + TRANSFER_INT_FIELDS + TRANSFER_BOOL_FIELDS + TRANSFER_FLOAT_FIELDS
+    tids = transfers.keys()
+    step_seconds = {step: [] for step in TRANSFER_STEPS}
+    progress_seconds = [[] for _ in TRANSFER_PROGRESS_DECILES]
+    for tid in tids:
+        xfer = transfers[tid]
+        if not isinstance(xfer, dict) or set(xfer.keys()) != set(fields + ['elapsed_seconds']) or \
+                'payload_progress' not in xfer['elapsed_seconds'] or \
+                len(set(xfer['elapsed_seconds'].keys()) - set(TRANSFER_STEPS + ['payload_progress'])) > 0:
+            raise ValueError("unexpected fields in transfer {0}".format(tid))
+        elapsed = xfer['elapsed_seconds']
+        for step in TRANSFER_STEPS:
+            step_seconds[step].append(elapsed[step] if step in elapsed else numpy.nan)
+        progress = {TRANSFER_PROGRESS_DECILES.index(float(decile)): secs for (decile, secs) in elapsed['payload_progress'].items()}
+        for i in xrange(len(TRANSFER_PROGRESS_DECILES)):
+            progress_seconds[i].append(progress[i] if i in progress else numpy.nan)
+
+    columns = {"{0}.key".format(prefix): encode_str_column(numpy, tids)}
+    for field in fields:
+        values = [transfers[tid][field] for tid in tids]
+        if field in TRANSFER_STR_FIELDS:
+            columns["{0}.{1}".format(prefix, field)] = encode_str_column(numpy, values)
+        elif field in TRANSFER_BOOL_FIELDS:
+            if not all([isinstance(v, bool) for v in values]):
+                raise ValueError("expected booleans in transfer field {0}".format(field))
+            columns["{0}.{1}".format(prefix, field)] = numpy.array(values, dtype=numpy.bool_)
+        else:
+            column = encode_number_column(numpy, values) if len(values) > 0 else numpy.array([])
+            if len(values) > 0 and (column.dtype.kind == 'f') != (field in TRANSFER_FLOAT_FIELDS):
+                raise ValueError("unexpected number type in transfer field {0}".format(field))
+            columns["{0}.{1}".format(prefix, field)] = column
+    # missing times are stored as NaN
+    for step in TRANSFER_STEPS:
+        columns["{0}.elapsed.{1}".format(prefix, step)] = numpy.array(step_seconds[step], dtype=numpy.float64)
+    for i in xrange(len(TRANSFER_PROGRESS_DECILES)):
+        columns["{0}.progress.{1}".format(prefix, i)] = numpy.array(progress_seconds[i], dtype=numpy.float64)
+    return columns
+
+def decode_transfers(npz, prefix):
+    tids = decode_str_column(npz["{0}.key".format(prefix)])
+    field_values = {}
+    for field in TRANSFER_STR_FIELDS:
+        field_values[field] = decode_str_column(npz["{0}.{1}".format(prefix, field)])
+    for field in TRANSFER_INT_FIELDS + TRANSFER_BOOL_FIELDS + TRANSFER_FLOAT_FIELDS:
+        field_values[field] = npz["{0}.{1}".format(prefix, field)].tolist()
+    step_seconds = [(step, npz["{0}.elapsed.{1}".format(prefix, step)].tolist()) for step in TRANSFER_STEPS]
+    # json writes the decile keys with repr()
+    progress_seconds = [(u'%r' % decile, npz["{0}.progress.{1}".format(prefix, i)].tolist()) for (i, decile) in enumerate(TRANSFER_PROGRESS_DECILES)]
+
+    transfers = {}
+    for i, tid in enumerate(tids):
+        xfer = {field: field_values[field][i] for field in field_values}
+        # NaN is the only value that is not equal to itself
+        xfer['elapsed_seconds'] = {step: values[i] for (step, values) in step_seconds if values[i] == values[i]}
+        xfer['elapsed_seconds']['payload_progress'] = {decile: values[i] for (decile, values) in progress_seconds if values[i] == values[i]}
+        transfers[tid] = xfer
+    return transfers
+
+def encode_section(numpy, prefix, section, depth, is_list):
+    if not isinstance(section, dict):
+        raise ValueError("expected a dict")
+    columns, names = {}, section.keys()
+    for (j, name) in enumerate(names):
+        keys, values = flatten_db_tree(section[name], depth, is_list)
+        for level in xrange(depth):
+            columns["{0}.{1}.k{2}".format(prefix, j, level)] = encode_key_column(numpy, keys[level])
+        columns["{0}.{1}.v".format(prefix, j)] = encode_number_column(numpy, values) if len(values) > 0 else numpy.array([])
+    return names, columns
+
+def decode_section(npz, prefix, names, depth, is_list):
+    section = {}
+    for (j, name) in enumerate(names):
+        keys = [decode_key_column(npz["{0}.{1}.k{2}".format(prefix, j, level)]) for level in xrange(depth)]
+        values = npz["{0}.{1}.v".format(prefix, j)].tolist()
+        section[name] = unflatten_db_tree(keys, values, depth, is_list)
+    return section
+
+def save_columnar_db(json_db, filepath, do_compress=True):
+    '''
+    writes json_db to a numpy .npz archive at filepath, where the tgen and tor summaries and the
+    tgen transfers are stored as typed columns, and the rest of each node's data as json text
+    '''
+    import numpy
+    columns, nodes = {}, []
+    for i, node in enumerate(json_db['data']):
+        node_db, rest, sections = json_db['data'][node], {}, []
+        for key in node_db:
+            rest[key] = dict(node_db[key]) if key in ('tgen', 'tor') else node_db[key]
+
+        for (parent_key, section_key, depth, is_list) in COLUMNAR_SECTIONS + [('tgen', 'transfers', None, None)]:
+            if parent_key not in rest or section_key not in rest[parent_key]:
+                continue
+            prefix = "n{0}.{1}.{2}".format(i, parent_key, section_key)
+            try:
+                if section_key == 'transfers':
+                    names, section_columns = None, encode_transfers(numpy, prefix, rest[parent_key][section_key])
+                else:
+                    names, section_columns = encode_section(numpy, prefix, rest[parent_key][section_key], depth, is_list)
+            except (ValueError, OverflowError) as e:
+                logging.info("storing {0} of {1} as json: {2}".format(section_key, node, e))
+                continue
+            columns.update(section_columns)
+            sections.append([parent_key, section_key, names])
+            rest[parent_key].pop(section_key)
+
+        columns["n{0}.sections".format(i)] = numpy.array(json.dumps(sections))
+        columns["n{0}.json".format(i)] = numpy.array(json.dumps(rest, default=json_encode_mapping))
+        nodes.append(node)
+
+    columns['meta'] = numpy.array(json.dumps({'type': json_db['type'], 'version': json_db['version'], 'nodes': nodes}))
+    if do_compress:
+        numpy.savez_compressed(filepath, **columns)
+    else:
+        numpy.savez(filepath, **columns)
+
+class ColumnarDB(object):
+    '''
+    an analysis database written by save_columnar_db, whose sections are only read from the
+    archive and converted back to the json db layout when they are first needed
+    '''
+
+    def __init__(self, filepath, nodes=None):
+        import numpy
+        self.npz = numpy.load(filepath)
+        self.meta = json.loads(self.npz['meta'].item())
+        self.node_indices = {node: i for (i, node) in enumerate(self.meta['nodes'])}
+        if nodes is not None:
+            self.meta['nodes'] = [node for node in self.meta['nodes'] if node in nodes]
+        self.node_sections = {}
+        self.node_dbs = {}
+        self.sections = {}
+
+    def get_nodes(self):
+        return list(self.meta['nodes'])
+
+    def __get_node_sections(self, node):
+        if node not in self.node_sections:
+            entries = json.loads(self.npz["n{0}.sections".format(self.node_indices[node])].item())
+            self.node_sections[node] = {(parent_key, section_key): names for (parent_key, section_key, names) in entries}
+        return self.node_sections[node]
+
+    def get_section(self, node, parent_key, section_key):
+        ''' returns json_db['data'][node][parent_key][section_key], raising KeyError if it does not exist '''
+        node_sections = self.__get_node_sections(node)
+        if (parent_key, section_key) not in node_sections:
+            return self.get_node_db(node)[parent_key][section_key]
+
+        if (node, parent_key, section_key) not in self.sections:
+            prefix = "n{0}.{1}.{2}".format(self.node_indices[node], parent_key, section_key)
+            if section_key == 'transfers':
+                section = decode_transfers(self.npz, prefix)
+            else:
+                depth, is_list = [(d, l) for (p, s, d, l) in COLUMNAR_SECTIONS if (p, s) == (parent_key, section_key)][0]
+                section = decode_section(self.npz, prefix, node_sections[(parent_key, section_key)], depth, is_list)
+            self.sections[(node, parent_key, section_key)] = section
+        return self.sections[(node, parent_key, section_key)]
+
+    def get_node_db(self, node):
+        # this parses the json part of the node, which holds the circuits and streams
+        if node not in self.node_dbs:
+            node_db = json.loads(self.npz["n{0}.json".format(self.node_indices[node])].item())
+            for (parent_key, section_key) in self.__get_node_sections(node):
+                node_db[parent_key][section_key] = self.get_section(node, parent_key, section_key)
+            self.node_dbs[node] = node_db
+        return self.node_dbs[node]
+
+    def get_json_db(self):
+        data = {node: self.get_node_db(node) for node in self.meta['nodes']}
+        return {'type': self.meta['type'], 'version': self.meta['version'], 'data': data}
+
+# the sections that are needed to visualize an analysis
+SUMMARY_SECTIONS = [('tgen', 'transfers_summary'), ('tor', 'bandwidth_summary')]
+
+class JSONSectionDB(object):
+    '''
+    an analysis database in json format that is read as a stream, keeping only some sections of
+    some nodes; other sections are read with another pass over the file when they are first needed
+    '''
+
+    def __init__(self, filepath, sections=None, nodes=None):
+        self.filepath = filepath
+        self.nodes = set(nodes) if nodes is not None else None
+        self.sections = set(sections) if sections is not None else set()
+        db = self.__read(self.sections)
+        self.meta = {k: db[k] for k in db if k != 'data'}
+        self.data = db.get('data', {})
+
+    def __read(self, sections):
+        inf = util.DataSource(self.filepath)
+        inf.open()
+        reader = util.JSONStreamReader(inf.get_file_handle())
+        db = {}
+        for key in reader.iter_object():
+            if key != 'data':
+                db[key] = reader.read_value()
+                continue
+            data = db.setdefault('data', {})
+            for node in reader.iter_object():
+                if self.nodes is not None and node not in self.nodes:
+                    reader.skip_value()
+                    continue
+                node_db = data.setdefault(node, {})
+                for parent_key in reader.iter_object():
+                    # node values such as the measurement_ip are always kept
+                    if reader.peek() != '{':
+                        node_db[parent_key] = reader.read_value()
+                        continue
+                    parent_db = node_db.setdefault(parent_key, {})
+                    for section_key in reader.iter_object():
+                        if (parent_key, section_key) in sections:
+                            parent_db[section_key] = reader.read_value()
+                        else:
+                            reader.skip_value()
+        inf.close()
+        return db
+
+    def get_nodes(self):
+        return self.data.keys()
+
+    def get_section(self, node, parent_key, section_key):
+        ''' returns json_db['data'][node][parent_key][section_key], raising KeyError if it does not exist '''
+        if (parent_key, section_key) not in self.sections:
+            logging.info("reading section {0}/{1} from {2}".format(parent_key, section_key, self.filepath))
+            db = self.__read(set([(parent_key, section_key)]))
+            for (name, node_db) in db.get('data', {}).items():
+                for (name_key, value) in node_db.items():
+                    if isinstance(value, dict):
+                        self.data[name].setdefault(name_key, {}).update(value)
+            self.sections.add((parent_key, section_key))
+        return self.data[node][parent_key][section_key]
+
+    def get_json_db(self):
+        inf = util.DataSource(self.filepath)
+        inf.open()
+        db = json.load(inf.get_file_handle())
+        inf.close()
+        if self.nodes is not None:
+            db['data'] = {node: db['data'][node] for node in db['data'] if node in self.nodes}
+        return db
+
+ANALYSIS_INDEX_VERSION = 1
+
+def get_analysis_index_path(filepath):
+    return "{0}.index".format(filepath)
+
+def save_analysis_index(json_db, offsets, filepath):
+    ''' writes the offsets that util.write_json found for the nodes and sections of json_db '''
+    nodes = {}
+    for (path, (start, end)) in offsets.items():
+        if path[0] != 'data' or len(path) not in [2, 4]:
+            continue
+        node_index = nodes.setdefault(path[1], {'range': None, 'sections': [], 'values': {}})
+        if len(path) == 2:
+            node_index['range'] = [start, end]
+            # values such as the measurement_ip, and empty parents, are kept in the index, so that the
+            # sections can be read on their own
+            node_db = json_db['data'][path[1]]
+            node_index['values'] = {k: v for (k, v) in node_db.items() if not isinstance(v, Mapping) or len(v) == 0}
+        else:
+            node_index['sections'].append([path[2], path[3], start, end])
+
+    index = {'type': 'onionperf-index', 'version': ANALYSIS_INDEX_VERSION, 'data_file_size': os.path.getsize(filepath),
+             'meta': {k: json_db[k] for k in json_db if k != 'data'}, 'nodes': nodes}
+    index_filepath = get_analysis_index_path(filepath)
+    logging.info("saving analysis index to {0}".format(index_filepath))
+    with open(index_filepath, 'w') as f:
+        json.dump(index, f, sort_keys=True)
+
+def load_analysis_index(filepath):
+    ''' returns the index that was saved next to filepath, or None if there is no usable index '''
+    index_filepath = get_analysis_index_path(filepath)
+    if not os.path.exists(index_filepath):
+        return None
+    with open(index_filepath, 'r') as f:
+        index = json.load(f)
+    if index.get('type') != 'onionperf-index' or index.get('version') != ANALYSIS_INDEX_VERSION:
+        logging.warning("ignoring analysis index {0} with unsupported version".format(index_filepath))
+        return None
+    elif index['data_file_size'] != os.path.getsize(filepath):
+        logging.warning("ignoring analysis index {0} that does not match {1}".format(index_filepath, filepath))
+        return None
+    return index
+
+class IndexedJSONDB(object):
+    '''
+    an analysis database in json format with an index saved next to it, whose sections are
+    read from their byte ranges in the file when they are first needed
+    '''
+
+    def __init__(self, filepath, index, nodes=None):
+        self.meta = index['meta']
+        self.index_nodes = index['nodes']
+        self.nodes = [node for node in self.index_nodes if nodes is None or node in nodes]
+        self.reader = util.ByteRangeReader(filepath)
+        self.sections = {}
+
+    def get_nodes(self):
+        return list(self.nodes)
+
+    def get_section(self, node, parent_key, section_key):
+        ''' returns json_db['data'][node][parent_key][section_key], raising KeyError if it does not exist '''
+        if node not in self.nodes:
+            raise KeyError(node)
+        if (node, parent_key, section_key) not in self.sections:
+            ranges = {(p, s): (start, end) for (p, s, start, end) in self.index_nodes[node]['sections']}
+            (start, end) = ranges[(parent_key, section_key)]
+            self.sections[(node, parent_key, section_key)] = json.loads(self.reader.read(start, end))
+        return self.sections[(node, parent_key, section_key)]
+
+    def iter_node_dbs(self, node):
+        ''' yields the values of node and then each of its sections as a node db of its own, see Analysis.iter_node_dbs '''
+        node_index = self.index_nodes[node]
+        if 'values' not in node_index:
+            # an index saved before the values were kept in it
+            yield json.loads(self.reader.read(*node_index['range']))
+            return
+        yield dict(node_index['values'])
+        # in key order, so that the circuits are merged before the streams that refer to them
+        for (parent_key, section_key, start, end) in sorted(node_index['sections']):
+            yield {parent_key: {section_key: json.loads(self.reader.read(start, end))}}
+
+    def get_json_db(self):
+        data = {}
+        for node in self.nodes:
+            (start, end) = self.index_nodes[node]['range']
+            data[node] = json.loads(self.reader.read(start, end))
+        db = dict(self.meta)
+        db['data'] = data
+        return db
+
+# sqlite files start with this header string
+SQLITE_MAGIC = 'SQLite format 3\x00'
+
+# the columns that records are indexed and filtered on, besides their node, key, and times
+SQLITE_RECORD_COLUMNS = {'transfers': [('filesize_bytes', 'INTEGER'), ('error_code', 'TEXT'), ('is_error', 'INTEGER')],
+                         'circuits': [('failure_reason_local', 'TEXT')],
+                         'streams': [('circuit_id', 'TEXT'), ('failure_reason_local', 'TEXT'), ('target', 'TEXT')]}
+
+SQLITE_SCHEMA = ["CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)",
+                 "CREATE TABLE nodes (node TEXT PRIMARY KEY, data TEXT)",
+                 # the data of a section that is held in its own table is NULL
+                 "CREATE TABLE sections (node TEXT, parent_key TEXT, section_key TEXT, data TEXT, PRIMARY KEY (node, parent_key, section_key))",
+                 "CREATE TABLE circuit_hops (node TEXT, record_id TEXT, hop INTEGER, fingerprint TEXT, nickname TEXT)",
+                 "CREATE TABLE bandwidth (node TEXT, unix_ts INTEGER, bytes_read INTEGER, bytes_written INTEGER)"] + \
+                ["CREATE TABLE {0} (node TEXT, record_id TEXT, unix_ts_start REAL, unix_ts_end REAL, {1}, data TEXT)".format(
+                    table, ", ".join(["{0} {1}".format(name, kind) for (name, kind) in columns])) for (table, columns) in sorted(SQLITE_RECORD_COLUMNS.items())]
+
+# indexes are created after the rows are inserted, which is faster than keeping them up to date
+SQLITE_INDEXES = ["CREATE INDEX transfers_node_ts ON transfers (node, unix_ts_start)",
+                  "CREATE INDEX transfers_filesize_ts ON transfers (filesize_bytes, unix_ts_start)",
+                  "CREATE INDEX transfers_ts ON transfers (unix_ts_start)",
+                  "CREATE INDEX circuits_node_ts ON circuits (node, unix_ts_start)",
+                  "CREATE INDEX circuits_ts ON circuits (unix_ts_start)",
+                  "CREATE INDEX circuit_hops_record ON circuit_hops (node, record_id)",
+                  "CREATE INDEX circuit_hops_fingerprint ON circuit_hops (fingerprint)",
+                  "CREATE INDEX circuit_hops_nickname ON circuit_hops (nickname)",
+                  "CREATE INDEX streams_node_ts ON streams (node, unix_ts_start)",
+                  "CREATE INDEX streams_ts ON streams (unix_ts_start)",
+                  "CREATE INDEX bandwidth_node_ts ON bandwidth (node, unix_ts)"]
+
+def is_sqlite_file(filepath):
+    with open(filepath, 'rb') as f:
+        return f.read(len(SQLITE_MAGIC)) == SQLITE_MAGIC
+
+def is_bandwidth_table_section(section):
+    # only a bandwidth summary with integer second keys is stored as rows, anything else stays json
+    if not isinstance(section, dict) or sorted(section.keys()) != ['bytes_read', 'bytes_written']:
+        return False
+    for counts in section.values():
+        if not isinstance(counts, dict):
+            return False
+        for (ts, count) in counts.iteritems():
+            if str(ts) != str(int(ts)) or not isinstance(count, (int, long)):
+                return False
+    return True
+
+def write_sqlite_db(connection, json_db):
+    ''' fills the empty sqlite database of connection with the tables and rows of json_db '''
+    for statement in SQLITE_SCHEMA:
+        connection.execute(statement)
+    connection.executemany("INSERT INTO meta VALUES (?, ?)", [(k, json.dumps(json_db[k])) for k in json_db if k != 'data'])
+
+    for (node, node_db) in json_db['data'].iteritems():
+        node_meta = {}
+        for (parent_key, parent_db) in node_db.iteritems():
+            # node values such as the measurement_ip are not sections
+            if not isinstance(parent_db, dict):
+                node_meta[parent_key] = parent_db
+                continue
+            node_meta[parent_key] = {}
+            for (section_key, section) in parent_db.iteritems():
+                if (parent_key, section_key) in RECORD_SECTIONS and isinstance(section, Mapping):
+                    columns = [name for (name, kind) in SQLITE_RECORD_COLUMNS[section_key]]
+                    statement = "INSERT INTO {0} VALUES ({1})".format(section_key, ", ".join(["?"] * (len(columns) + 5)))
+                    connection.executemany(statement, [[node, str(record_id), record.get('unix_ts_start'), record.get('unix_ts_end')] +
+                                                       [record.get(name) for name in columns] + [json.dumps(record)]
+                                                       for (record_id, record) in section.iteritems()])
+                    if section_key == 'circuits':
+                        connection.executemany("INSERT INTO circuit_hops VALUES (?, ?, ?, ?, ?)",
+                                               [(node, str(record_id), hop, name.split('~')[0].lstrip('$'), name.partition('~')[2])
+                                                for (record_id, record) in section.iteritems()
+                                                for (hop, (name, elapsed)) in enumerate(record.get('path', []))])
+                    data = None
+                elif (parent_key, section_key) == ('tor', 'bandwidth_summary') and is_bandwidth_table_section(section):
+                    read, written = section['bytes_read'], section['bytes_written']
+                    connection.executemany("INSERT INTO bandwidth VALUES (?, ?, ?, ?)",
+                                           [(node, int(ts), read.get(ts), written.get(ts)) for ts in set(read) | set(written)])
+                    data = None
+                else:
+                    data = json.dumps(section)
+                connection.execute("INSERT INTO sections VALUES (?, ?, ?, ?)", (node, parent_key, section_key, data))
+        connection.execute("INSERT INTO nodes VALUES (?, ?)", (node, json.dumps(node_meta)))
+
+    for statement in SQLITE_INDEXES:
+        connection.execute(statement)
+    connection.commit()
+
+def save_sqlite_db(json_db, filepath):
+    # sqlite would add our tables to those of an existing file
+    if os.path.exists(filepath):
+        os.remove(filepath)
+    connection = sqlite3.connect(filepath)
+    write_sqlite_db(connection, json_db)
+    connection.close()
+
+class SQLiteDB(object):
+    '''
+    an analysis database in sqlite, which holds the transfers, circuits, streams, and bandwidth
+    samples in tables that are indexed on node, time, and file size; sections are read when they
+    are first needed, and the query methods filter records in the database without reading the rest
+    '''
+
+    def __init__(self, connection, nodes=None):
+        self.connection = connection
+        self.meta = {k: json.loads(v) for (k, v) in self.connection.execute("SELECT key, value FROM meta")}
+        self.nodes = [node for (node,) in self.connection.execute("SELECT node FROM nodes ORDER BY node")
+                      if nodes is None or node in nodes]
+        self.node_set = set(self.nodes)
+        self.sections = {}
+
+    def get_nodes(self):
+        return list(self.nodes)
+
+    def get_section(self, node, parent_key, section_key):
+        ''' returns json_db['data'][node][parent_key][section_key], raising KeyError if it does not exist '''
+        if node not in self.node_set:
+            raise KeyError(node)
+        if (node, parent_key, section_key) not in self.sections:
+            row = self.connection.execute("SELECT data FROM sections WHERE node = ? AND parent_key = ? AND section_key = ?",
+                                          (node, parent_key, section_key)).fetchone()
+            if row is None:
+                raise KeyError(section_key)
+            elif row[0] is not None:
+                section = json.loads(row[0])
+            elif section_key == 'bandwidth_summary':
+                section = {'bytes_read': {}, 'bytes_written': {}}
+                for (ts, bytes_read, bytes_written) in self.connection.execute(
+                        "SELECT unix_ts, bytes_read, bytes_written FROM bandwidth WHERE node = ?", (node,)):
+                    # the keys are strings, as they are in a json file
+                    if bytes_read is not None: section['bytes_read'][str(ts)] = bytes_read
+                    if bytes_written is not None: section['bytes_written'][str(ts)] = bytes_written
+            else:
+                section = {record_id: json.loads(data) for (record_id, data) in self.connection.execute(
+                    "SELECT record_id, data FROM {0} WHERE node = ?".format(section_key), (node,))}
+            self.sections[(node, parent_key, section_key)] = section
+        return self.sections[(node, parent_key, section_key)]
+
+    def get_node_db(self, node):
+        node_db = json.loads(self.connection.execute("SELECT data FROM nodes WHERE node = ?", (node,)).fetchone()[0])
+        for (parent_key, section_key) in self.connection.execute("SELECT parent_key, section_key FROM sections WHERE node = ?", (node,)):
+            node_db[parent_key][section_key] = self.get_section(node, parent_key, section_key)
+        return node_db
+
+    def get_json_db(self):
+        db = dict(self.meta)
+        db['data'] = {node: self.get_node_db(node) for node in self.nodes}
+        return db
+
+    def __query_records(self, table, node, start, end, conditions, args):
+        # times select the records that started in [start, end)
+        if node is not None:
+            conditions.append("node = ?")
+            args.append(node)
+        if start is not None:
+            conditions.append("unix_ts_start >= ?")
+            args.append(start)
+        if end is not None:
+            conditions.append("unix_ts_start < ?")
+            args.append(end)
+        where = " WHERE " + " AND ".join(conditions) if len(conditions) > 0 else ""
+        rows = self.connection.execute("SELECT node, data FROM {0}{1} ORDER BY unix_ts_start".format(table, where), args)
+        return [(node, json.loads(data)) for (node, data) in rows if node in self.node_set]
+
+    def query_transfers(self, node=None, start=None, end=None, filesize=None, error_code=None, is_error=None):
+        ''' returns the (node, transfer) pairs of the transfers that match all of the given filters '''
+        conditions, args = [], []
+        if filesize is not None:
+            conditions.append("filesize_bytes = ?")
+            args.append(filesize)
+        if error_code is not None:
+            conditions.append("error_code = ?")
+            args.append(error_code)
+        if is_error is not None:
+            conditions.append("is_error = ?")
+            args.append(1 if is_error else 0)
+        return self.__query_records('transfers', node, start, end, conditions, args)
+
+    def query_circuits(self, node=None, start=None, end=None, relay=None, is_failed=None):
+        '''
+        returns the (node, circuit) pairs of the circuits that match all of the given filters;
+        relay is the fingerprint or nickname of a relay in the circuit path
+        '''
+        conditions, args = [], []
+        if relay is not None:
+            conditions.append("record_id IN (SELECT record_id FROM circuit_hops WHERE circuit_hops.node = circuits.node AND (fingerprint = ? OR nickname = ?))")
+            args.extend([relay.lstrip('$'), relay])
+        if is_failed is not None:
+            conditions.append("failure_reason_local IS NOT NULL" if is_failed else "failure_reason_local IS NULL")
+        return self.__query_records('circuits', node, start, end, conditions, args)
+
+    def query_streams(self, node=None, start=None, end=None, circuit_id=None, target=None, is_failed=None):
+        ''' returns the (node, stream) pairs of the streams that match all of the given filters '''
+        conditions, args = [], []
+        if circuit_id is not None:
+            conditions.append("circuit_id = ?")
+            args.append(str(circuit_id))
+        if target is not None:
+            conditions.append("target = ?")
+            args.append(target)
+        if is_failed is not None:
+            conditions.append("failure_reason_local IS NOT NULL" if is_failed else "failure_reason_local IS NULL")
+        return self.__query_records('streams', node, start, end, conditions, args)
+
+    def query_bandwidth(self, node=None, start=None, end=None):
+        ''' returns (node, unix_ts, bytes_read, bytes_written) tuples for the bandwidth samples in [start, end) '''
+        conditions, args = [], []
+        if node is not None:
+            conditions.append("node = ?")
+            args.append(node)
+        if start is not None:
+            conditions.append("unix_ts >= ?")
+            args.append(start)
+        if end is not None:
+            conditions.append("unix_ts < ?")
+            args.append(end)
+        where = " WHERE " + " AND ".join(conditions) if len(conditions) > 0 else ""
+        rows = self.connection.execute("SELECT node, unix_ts, bytes_read, bytes_written FROM bandwidth{0} ORDER BY node, unix_ts".format(where), args)
+        return [row for row in rows if row[0] in self.node_set]
+
+class LiveParser(util.Writable):
+    '''
+    a listener for a util.FileWritable that parses the lines of its log as they are written,
+    so that the results for a day are ready when the log is rotated at the end of that day
+    '''
+
+    def __init__(self, parser_class, do_simple=False, memory_budget=None):
+        self.parser_class = parser_class
+        self.do_simple = do_simple
+        self.memory_budget = memory_budget
+        self.parser = parser_class(date_filter=datetime.datetime.utcnow().date(), memory_budget=memory_budget)
+        self.rotated_parser = None
+        self.partial_line = ''
+
+    def write(self, msg):
+        # a write may hold a partial line or several lines, so only parse the complete ones
+        lines = (self.partial_line + msg).split('\n')
+        self.partial_line = lines.pop()
+        for line in lines:
+            # we are called from the write path, so we must never raise
+            try:
+                self.parser.parse_line(line + '\n', do_simple=self.do_simple)
+            except:
+                logging.warning("{0}: skipping line due to parsing error: {1}".format(self.parser_class.__name__, line))
+
+    def rotate_file(self, filename_datetime=None):
+        # the rotated log holds the day of filename_datetime, new lines belong to the next day
+        self.rotated_parser = self.parser
+        self.parser = self.parser_class(date_filter=filename_datetime.date() + datetime.timedelta(1), memory_budget=self.memory_budget)
+
+    def take_rotated_parser(self):
+        parser, self.rotated_parser = self.rotated_parser, None
+        return parser
+
+    def close(self):
+        pass
+
+class LiveAnalysis(object):
+    '''
+    parses the tgen and torctl logs of a measurement while they are written, by adding
+    tgen_listener and torctl_listener to the util.FileWritable objects of those logs;
+    see TGenParser and TorCtlParser for memory_budget
+    '''
+
+    def __init__(self, nickname=None, do_simple=False, memory_budget=None):
+        self.nickname = nickname
+        self.tgen_listener = LiveParser(TGenParser, do_simple=do_simple, memory_budget=memory_budget)
+        self.torctl_listener = LiveParser(TorCtlParser, do_simple=do_simple, memory_budget=memory_budget)
+
+    def get_rotated_analysis(self, ip_address=None):
+        '''
+        returns the Analysis of the day that the logs were last rotated for, which is the
+        same as that of running analyze() on the rotated logs with that day as date_filter
+        '''
+        anal = Analysis(nickname=self.nickname, ip_address=ip_address)
+        for (listener, json_db_key) in [(self.tgen_listener, 'tgen'), (self.torctl_listener, 'tor')]:
+            parser = listener.take_rotated_parser()
+            if parser is not None:
+                anal.date_filter = parser.date_filter
+                anal.store_parser_data(parser, json_db_key)
+        anal.did_analysis = True
+        return anal
+
+# the payload fractions at which a transfer records its progress
+TRANSFER_PROGRESS_DECILES = [0.0, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0]
+
+# the steps of a transfer in the order of the elapsed times in a completed transfer's log line
+TRANSFER_STEPS = ['socket_create', 'socket_connect', 'proxy_init', 'proxy_choice', 'proxy_request',
+                  'proxy_response', 'command', 'response', 'first_byte', 'last_byte', 'checksum']
+
 class TransferStatusEvent(object):
+    __slots__ = ('is_success', 'is_error', 'is_complete', 'unix_ts_end', 'endpoint_local', 'endpoint_proxy',
+                 'endpoint_remote', 'transfer_id', 'hostname_local', 'method', 'filesize_bytes', 'hostname_remote',
+                 'error_code', 'total_bytes_read', 'total_bytes_write', 'is_commander', 'payload_bytes_status',
+                 'unconsumed_parts')
 
     def __init__(self, line):
         self.is_success = False
@@ -323,10 +1429,11 @@ class TransferStatusEvent(object):
         parts = line.strip().split()
         self.unix_ts_end = util.timestamp_to_seconds(parts[2])
 
+        # the strings that repeat across transfers are shared
         transport_parts = parts[8].split(',')
         self.endpoint_local = transport_parts[2]
-        self.endpoint_proxy = transport_parts[3]
-        self.endpoint_remote = transport_parts[4]
+        self.endpoint_proxy = intern(transport_parts[3])
+        self.endpoint_remote = intern(transport_parts[4])
 
         transfer_parts = parts[10].split(',')
 
@@ -335,11 +1442,11 @@ class TransferStatusEvent(object):
         # #self.transfer_id = "{0}-{1}".format(round(self.unix_ts_end, -2), transfer_num)
         self.transfer_id = "{0}:{1}".format(transfer_parts[0], transfer_parts[1])  # id:count
 
-        self.hostname_local = transfer_parts[2]
-        self.method = transfer_parts[3]  # 'GET' or 'PUT'
+        self.hostname_local = intern(transfer_parts[2])
+        self.method = intern(transfer_parts[3])  # 'GET' or 'PUT'
         self.filesize_bytes = int(transfer_parts[4])
-        self.hostname_remote = transfer_parts[5]
-        self.error_code = transfer_parts[8].split('=')[1]
+        self.hostname_remote = intern(transfer_parts[5])
+        self.error_code = intern(transfer_parts[8].split('=')[1])
 
         self.total_bytes_read = int(parts[11].split('=')[1])
         self.total_bytes_write = int(parts[12].split('=')[1])
@@ -352,18 +1459,20 @@ class TransferStatusEvent(object):
         self.payload_bytes_status = int(progress_parts[1].split('/')[0])
 
         self.unconsumed_parts = None if len(parts) < 16 else parts[15:]
-        self.elapsed_seconds = {}
 
 class TransferCompleteEvent(TransferStatusEvent):
+    __slots__ = ('unix_ts_start', 'elapsed_seconds')
+
     def __init__(self, line):
         super(TransferCompleteEvent, self).__init__(line)
         self.is_complete = True
 
         i = 0
         elapsed_seconds = 0.0
+        # the elapsed time of each of TRANSFER_STEPS, or None if the step was not reached
+        step_seconds = []
         # match up self.unconsumed_parts[0:11] with the events in the transfer_steps enum
-        for k in ['socket_create', 'socket_connect', 'proxy_init', 'proxy_choice', 'proxy_request',
-                  'proxy_response', 'command', 'response', 'first_byte', 'last_byte', 'checksum']:
+        for k in TRANSFER_STEPS:
             # parse out the elapsed time value
             keyval = self.unconsumed_parts[i]
             i += 1
@@ -371,140 +1480,664 @@ class TransferCompleteEvent(TransferStatusEvent):
             val = float(int(keyval.split('=')[1]))
             if val >= 0.0:
                 elapsed_seconds = val / 1000000.0  # usecs to secs
-                self.elapsed_seconds.setdefault(k, elapsed_seconds)
+                step_seconds.append(elapsed_seconds)
+            else:
+                step_seconds.append(None)
 
+        self.elapsed_seconds = tuple(step_seconds)
         self.unix_ts_start = self.unix_ts_end - elapsed_seconds
-        del(self.unconsumed_parts)
+        self.unconsumed_parts = None
+
+    def get_step_seconds(self, step):
+        secs = self.elapsed_seconds[TRANSFER_STEPS.index(step)]
+        if secs is None:
+            raise KeyError(step)
+        return secs
+
+    def get_data(self):
+        d = {name: getattr(self, name) for name in TransferStatusEvent.__slots__ if name != 'unconsumed_parts'}
+        d['unix_ts_start'] = self.unix_ts_start
+        d['elapsed_seconds'] = {k: secs for (k, secs) in zip(TRANSFER_STEPS, self.elapsed_seconds) if secs is not None}
+        return d
 
 class TransferSuccessEvent(TransferCompleteEvent):
+    __slots__ = ()
+
     def __init__(self, line):
         super(TransferSuccessEvent, self).__init__(line)
         self.is_success = True
 
 class TransferErrorEvent(TransferCompleteEvent):
+    __slots__ = ()
+
     def __init__(self, line):
         super(TransferErrorEvent, self).__init__(line)
         self.is_error = True
 
 class Transfer(object):
+    __slots__ = ('id', 'last_event', 'payload_progress')
+
     def __init__(self, tid):
         self.id = tid
         self.last_event = None
-        self.payload_progress = {decile:None for decile in [0.0, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0]}
+        # the time at which each of TRANSFER_PROGRESS_DECILES was reached
+        self.payload_progress = [None] * len(TRANSFER_PROGRESS_DECILES)
 
     def add_event(self, status_event):
         progress_frac = float(status_event.payload_bytes_status) / float(status_event.filesize_bytes)
-        for decile in sorted(self.payload_progress.keys()):
-            if progress_frac >= decile and self.payload_progress[decile] is None:
-                self.payload_progress[decile] = status_event.unix_ts_end
+        for i, decile in enumerate(TRANSFER_PROGRESS_DECILES):
+            if progress_frac >= decile and self.payload_progress[i] is None:
+                self.payload_progress[i] = status_event.unix_ts_end
         self.last_event = status_event
 
     def get_data(self):
         e = self.last_event
         if e is None or not e.is_complete:
             return None
-        d = e.__dict__
-        d['elapsed_seconds']['payload_progress'] = {decile: self.payload_progress[decile] - e.unix_ts_start for decile in self.payload_progress if self.payload_progress[decile] is not None}
+        d = e.get_data()
+        d['elapsed_seconds']['payload_progress'] = {decile: ts - e.unix_ts_start for (decile, ts) in zip(TRANSFER_PROGRESS_DECILES, self.payload_progress) if ts is not None}
         return d
 
+def merge_summary(dst, src):
+    # nested dicts are merged, lists are extended in order, and other values are overwritten
+    for key in src:
+        if key in dst and isinstance(dst[key], dict) and isinstance(src[key], dict):
+            merge_summary(dst[key], src[key])
+        elif key in dst and isinstance(dst[key], list) and isinstance(src[key], list):
+            dst[key].extend(src[key])
+        else:
+            dst[key] = src[key]
+
+# the sections of a node db that map ids to records, the others are summaries
+RECORD_SECTIONS = [('tgen', 'transfers'), ('tor', 'circuits'), ('tor', 'streams')]
+
+# the fields of records that hold the id of a record in another section of the same parent
+RECORD_REFERENCES = {('tor', 'streams'): ('circuit_id', 'circuits')}
+
+def merge_records(dst, src, ref_field=None, ref_ids=None):
+    '''
+    adds the records of src to dst, and returns the new ids of the records that were renamed, keyed by
+    their old ids as strings; if ref_ids holds the new ids of other records, the ref_field of a record
+    that refers to one of them is changed to its new id
+    '''
+    # tgen and tor ids start over when they restart, so a different record with a taken id gets a new one
+    new_ids = {}
+    for (record_id, record) in src.iteritems():
+        if ref_ids and record.get(ref_field) is not None and str(record[ref_field]) in ref_ids:
+            record = dict(record)
+            record[ref_field] = ref_ids[str(record[ref_field])]
+        new_id, n = record_id, 0
+        while new_id in dst and dst[new_id] != record:
+            n += 1
+            new_id = "{0}-{1}".format(record_id, n)
+        dst[new_id] = record
+        if new_id != record_id:
+            new_ids[str(record_id)] = new_id
+    return new_ids
+
+def merge_node_db(dst, src, memory_budget=None, new_ids=None):
+    '''
+    merges the db of a node from one analysis into the db of the same node from another, e.g., of
+    another day: summaries are merged with merge_summary, and records are added with merge_records,
+    which also points streams to the new ids of their circuits; if memory_budget is given, the records
+    are added to a SpilledRecords with that budget; new_ids keeps the renamed ids for later calls that
+    merge other sections of the same src
+    '''
+    if new_ids is None:
+        new_ids = {}
+    # circuits are merged before the streams that refer to them
+    for (parent_key, src_parent) in sorted(src.items()):
+        # values such as the measurement_ip are kept from dst
+        if not isinstance(src_parent, dict) or not isinstance(dst.setdefault(parent_key, {}), dict):
+            dst.setdefault(parent_key, src_parent)
+            continue
+        dst_parent = dst[parent_key]
+        for (section_key, src_section) in sorted(src_parent.items()):
+            is_records = (parent_key, section_key) in RECORD_SECTIONS
+            (ref_field, ref_section_key) = RECORD_REFERENCES.get((parent_key, section_key), (None, None))
+            ref_ids = new_ids.get((parent_key, ref_section_key))
+            if section_key not in dst_parent and not (is_records and (memory_budget is not None or ref_ids)):
+                dst_parent[section_key] = src_section
+            elif is_records:
+                # records that are looked up lazily are read one at a time to add to them
+                dst_parent[section_key] = make_records(memory_budget, dst_parent.get(section_key))
+                new_ids[(parent_key, section_key)] = merge_records(dst_parent[section_key], src_section, ref_field, ref_ids)
+            else:
+                merge_summary(dst_parent[section_key], src_section)
+
+# the number of records that are added between checks of the memory budget
+SPILL_CHECK_INTERVAL = 1000
+
+class SpilledRecords(MutableMapping):
+    '''
+    maps ids to the records of completed transfers, circuits, or streams like a dict, but once the
+    resident size of the process exceeds memory_budget MiB, the records held in memory are pickled
+    to a temporary file in spill_dir and are only unpickled again when they are looked up
+    '''
+    def __init__(self, memory_budget, spill_dir=None):
+        self.memory_budget = memory_budget
+        self.spill_dir = spill_dir
+        # every id maps to the (offset, length) of its pickled record, or to None while it is in memory
+        self.offsets = {}
+        self.records = {}
+        self.spill_file = None
+        self.num_added = 0
+
+    def __getitem__(self, key):
+        offset = self.offsets[key]
+        if offset is None:
+            return self.records[key]
+        self.spill_file.seek(offset[0])
+        return cPickle.loads(self.spill_file.read(offset[1]))
+
+    def __setitem__(self, key, record):
+        self.offsets[key] = None
+        self.records[key] = record
+        self.num_added += 1
+        if self.num_added % SPILL_CHECK_INTERVAL == 0 and util.get_rss() > self.memory_budget * 1024 * 1024:
+            self.spill()
+
+    def __delitem__(self, key):
+        del self.offsets[key]
+        self.records.pop(key, None)
+
+    def __iter__(self):
+        # ids are kept in a single dict, so they come out in the order of a dict holding the records
+        return iter(self.offsets)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __contains__(self, key):
+        return key in self.offsets
+
+    def __reduce__(self):
+        # pickles, e.g., checkpoints and cached results, write the items one at a time, so that spilled
+        # records are not all read back at once, and they are added again with the same budget when loaded
+        return (SpilledRecords, (self.memory_budget,), None, None, self.iteritems())
+
+    def spill(self):
+        ''' moves the records held in memory to the spill file '''
+        if len(self.records) == 0:
+            return
+        if self.spill_file is None:
+            self.spill_file = tempfile.TemporaryFile(prefix="onionperf.spill.", dir=self.spill_dir)
+        logging.info("memory budget of {0} MiB exceeded, spilling {1} records to disk".format(self.memory_budget, len(self.records)))
+        self.spill_file.seek(0, os.SEEK_END)
+        offset = self.spill_file.tell()
+        for (key, record) in self.records.iteritems():
+            data = cPickle.dumps(record, cPickle.HIGHEST_PROTOCOL)
+            self.spill_file.write(data)
+            self.offsets[key] = (offset, len(data))
+            offset += len(data)
+        self.records = {}
+
+def make_records(memory_budget, records=None):
+    '''
+    returns a SpilledRecords with memory_budget, or a dict if it is None, that holds the items of records;
+    records that are of that kind already are returned as they are, with the budget changed
+    '''
+    if memory_budget is None:
+        if isinstance(records, dict):
+            return records
+        return dict(records.iteritems()) if records is not None else {}
+    if isinstance(records, SpilledRecords):
+        records.memory_budget = memory_budget
+        return records
+    spilled = SpilledRecords(memory_budget)
+    if records is not None:
+        spilled.update(records.iteritems())
+    return spilled
+
+class RecordDataView(Mapping):
+    '''
+    a read-only mapping from the ids of the records in a SpilledRecords to their data, which is
+    built when it is looked up, so that writing the results never holds all of it in memory
+    '''
+    def __init__(self, records):
+        self.records = records
+
+    def __getitem__(self, key):
+        return self.records[key].get_data()
+
+    def __iter__(self):
+        # ids come out in the order of a dict that is built from the records, as get_record_data
+        # builds without a budget, so that the results are written in the same order either way
+        return iter(dict.fromkeys(iter(self.records)))
+
+    def __len__(self):
+        return len(self.records)
+
+    def __contains__(self, key):
+        return key in self.records
+
+    def __reduce__(self):
+        return (dict, (list(self.iteritems()),))
+
+def get_record_data(records):
+    ''' returns the data of records, which is looked up lazily if the records were spilled to disk '''
+    if isinstance(records, SpilledRecords):
+        return RecordDataView(records)
+    return {record_id: records[record_id].get_data() for record_id in records}
+
+def json_encode_mapping(obj):
+    # the default hook of json.dumps, which otherwise only encodes dicts
+    if isinstance(obj, Mapping):
+        return dict(obj.iteritems())
+    raise TypeError("{0} is not JSON serializable".format(repr(obj)))
+
+class ParseChunk(object):
+    '''
+    holds the results of parsing one byte range of a log file with a fresh parser.
+
+    a line about a transfer, circuit, or stream that may have been opened before the chunk
+    started is not parsed in the chunk; instead, the results parsed so far are cut into a
+    segment that ends with that line, so that the parser merging the chunks in order can
+    replay the line against the state it carried forward from the previous chunks.
+    '''
+    def __init__(self):
+        self.segments = []
+        self.segment = self.__new_segment()
+        # ids whose lines are all replayed by the merging parser
+        self.orphan_ids = set()
+        # ids whose complete history since the chunk started is known locally
+        self.local_ids = set()
+        # ids first opened in this chunk, which must not already be open in the merging parser
+        self.started_ids = set()
+        self.build_timeout_known = False
+        self.open_state = None
+
+    def __new_segment(self):
+        return {'data': None, 'line': None, 'header_lines': [], 'pops': [], 'build_timeout': None}
+
+    def is_deferred(self, key, is_start):
+        if key in self.orphan_ids:
+            return True
+        elif key in self.local_ids:
+            return False
+        elif is_start:
+            self.local_ids.add(key)
+            self.started_ids.add(key)
+            return False
+        else:
+            self.orphan_ids.add(key)
+            return True
+
+    def reset(self, key):
+        # everything before this line is dropped, so later lines for key can be parsed locally
+        if key not in self.local_ids:
+            self.segment['pops'].append(key)
+        self.orphan_ids.discard(key)
+        self.local_ids.add(key)
+
+    def cut(self, data, line):
+        self.segment['data'] = data
+        self.segment['line'] = line
+        self.segments.append(self.segment)
+        self.segment = self.__new_segment()
+
+def subproc_parse_chunk_func(chunk_args):
+    signal(SIGINT, SIG_IGN)  # ignore interrupts
+    parser, filepath, start, end, do_simple = chunk_args
+    parser.chunk = ParseChunk()
+    parser.parse(util.DataSource(filepath, start_offset=start, end_offset=end), do_simple=do_simple)
+    return parser.finish_chunk()
+
+def parse_file_chunk(parser, filepath, do_simple, mode, num_threads, parse_cache):
+    # a whole file is parsed as a chunk, so that it can be merged after the files before it
+    logging.info("parsing log file at {0}".format(filepath))
+    parser.chunk = ParseChunk()
+    if mode == 'date_seek':
+        parser.parse_date_seek(filepath, do_simple=do_simple)
+    else:
+        parser.parse(util.DataSource(filepath, num_threads=num_threads), do_simple=do_simple)
+    chunk = parser.finish_chunk()
+    # the chunk is cached before it is merged, because merging may change its contents
+    if parse_cache is not None:
+        parse_cache.put(filepath, parser, do_simple, chunk)
+    return chunk
+
+def subproc_parse_job_func(job_args):
+    signal(SIGINT, SIG_IGN)  # ignore interrupts
+    parser, filepath, do_simple, mode, num_threads, parse_cache, spill_dir, job_index = job_args
+    start = time.time()
+    # only the path of the parsed chunk goes back through the pool, the parent reads it when it merges it
+    if parse_cache is not None:
+        entry_path = parse_cache.find(filepath, parser, do_simple)
+        if entry_path is None:
+            chunk = parse_file_chunk(parser, filepath, do_simple, mode, num_threads, None)
+            entry_path = parse_cache.put(filepath, parser, do_simple, chunk)
+        return job_index, entry_path, True, time.time() - start
+    chunk = parse_file_chunk(parser, filepath, do_simple, mode, num_threads, None)
+    fd, spill_filepath = tempfile.mkstemp(suffix=".spill", dir=spill_dir)
+    with os.fdopen(fd, 'wb') as f:
+        cPickle.dump(chunk, f, cPickle.HIGHEST_PROTOCOL)
+    return job_index, spill_filepath, False, time.time() - start
+
+def load_chunk_file(chunk_path, is_cached, parse_cache):
+    # spill files are removed once they are read, cache entries are kept
+    if is_cached:
+        return parse_cache.load(chunk_path)
+    with open(chunk_path, 'rb') as f:
+        chunk = cPickle.load(f)
+    os.remove(chunk_path)
+    return chunk
+
+# a worker that is killed, e.g., by the out-of-memory killer, is replaced by the pool without ever
+# returning the result of its job, so we stop waiting for a result after this many seconds
+WORKER_RESULT_TIMEOUT = 6 * 3600
+
+def wait_for_result(get, on_wait=None):
+    '''
+    returns get(timeout), for the get method of a pool's AsyncResult or the next method of its imap
+    iterators; we wait a second at a time, which keeps the wait interruptible, and call on_wait with
+    the number of seconds waited so far after each, and raise TimeoutError after WORKER_RESULT_TIMEOUT
+    '''
+    waited = 0
+    while True:
+        try:
+            return get(1)
+        except TimeoutError:
+            waited += 1
+            if waited >= WORKER_RESULT_TIMEOUT:
+                raise TimeoutError("no result from a worker process in {0} seconds".format(waited))
+            if on_wait is not None:
+                on_wait(waited)
+
+# incremented when the contents of parser checkpoints change
+CHECKPOINT_VERSION = 3
+
+# when seeking to the filter date, the number of bytes at the start of a file that are still parsed
+DATE_SEEK_HEAD_BYTES = 1024 * 1024
+
 class Parser(object):
     __metaclass__ = ABCMeta
+    # the attributes that map ids to records, which are spilled to disk if the parser has a memory_budget
+    RECORD_ATTRIBUTES = []
     @abstractmethod
     def parse(self, source, do_simple):
         pass
     @abstractmethod
+    def parse_line(self, line, do_simple):
+        pass
+    @abstractmethod
     def get_data(self):
         pass
     @abstractmethod
     def get_name(self):
         pass
+    @abstractmethod
+    def new_chunk_parser(self):
+        pass
+    @abstractmethod
+    def finish_chunk(self):
+        pass
+    @abstractmethod
+    def merge_chunk(self, chunk, do_simple):
+        pass
+
+    def parse_resumable(self, filepath, do_simple=True):
+        '''
+        parse the uncompressed log file at filepath, starting from the checkpoint saved by a
+        previous call for the same file and settings if there is one, and then save a new
+        checkpoint at the end of the last complete line so that the next call only parses
+        the lines that were appended in the meantime
+        '''
+        checkpoint_path = util.get_checkpoint_path(filepath)
+        offset = self.__load_checkpoint(checkpoint_path, filepath, do_simple)
+        end_offset = util.find_last_line_end(filepath)
+
+        if end_offset > offset:
+            logging.info("parsing bytes {0} to {1} of {2}".format(offset, end_offset, filepath))
+            source = util.DataSource(filepath, start_offset=offset, end_offset=end_offset)
+            self.parse(source, do_simple=do_simple)
+            offset = source.get_offset()
+
+        self.__save_checkpoint(checkpoint_path, filepath, do_simple, offset)
+
+    def get_settings(self, do_simple):
+        ''' returns the settings that the results of this parser depend on '''
+        return (self.__class__.__name__, do_simple, self.date_filter)
+
+    def __get_checkpoint_settings(self, do_simple):
+        # a checkpoint is only valid for a parser that would have produced the same results
+        return self.get_settings(do_simple)
+
+    def __load_checkpoint(self, checkpoint_path, filepath, do_simple):
+        if not os.path.exists(checkpoint_path):
+            return 0
+
+        try:
+            with open(checkpoint_path, 'rb') as f:
+                checkpoint = cPickle.load(f)
+        except Exception as e:
+            logging.warning("ignoring unreadable checkpoint at {0}: {1}".format(checkpoint_path, repr(e)))
+            return 0
+
+        st = os.stat(filepath)
+        if checkpoint['version'] != CHECKPOINT_VERSION or checkpoint['settings'] != self.__get_checkpoint_settings(do_simple):
+            logging.info("ignoring checkpoint at {0} because it was made with other settings".format(checkpoint_path))
+            return 0
+        elif checkpoint['inode'] != (st.st_dev, st.st_ino) or checkpoint['offset'] > st.st_size:
+            # the log was rotated or truncated since the checkpoint was saved
+            logging.info("ignoring checkpoint at {0} because {1} was replaced".format(checkpoint_path, filepath))
+            return 0
+
+        logging.info("resuming from checkpoint at {0}".format(checkpoint_path))
+        # the budget does not change the results, so ours is kept, and applies to the records we resume with
+        memory_budget = self.memory_budget
+        self.__dict__.update(checkpoint['parser'])
+        self.memory_budget = memory_budget
+        for name in self.RECORD_ATTRIBUTES:
+            setattr(self, name, make_records(memory_budget, getattr(self, name)))
+        return checkpoint['offset']
+
+    def __save_checkpoint(self, checkpoint_path, filepath, do_simple, offset):
+        st = os.stat(filepath)
+        checkpoint = {'version': CHECKPOINT_VERSION, 'settings': self.__get_checkpoint_settings(do_simple),
+                      'inode': (st.st_dev, st.st_ino), 'offset': offset, 'parser': self.__dict__}
+
+        # write to a temporary file first, so a crash never leaves a half-written checkpoint
+        tmp_path = "{0}.tmp".format(checkpoint_path)
+        with open(tmp_path, 'wb') as f:
+            cPickle.dump(checkpoint, f, cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, checkpoint_path)
+        logging.info("saved checkpoint at byte {0} of {1} to {2}".format(offset, filepath, checkpoint_path))
+
+    def parse_date_seek(self, filepath, do_simple=True):
+        '''
+        parse only the part of the uncompressed, time-ordered log file at filepath that covers
+        our date_filter day, which we find by binary search over byte offsets
+        '''
+        start_ts, end_ts = util.date_to_timestamp_range(self.date_filter)
+        offset = util.find_timestamp_offset(filepath, start_ts)
+        # the node name is logged when the process starts, which is likely before our day
+        head_offset = min(offset, DATE_SEEK_HEAD_BYTES)
+        if head_offset > 0:
+            self.parse(util.DataSource(filepath, end_offset=head_offset), do_simple=do_simple)
+        logging.info("skipping to byte {0} of {1} to parse lines from {2}".format(offset, filepath, util.date_to_string(self.date_filter)))
+        self.parse(util.DataSource(filepath, start_offset=offset), do_simple=do_simple)
+
+    def parse_chunked(self, filepath, do_simple=True, num_chunks=cpu_count()):
+        '''
+        parse the uncompressed log file at filepath by splitting it at line boundaries into
+        num_chunks byte ranges, parsing the ranges in a process pool, and merging the results
+        into this parser in file order; the result is the same as that of a serial parse
+        '''
+        ranges = util.find_line_chunks(filepath, num_chunks)
+        chunk_jobs = [(self.new_chunk_parser(), filepath, start, end, do_simple) for (start, end) in ranges]
+
+        pool = Pool(len(chunk_jobs))
+        try:
+            chunks = pool.imap(subproc_parse_chunk_func, chunk_jobs)
+            pool.close()
+            for i in xrange(len(chunk_jobs)):
+                chunk = wait_for_result(chunks.next)
+                if not self.merge_chunk(chunk, do_simple):
+                    # the chunk reused an id that was still open, so its local results are wrong
+                    start, end = ranges[i]
+                    logging.info("re-parsing bytes {0} to {1} of {2} serially".format(start, end, filepath))
+                    self.parse(util.DataSource(filepath, start_offset=start, end_offset=end), do_simple=do_simple)
+        except KeyboardInterrupt:
+            logging.info("interrupted, terminating process pool")
+            sys.exit()
+        finally:
+            # the workers are also stopped if a chunk failed
+            pool.terminate()
+            pool.join()
+
+# index of the token holding the event keyword in a whitespace-split tgen log line
+TGEN_KEYWORD_INDEX = 6
 
 class TGenParser(Parser):
+    RECORD_ATTRIBUTES = ['transfers']
 
-    def __init__(self, date_filter=None):
-        ''' date_filter should be given in UTC '''
+    def __init__(self, date_filter=None, memory_budget=None):
+        '''
+        date_filter should be given in UTC
+        if memory_budget is given, completed transfers are spilled to disk once the process uses more than memory_budget MiB
+        '''
         self.state = {}
-        self.transfers = {}
+        self.memory_budget = memory_budget
+        self.transfers = make_records(memory_budget)
         self.transfers_summary = {'time_to_first_byte':{}, 'time_to_last_byte':{}, 'errors':{}}
         self.name = None
         self.date_filter = date_filter
+        self.date_start_ts, self.date_end_ts = util.date_to_timestamp_range(date_filter) if date_filter is not None else (None, None)
+        self.chunk = None
 
-    def __is_date_valid(self, date_to_check):
+    def __is_date_valid(self, unix_ts):
         if self.date_filter is None:
             # we are not asked to filter, so every date is valid
             return True
         else:
-            # we are asked to filter, so the line is only valid if the date matches the filter
-            # both the filter and the unix timestamp should be in UTC at this point
-            return util.do_dates_match(self.date_filter, date_to_check)
-
-    def __parse_line(self, line, do_simple):
-        if self.name is None and re.search("Initializing traffic generator on host", line) is not None:
+            # we are asked to filter, so the line is only valid if it falls within the filter day
+            # both the filter bounds and the unix timestamp are in UTC at this point
+            return self.date_start_ts <= unix_ts < self.date_end_ts
+
+    def __is_past_date(self, unix_ts):
+        # log lines are time-ordered, so nothing after a line past the filter day can match it
+        return self.date_filter is not None and unix_ts >= self.date_end_ts
+
+    def __get_handlers(self, do_simple):
+        # map the event keyword found at TGEN_KEYWORD_INDEX to the function that handles the line
+        handlers = {'[transfer-complete]': self.__handle_complete, '[transfer-error]': self.__handle_error}
+        if not do_simple:
+            handlers['[transfer-status]'] = self.__handle_status
+            handlers['transfer'] = self.__handle_state_change
+        return handlers
+
+    def __handle_name(self, line):
+        if self.name is None and "Initializing traffic generator on host" in line:
             self.name = line.strip().split()[11]
 
-        if self.date_filter is not None:
-            parts = line.split(' ', 3)
-            if len(parts) < 4: # the 3rd is the timestamp, the 4th is the rest of the line
-                return True
-            unix_ts = float(parts[2])
-            line_date = datetime.datetime.utcfromtimestamp(unix_ts).date()
-            if not self.__is_date_valid(line_date):
-                return True
-
-        if not do_simple and re.search("state\sRESPONSE\sto\sstate\sPAYLOAD", line) is not None:
-            # another run of tgen starts the id over counting up from 1
-            # if a prev transfer with the same id did not complete, we can be sure it never will
-            parts = line.strip().split()
-            transfer_parts = parts[7].strip().split(',')
-            transfer_id = "{0}:{1}".format(transfer_parts[0], transfer_parts[1])  # id:count
-            if transfer_id in self.state:
-                self.state.pop(transfer_id)
-
-        elif not do_simple and re.search("transfer-status", line) is not None:
-            status = TransferStatusEvent(line)
-            xfer = self.state.setdefault(status.transfer_id, Transfer(status.transfer_id))
-            xfer.add_event(status)
-
-        elif re.search("transfer-complete", line) is not None:
-            complete = TransferSuccessEvent(line)
-
-            if not do_simple:
-                xfer = self.state.setdefault(complete.transfer_id, Transfer(complete.transfer_id))
-                xfer.add_event(complete)
-                self.transfers[xfer.id] = xfer.get_data()
-                self.state.pop(complete.transfer_id)
+    def __handle_state_change(self, line, do_simple):
+        if "state RESPONSE to state PAYLOAD" not in line:
+            return
+        # another run of tgen starts the id over counting up from 1
+        # if a prev transfer with the same id did not complete, we can be sure it never will
+        parts = line.strip().split()
+        transfer_parts = parts[7].strip().split(',')
+        transfer_id = "{0}:{1}".format(transfer_parts[0], transfer_parts[1])  # id:count
+        if transfer_id in self.state:
+            self.state.pop(transfer_id)
+
+    def __handle_status(self, line, do_simple):
+        status = TransferStatusEvent(line)
+        xfer = self.state.setdefault(status.transfer_id, Transfer(status.transfer_id))
+        xfer.add_event(status)
+
+    def __handle_complete(self, line, do_simple):
+        complete = TransferSuccessEvent(line)
+
+        if not do_simple:
+            xfer = self.state.setdefault(complete.transfer_id, Transfer(complete.transfer_id))
+            xfer.add_event(complete)
+            self.transfers[xfer.id] = xfer
+            self.state.pop(complete.transfer_id)
+
+        filesize, second = complete.filesize_bytes, int(complete.unix_ts_end)
+        fb_secs = complete.get_step_seconds('first_byte') - complete.get_step_seconds('command')
+        lb_secs = complete.get_step_seconds('last_byte') - complete.get_step_seconds('command')
+
+        fb_list = self.transfers_summary['time_to_first_byte'].setdefault(filesize, {}).setdefault(second, [])
+        fb_list.append(fb_secs)
+        lb_list = self.transfers_summary['time_to_last_byte'].setdefault(filesize, {}).setdefault(second, [])
+        lb_list.append(lb_secs)
+
+    def __handle_error(self, line, do_simple):
+        error = TransferErrorEvent(line)
+
+        if not do_simple:
+            xfer = self.state.setdefault(error.transfer_id, Transfer(error.transfer_id))
+            xfer.add_event(error)
+            self.transfers[xfer.id] = xfer
+            self.state.pop(error.transfer_id)
+
+        err_code, filesize, second = error.error_code, error.filesize_bytes, int(error.unix_ts_end)
+
+        err_list = self.transfers_summary['errors'].setdefault(err_code, {}).setdefault(second, [])
+        err_list.append(filesize)
+
+    def __parse_line(self, line, handlers, do_simple):
+        # tgen writes 'date time timestamp [level] [file:line] [function] message', so the
+        # keyword that tells us the event type is always the first token of the message
+        parts = line.split(None, TGEN_KEYWORD_INDEX + 1)
+        if len(parts) <= TGEN_KEYWORD_INDEX:
+            return True
 
-            filesize, second = complete.filesize_bytes, int(complete.unix_ts_end)
-            fb_secs = complete.elapsed_seconds['first_byte'] - complete.elapsed_seconds['command']
-            lb_secs = complete.elapsed_seconds['last_byte'] - complete.elapsed_seconds['command']
+        keyword = parts[TGEN_KEYWORD_INDEX]
+        if keyword == 'Initializing':
+            if self.chunk is not None:
+                self.chunk.segment['header_lines'].append(line)
+            self.__handle_name(line)
+            return True
 
-            fb_list = self.transfers_summary['time_to_first_byte'].setdefault(filesize, {}).setdefault(second, [])
-            fb_list.append(fb_secs)
-            lb_list = self.transfers_summary['time_to_last_byte'].setdefault(filesize, {}).setdefault(second, [])
-            lb_list.append(lb_secs)
+        handler = handlers.get(keyword)
+        if handler is None:
+            # most lines are heartbeats and state changes we do not care about
+            return True
 
-        elif re.search("transfer-error", line) is not None:
-            error = TransferErrorEvent(line)
+        if self.date_filter is not None:
+            unix_ts = float(parts[2])
+            if self.__is_past_date(unix_ts):
+                return False
+            if not self.__is_date_valid(unix_ts):
+                return True
 
-            if not do_simple:
-                xfer = self.state.setdefault(error.transfer_id, Transfer(error.transfer_id))
-                xfer.add_event(error)
-                self.transfers[xfer.id] = xfer.get_data()
-                self.state.pop(error.transfer_id)
+        if self.chunk is not None and self.__is_chunk_deferred(keyword, line, do_simple):
+            self.chunk.cut(self.__take_results(), line)
+            return True
 
-            err_code, filesize, second = error.error_code, error.filesize_bytes, int(error.unix_ts_end)
+        handler(line, do_simple)
+        return True
 
-            err_list = self.transfers_summary['errors'].setdefault(err_code, {}).setdefault(second, [])
-            err_list.append(filesize)
+    def __is_chunk_deferred(self, keyword, line, do_simple):
+        if do_simple:
+            # simple mode keeps no transfer state, so every line can be parsed locally
+            return False
+        elif keyword == 'transfer':
+            if "state RESPONSE to state PAYLOAD" in line:
+                transfer_parts = line.split()[7].split(',')
+                self.chunk.reset(('transfer', "{0}:{1}".format(transfer_parts[0], transfer_parts[1])))
+            return False
+        else:
+            transfer_parts = line.split()[10].split(',')
+            return self.chunk.is_deferred(('transfer', "{0}:{1}".format(transfer_parts[0], transfer_parts[1])), False)
 
-        return True
+    def __take_results(self):
+        data = {'transfers': self.transfers, 'transfers_summary': self.transfers_summary}
+        self.transfers = make_records(self.memory_budget)
+        self.transfers_summary = {'time_to_first_byte':{}, 'time_to_last_byte':{}, 'errors':{}}
+        return data
 
     def parse(self, source, do_simple=True):
+        handlers = self.__get_handlers(do_simple)
         source.open()
         for line in source:
             # ignore line parsing errors
             try:
-                if not self.__parse_line(line, do_simple):
+                if not self.__parse_line(line, handlers, do_simple):
                     break
             except:
                 logging.warning("TGenParser: skipping line due to parsing error: {0}".format(line))
@@ -512,13 +2145,45 @@ class TGenParser(Parser):
                 continue
         source.close()
 
+    def parse_line(self, line, do_simple=True):
+        ''' parse a single line, returns False once lines are past the date_filter day '''
+        return self.__parse_line(line, self.__get_handlers(do_simple), do_simple)
+
+    def new_chunk_parser(self):
+        return TGenParser(date_filter=self.date_filter, memory_budget=self.memory_budget)
+
+    def finish_chunk(self):
+        chunk = self.chunk
+        chunk.cut(self.__take_results(), None)
+        chunk.open_state = self.state
+        self.chunk, self.state = None, {}
+        return chunk
+
+    def merge_chunk(self, chunk, do_simple):
+        handlers = self.__get_handlers(do_simple)
+        for segment in chunk.segments:
+            for line in segment['header_lines']:
+                self.__handle_name(line)
+            for (kind, transfer_id) in segment['pops']:
+                self.state.pop(transfer_id, None)
+            self.transfers.update(segment['data']['transfers'])
+            merge_summary(self.transfers_summary, segment['data']['transfers_summary'])
+            if segment['line'] is not None:
+                self.__parse_line(segment['line'], handlers, do_simple)
+        self.state.update(chunk.open_state)
+        return True
+
     def get_data(self):
-        return {'transfers':self.transfers, 'transfers_summary': self.transfers_summary}
+        # transfers are kept as compact records until their data is needed
+        return {'transfers': get_record_data(self.transfers), 'transfers_summary': self.transfers_summary}
 
     def get_name(self):
         return self.name
 
 class Stream(object):
+    __slots__ = ('stream_id', 'circuit_id', 'unix_ts_start', 'unix_ts_end', 'failure_reason_local',
+                 'failure_reason_remote', 'source', 'target', 'elapsed_seconds', 'last_purpose')
+
     def __init__(self, sid):
         self.stream_id = sid
         self.circuit_id = None
@@ -534,8 +2199,9 @@ class Stream(object):
     def add_event(self, purpose, status, arrived_at):
         if purpose is not None:
             self.last_purpose = purpose
-        key = "{0}:{1}".format(self.last_purpose, status)
-        self.elapsed_seconds.append([key, arrived_at])
+        # the few distinct keys are shared by all streams
+        key = intern("{0}:{1}".format(self.last_purpose, status))
+        self.elapsed_seconds.append((key, arrived_at))
 
     def set_circ_id(self, circ_id):
         if circ_id is not None:
@@ -563,14 +2229,13 @@ class Stream(object):
     def get_data(self):
         if self.unix_ts_start is None or self.unix_ts_end is None:
             return None
-        d = self.__dict__
-        for item in d['elapsed_seconds']:
-            item[1] = item[1] - self.unix_ts_start
-        del(d['last_purpose'])
-        if d['failure_reason_local'] is None: del(d['failure_reason_local'])
-        if d['failure_reason_remote'] is None: del(d['failure_reason_remote'])
-        if d['source'] is None: del(d['source'])
-        if d['target'] is None: del(d['target'])
+        d = {'stream_id': self.stream_id, 'circuit_id': self.circuit_id,
+             'unix_ts_start': self.unix_ts_start, 'unix_ts_end': self.unix_ts_end,
+             'elapsed_seconds': [[key, ts - self.unix_ts_start] for (key, ts) in self.elapsed_seconds]}
+        if self.failure_reason_local is not None: d['failure_reason_local'] = self.failure_reason_local
+        if self.failure_reason_remote is not None: d['failure_reason_remote'] = self.failure_reason_remote
+        if self.source is not None: d['source'] = self.source
+        if self.target is not None: d['target'] = self.target
         return d
 
     def __str__(self):
@@ -579,6 +2244,9 @@ class Stream(object):
                for (event, arrived_at) in sorted(self.elapsed_seconds, key=lambda item: item[1])])))
 
 class Circuit(object):
+    __slots__ = ('circuit_id', 'unix_ts_start', 'unix_ts_end', 'failure_reason_local', 'failure_reason_remote',
+                 'buildtime_seconds', 'build_timeout', 'build_quantile', 'elapsed_seconds', 'path')
+
     def __init__(self, cid):
         self.circuit_id = cid
         self.unix_ts_start = None
@@ -592,10 +2260,11 @@ class Circuit(object):
         self.path = []
 
     def add_event(self, event, arrived_at):
-        self.elapsed_seconds.append([str(event), arrived_at])
+        self.elapsed_seconds.append((intern(str(event)), arrived_at))
 
     def add_hop(self, hop, arrived_at):
-        self.path.append(["${0}~{1}".format(hop[0], hop[1]), arrived_at])
+        # relays appear on many circuits, so share their names
+        self.path.append((intern("${0}~{1}".format(hop[0], hop[1])), arrived_at))
 
     def set_launched(self, unix_ts, build_timeout, build_quantile):
         if self.unix_ts_start is None:
@@ -619,20 +2288,14 @@ class Circuit(object):
     def get_data(self):
         if self.unix_ts_start is None or self.unix_ts_end is None:
             return None
-        d = self.__dict__
-        for item in d['elapsed_seconds']:
-            item[1] = item[1] - self.unix_ts_start
-        for item in d['path']:
-            item[1] = item[1] - self.unix_ts_start
-        if d['buildtime_seconds'] is None:
-            del(d['buildtime_seconds'])
-        else:
-            d['buildtime_seconds'] = self.buildtime_seconds - self.unix_ts_start
-        if len(d['path']) == 0: del(d['path'])
-        if d['failure_reason_local'] is None: del(d['failure_reason_local'])
-        if d['failure_reason_remote'] is None: del(d['failure_reason_remote'])
-        if d['build_timeout'] is None: del(d['build_timeout'])
-        if d['build_quantile'] is None: del(d['build_quantile'])
+        d = {'circuit_id': self.circuit_id, 'unix_ts_start': self.unix_ts_start, 'unix_ts_end': self.unix_ts_end,
+             'elapsed_seconds': [[key, ts - self.unix_ts_start] for (key, ts) in self.elapsed_seconds]}
+        if self.buildtime_seconds is not None: d['buildtime_seconds'] = self.buildtime_seconds - self.unix_ts_start
+        if len(self.path) > 0: d['path'] = [[hop, ts - self.unix_ts_start] for (hop, ts) in self.path]
+        if self.failure_reason_local is not None: d['failure_reason_local'] = self.failure_reason_local
+        if self.failure_reason_remote is not None: d['failure_reason_remote'] = self.failure_reason_remote
+        if self.build_timeout is not None: d['build_timeout'] = self.build_timeout
+        if self.build_quantile is not None: d['build_quantile'] = self.build_quantile
         return d
 
     def __str__(self):
@@ -640,23 +2303,162 @@ class Circuit(object):
                (event, arrived_at) for (event, arrived_at) in
                sorted(self.elapsed_seconds, key=lambda item: item[1])])))
 
-class TorCtlParser(Parser):
+# the event types that TorCtlParser has handlers for
+TORCTL_HANDLED_EVENTS = frozenset(['CIRC', 'CIRC_MINOR', 'STREAM', 'BW', 'BUILDTIMEOUT_SET'])
+
+# (positional field names, (keyword, field name) pairs) that our handlers use for each event type
+TORCTL_EVENT_FIELDS = {
+    'CIRC': (('id', 'status', 'path'),
+             (('PURPOSE', 'purpose'), ('HS_STATE', 'hs_state'), ('REND_QUERY', 'rend_query'),
+              ('REASON', 'reason'), ('REMOTE_REASON', 'remote_reason'))),
+    'CIRC_MINOR': (('id', 'event', 'path'),
+                   (('PURPOSE', 'purpose'), ('HS_STATE', 'hs_state'), ('REND_QUERY', 'rend_query'),
+                    ('OLD_PURPOSE', 'old_purpose'))),
+    'STREAM': (('id', 'status', 'circ_id', 'target'),
+               (('PURPOSE', 'purpose'), ('REASON', 'reason'), ('REMOTE_REASON', 'remote_reason'),
+                ('SOURCE_ADDR', 'source_addr'))),
+    'BUILDTIMEOUT_SET': (('set_type',),
+                         (('TIMEOUT_MS', 'timeout'), ('CUTOFF_QUANTILE', 'quantile'))),
+}
+
+class TorCtlEvent(object):
+    '''
+    a minimal stand-in for the stem event objects, holding only the fields that our
+    TorCtlParser handlers read; fields not present in the raw event are set to None
+    '''
+    def __init__(self, event_type, positional_names, positional_args, keyword_names, keyword_args):
+        self.type = event_type
+        for i, name in enumerate(positional_names):
+            setattr(self, name, positional_args[i] if i < len(positional_args) else None)
+        for (keyword, name) in keyword_names:
+            setattr(self, name, keyword_args.get(keyword))
+
+def decode_circ_path(path):
+    # the same (fingerprint, nickname) tuples that stem builds, or None if stem should decide
+    if path is None:
+        return ()
+    hops = []
+    for entry in path.split(','):
+        if '=' in entry:
+            fingerprint, sep, nickname = entry.partition('=')
+        elif '~' in entry:
+            fingerprint, sep, nickname = entry.partition('~')
+        elif entry.startswith('$'):
+            fingerprint, nickname = entry, None
+        else:
+            fingerprint, nickname = None, entry
+        if fingerprint is not None:
+            if len(fingerprint) != 41 or not fingerprint.startswith('$'):
+                return None
+            fingerprint = fingerprint[1:]
+        if nickname is not None and (len(nickname) < 1 or len(nickname) > 19 or not nickname.isalnum()):
+            return None
+        hops.append((fingerprint, nickname))
+    return tuple(hops)
+
+def decode_torctl_event(raw_event_str):
+    '''
+    returns a TorCtlEvent for the CIRC, CIRC_MINOR, STREAM, and BUILDTIMEOUT_SET events in
+    raw_event_str (the part of the line after '650 '), or None if the event is of another type
+    or is in a form that should be left to stem to decode
+    '''
+    # quoted values may contain spaces, let stem handle those
+    if '"' in raw_event_str:
+        return None
+
+    tokens = raw_event_str.split()
+    if len(tokens) == 0 or tokens[0] not in TORCTL_EVENT_FIELDS:
+        return None
+    event_type = tokens[0]
+
+    # like stem, consume 'KEY=value' pairs from the end; whatever remains is positional
+    keyword_args = {}
+    end = len(tokens)
+    while end > 1:
+        keyword, sep, value = tokens[end - 1].partition('=')
+        if sep == '' or not keyword.replace('_', 'a').isalnum():
+            break
+        keyword_args[keyword] = value
+        end -= 1
+
+    positional_names, keyword_names = TORCTL_EVENT_FIELDS[event_type]
+    event = TorCtlEvent(event_type, positional_names, tokens[1:end], keyword_names, keyword_args)
+
+    if event_type in ('CIRC', 'CIRC_MINOR'):
+        event.path = decode_circ_path(event.path)
+        if event.path is None or event.id is None:
+            return None
+    elif event_type == 'STREAM':
+        if event.target is None:
+            return None
+        # an unattached stream has a circuit id of 0
+        if event.circ_id == '0':
+            event.circ_id = None
+    elif event_type == 'BUILDTIMEOUT_SET':
+        try:
+            if event.timeout is not None:
+                event.timeout = int(event.timeout)
+            if event.quantile is not None:
+                event.quantile = float(event.quantile)
+        except ValueError:
+            return None
 
-    def __init__(self, date_filter=None):
-        ''' date_filter should be given in UTC '''
+    return event
+
+def decode_bw_line(line):
+    '''
+    returns a (unix_ts, bytes_read, bytes_written) tuple for a well-formed '650 BW' torctl
+    log line, or None if the line is not a BW event or should be left to stem to decode
+    '''
+    # torctl lines look like 'date time timestamp 650 BW read written\r\n'
+    parts = line.split()
+    if len(parts) != 7 or parts[3] != '650' or parts[4] != 'BW':
+        return None
+    if not parts[5].isdigit() or not parts[6].isdigit():
+        return None
+    # stem only accepts events that are separated by single spaces and end with CRLF
+    if not line.endswith(" 650 BW {0} {1}\r\n".format(parts[5], parts[6])):
+        return None
+    try:
+        unix_ts = float(parts[2])
+    except ValueError:
+        return None
+    return unix_ts, int(parts[5]), int(parts[6])
+
+class TorCtlParser(Parser):
+    RECORD_ATTRIBUTES = ['circuits', 'streams']
+
+    def __init__(self, date_filter=None, fast_decode=False, skip_events=None, memory_budget=None):
+        '''
+        date_filter should be given in UTC
+        if fast_decode is True, CIRC, CIRC_MINOR, STREAM, and BUILDTIMEOUT_SET events are
+        decoded with decode_torctl_event instead of stem
+        skip_events is a list of event types that are dropped before decoding; if None,
+        every event type not in TORCTL_HANDLED_EVENTS is dropped
+        if memory_budget is given, closed circuits and streams are spilled to disk once the
+        process uses more than memory_budget MiB
+        '''
         self.do_simple = True
+        self.fast_decode = fast_decode
+        self.skip_events = set(skip_events) if skip_events is not None else None
+        # skipped BW events are counted along with the other skipped events
+        self.decode_bw = not self.__is_event_skipped('BW')
+        self.skipped_events = {}
+        self.chunk = None
         self.bandwidth_summary = {'bytes_read':{}, 'bytes_written':{}}
         self.circuits_state = {}
-        self.circuits = {}
+        self.memory_budget = memory_budget
+        self.circuits = make_records(memory_budget)
         self.circuits_summary = {'buildtimes':[], 'lifetimes':[]}
         self.streams_state = {}
-        self.streams = {}
+        self.streams = make_records(memory_budget)
         self.streams_summary = {'lifetimes':{}}
         self.name = None
         self.boot_succeeded = False
         self.build_timeout_last = None
         self.build_quantile_last = None
         self.date_filter = date_filter
+        self.date_start_ts, self.date_end_ts = util.date_to_timestamp_range(date_filter) if date_filter is not None else (None, None)
 
     def __handle_circuit(self, event, arrival_dt):
         # first make sure we have a circuit object
@@ -667,7 +2469,7 @@ class TorCtlParser(Parser):
 
         # now figure out what status we want to track
         key = None
-        if isinstance(event, CircuitEvent):
+        if event.type == 'CIRC':
             if event.status == CircStatus.LAUNCHED:
                 circ.set_launched(arrival_dt, self.build_timeout_last, self.build_quantile_last)
 
@@ -692,17 +2494,17 @@ class TorCtlParser(Parser):
                 circ.set_end_time(arrival_dt)
                 started, built, ended = circ.unix_ts_start, circ.buildtime_seconds, circ.unix_ts_end
 
-                data = circ.get_data()
-                if data is not None:
-                    if built is not None and started is not None and len(data['path']) == 3:
+                # only circuits that we saw launch have data, and circuits that were built
+                # without any hop that we saw extended are left out, as they always were
+                if started is not None and (built is None or len(circ.path) > 0):
+                    if built is not None and len(circ.path) == 3:
                         self.circuits_summary['buildtimes'].append(built - started)
-                    if ended is not None and started is not None:
-                        self.circuits_summary['lifetimes'].append(ended - started)
+                    self.circuits_summary['lifetimes'].append(ended - started)
                     if not self.do_simple:
-                        self.circuits[cid] = data
+                        self.circuits[cid] = circ
                 self.circuits_state.pop(cid)
 
-        elif not self.do_simple and isinstance(event, CircMinorEvent):
+        elif not self.do_simple and event.type == 'CIRC_MINOR':
             if event.purpose != event.old_purpose or event.event != CircEvent.PURPOSE_CHANGED:
                 key = "{0}:{1}".format(event.event, event.purpose)
                 circ.add_event(key, arrival_dt)
@@ -736,51 +2538,83 @@ class TorCtlParser(Parser):
             stream_type = strm.last_purpose
             started, ended = strm.unix_ts_start, strm.unix_ts_end
 
-            data = strm.get_data()
-            if data is not None:
+            # only streams that we saw start have data
+            if started is not None:
                 if not self.do_simple:
-                    self.streams[sid] = data
+                    self.streams[sid] = strm
                 self.streams_summary['lifetimes'].setdefault(stream_type, []).append(ended - started)
             self.streams_state.pop(sid)
 
     def __handle_bw(self, event, arrival_dt):
-        self.bandwidth_summary['bytes_read'][int(arrival_dt)] = event.read
-        self.bandwidth_summary['bytes_written'][int(arrival_dt)] = event.written
+        self.__handle_bw_counts(event.read, event.written, arrival_dt)
+
+    def __handle_bw_counts(self, bytes_read, bytes_written, arrival_dt):
+        self.bandwidth_summary['bytes_read'][int(arrival_dt)] = bytes_read
+        self.bandwidth_summary['bytes_written'][int(arrival_dt)] = bytes_written
 
     def __handle_buildtimeout(self, event, arrival_dt):
         self.build_timeout_last = event.timeout
         self.build_quantile_last = event.quantile
 
     def __handle_event(self, event, arrival_dt):
-        if isinstance(event, (CircuitEvent, CircMinorEvent)):
+        # dispatch on the event type so that stem events and our TorCtlEvents are handled alike
+        if event.type in ('CIRC', 'CIRC_MINOR'):
             self.__handle_circuit(event, arrival_dt)
-        elif isinstance(event, StreamEvent):
+        elif event.type == 'STREAM':
             self.__handle_stream(event, arrival_dt)
-        elif isinstance(event, BandwidthEvent):
+        elif event.type == 'BW':
             self.__handle_bw(event, arrival_dt)
-        elif isinstance(event, BuildTimeoutSetEvent):
+        elif event.type == 'BUILDTIMEOUT_SET':
             self.__handle_buildtimeout(event, arrival_dt)
 
-    def __is_date_valid(self, date_to_check):
+    def __is_date_valid(self, unix_ts):
         if self.date_filter is None:
             # we are not asked to filter, so every date is valid
             return True
         else:
-            # we are asked to filter, so the line is only valid if the date matches the filter
-            # both the filter and the unix timestamp should be in UTC at this point
-            return util.do_dates_match(self.date_filter, date_to_check)
+            # we are asked to filter, so the line is only valid if it falls within the filter day
+            # both the filter bounds and the unix timestamp are in UTC at this point
+            return self.date_start_ts <= unix_ts < self.date_end_ts
+
+    def __is_past_date(self, unix_ts):
+        # log lines are time-ordered, so nothing after a line past the filter day can match it
+        return self.date_filter is not None and unix_ts >= self.date_end_ts
+
+    def __is_event_skipped(self, event_type):
+        if self.skip_events is None:
+            return event_type not in TORCTL_HANDLED_EVENTS
+        else:
+            return event_type in self.skip_events
+
+    def __parse_header(self, line):
+        ''' returns False if the rest of the line should not be parsed '''
+        if re.search("Starting\storctl\sprogram\son\shost", line) is not None:
+            parts = line.strip().split()
+            if len(parts) < 11:
+                return False
+            self.name = parts[10]
+        if re.search("Bootstrapped\s100", line) is not None:
+            self.boot_succeeded = True
+        elif re.search("BOOTSTRAP", line) is not None and re.search("PROGRESS=100", line) is not None:
+            self.boot_succeeded = True
+        return True
 
     def __parse_line(self, line):
         if not self.boot_succeeded:
-            if re.search("Starting\storctl\sprogram\son\shost", line) is not None:
-                parts = line.strip().split()
-                if len(parts) < 11:
-                    return True
-                self.name = parts[10]
-            if re.search("Bootstrapped\s100", line) is not None:
-                self.boot_succeeded = True
-            elif re.search("BOOTSTRAP", line) is not None and re.search("PROGRESS=100", line) is not None:
-                self.boot_succeeded = True
+            if self.chunk is not None and ("torctl" in line or "Bootstrap" in line or "BOOTSTRAP" in line):
+                self.chunk.segment['header_lines'].append(line)
+            if not self.__parse_header(line):
+                return True
+
+        # BW events are the bulk of the log, so decode them without building stem objects
+        bw = decode_bw_line(line) if self.decode_bw else None
+        if bw is not None:
+            unix_ts, bytes_read, bytes_written = bw
+            if self.__is_past_date(unix_ts):
+                return False
+            if self.__is_date_valid(unix_ts):
+                self.__handle_bw_counts(bytes_read, bytes_written, unix_ts)
+            return True
 
         if self.do_simple is False or (self.do_simple is True and re.search("650\sBW", line) is not None):
             # parse with stem
@@ -788,21 +2622,37 @@ class TorCtlParser(Parser):
             if sep == '':
                 return True
 
+            # drop event types that no handler uses before we spend any time decoding them
+            event_type = raw_event_str.split(None, 1)[0] if len(raw_event_str) > 0 else ''
+            if self.__is_event_skipped(event_type):
+                self.skipped_events[event_type] = self.skipped_events.get(event_type, 0) + 1
+                return True
+
             # event.arrived_at is also available but at worse granularity
             unix_ts = float(timestamps.strip().split()[2])
 
-            # check if we should ignore the line
-            line_date = datetime.datetime.utcfromtimestamp(unix_ts).date()
-            if not self.__is_date_valid(line_date):
+            # check if we should ignore the line, or stop parsing altogether
+            if self.__is_past_date(unix_ts):
+                return False
+            if not self.__is_date_valid(unix_ts):
+                return True
+
+            event = decode_torctl_event(raw_event_str) if self.fast_decode else None
+            if event is None:
+                event = ControlMessage.from_str("{0} {1}".format(sep.strip(), raw_event_str))
+                convert('EVENT', event)
+
+            if self.chunk is not None and self.__is_chunk_deferred(event):
+                self.chunk.cut(self.__take_results(), line)
                 return True
 
-            event = ControlMessage.from_str("{0} {1}".format(sep.strip(), raw_event_str))
-            convert('EVENT', event)
             self.__handle_event(event, unix_ts)
         return True
 
     def parse(self, source, do_simple=True):
         self.do_simple = do_simple
+        # the counts that we log are those of this source
+        self.skipped_events = {}
         source.open()
         for line in source:
             # ignore line parsing errors
@@ -816,9 +2666,89 @@ class TorCtlParser(Parser):
         source.close()
         print len(self.streams), len(self.circuits)
 
+        if len(self.skipped_events) > 0:
+            counts = ', '.join(["{0}={1}".format(k, self.skipped_events[k]) for k in sorted(self.skipped_events.keys())])
+            logging.info("TorCtlParser: skipped decoding events by type: {0}".format(counts))
+
+    def parse_line(self, line, do_simple=True):
+        ''' parse a single line, returns False once lines are past the date_filter day '''
+        self.do_simple = do_simple
+        return self.__parse_line(line)
+
+    def __is_chunk_deferred(self, event):
+        if event.type in ('CIRC', 'CIRC_MINOR'):
+            # a circuit launched before we know the current build timeout needs the carried one
+            is_start = event.type == 'CIRC' and event.status == CircStatus.LAUNCHED and self.chunk.build_timeout_known
+            return self.chunk.is_deferred(('circuit', int(event.id)), is_start)
+        elif event.type == 'STREAM':
+            is_start = event.status == StreamStatus.NEW or event.status == StreamStatus.NEWRESOLVE
+            return self.chunk.is_deferred(('stream', int(event.id)), is_start)
+        elif event.type == 'BUILDTIMEOUT_SET':
+            self.chunk.segment['build_timeout'] = (event.timeout, event.quantile)
+            self.chunk.build_timeout_known = True
+        return False
+
+    def __take_results(self):
+        data = {'circuits': self.circuits, 'circuits_summary': self.circuits_summary,
+                'streams': self.streams, 'streams_summary': self.streams_summary,
+                'bandwidth_summary': self.bandwidth_summary}
+        self.bandwidth_summary = {'bytes_read':{}, 'bytes_written':{}}
+        self.circuits = make_records(self.memory_budget)
+        self.circuits_summary = {'buildtimes':[], 'lifetimes':[]}
+        self.streams = make_records(self.memory_budget)
+        self.streams_summary = {'lifetimes':{}}
+        return data
+
+    def get_settings(self, do_simple):
+        # the event types that are dropped change the results
+        skip_events = tuple(sorted(self.skip_events)) if self.skip_events is not None else None
+        return Parser.get_settings(self, do_simple) + (skip_events,)
+
+    def new_chunk_parser(self):
+        skip_events = list(self.skip_events) if self.skip_events is not None else None
+        return TorCtlParser(date_filter=self.date_filter, fast_decode=self.fast_decode, skip_events=skip_events, memory_budget=self.memory_budget)
+
+    def finish_chunk(self):
+        chunk = self.chunk
+        chunk.cut(self.__take_results(), None)
+        chunk.open_state = (self.circuits_state, self.streams_state)
+        self.chunk, self.circuits_state, self.streams_state = None, {}, {}
+        return chunk
+
+    def merge_chunk(self, chunk, do_simple):
+        open_ids = set([('circuit', cid) for cid in self.circuits_state] + [('stream', sid) for sid in self.streams_state])
+        if len(chunk.started_ids & open_ids) > 0:
+            return False
+
+        self.do_simple = do_simple
+        for segment in chunk.segments:
+            for line in segment['header_lines']:
+                if not self.boot_succeeded:
+                    self.__parse_header(line)
+            if segment['build_timeout'] is not None:
+                self.build_timeout_last, self.build_quantile_last = segment['build_timeout']
+            data = segment['data']
+            self.circuits.update(data['circuits'])
+            self.streams.update(data['streams'])
+            merge_summary(self.circuits_summary, data['circuits_summary'])
+            merge_summary(self.streams_summary, data['streams_summary'])
+            merge_summary(self.bandwidth_summary, data['bandwidth_summary'])
+            if segment['line'] is not None:
+                # ignore line parsing errors
+                try:
+                    self.__parse_line(segment['line'])
+                except:
+                    pass
+
+        circuits_state, streams_state = chunk.open_state
+        self.circuits_state.update(circuits_state)
+        self.streams_state.update(streams_state)
+        return True
+
     def get_data(self):
-        return {'circuits': self.circuits, 'circuits_summary': self.circuits_summary,
-                'streams':self.streams, 'streams_summary': self.streams_summary,
+        # circuits and streams are kept as compact records until their data is needed
+        return {'circuits': get_record_data(self.circuits), 'circuits_summary': self.circuits_summary,
+                'streams': get_record_data(self.streams), 'streams_summary': self.streams_summary,
                 'bandwidth_summary': self.bandwidth_summary}
 
     def get_name(self):
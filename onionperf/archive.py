@@ -0,0 +1,198 @@
+'''
+  OnionPerf
+  Authored by Rob Jansen, 2015
+  See LICENSE for licensing information
+'''
+
+import os, re, datetime, logging, shutil
+
+from analysis import Analysis, get_analysis_index_path
+
+# partitions hold the analyses of the days from the first to the last date in their name
+PARTITION_SUFFIX = ".onionperf.archive.json.xz"
+PARTITION_RE = re.compile(r'^(\d{4})-(\d{2})-(\d{2})\.(\d{4})-(\d{2})-(\d{2})' + re.escape(PARTITION_SUFFIX) + '$')
+
+def get_period_range(date, period):
+    ''' returns the first and last day of the 'week' (starting on monday) or 'month' that date is in '''
+    if period == 'week':
+        first = date - datetime.timedelta(days=date.weekday())
+        return first, first + datetime.timedelta(days=6)
+    elif period == 'month':
+        first = date.replace(day=1)
+        next_first = (first + datetime.timedelta(days=32)).replace(day=1)
+        return first, next_first - datetime.timedelta(days=1)
+    else:
+        raise ValueError("unsupported archive period '{0}'".format(period))
+
+class Partition(object):
+
+    def __init__(self, archive_dir, first_date, last_date):
+        self.first_date = first_date
+        self.last_date = last_date
+        self.filename = "{0}.{1}{2}".format(first_date.isoformat(), last_date.isoformat(), PARTITION_SUFFIX)
+        self.filepath = os.path.join(archive_dir, self.filename)
+
+    def overlaps(self, first_date, last_date):
+        return self.first_date <= last_date and first_date <= self.last_date
+
+    def contains(self, other):
+        return self.first_date <= other.first_date and other.last_date <= self.last_date
+
+    def load(self, sections=None, nodes=None):
+        return Analysis.load(filename=self.filepath, sections=sections, nodes=nodes)
+
+    def remove(self):
+        for path in [self.filepath, "{0}.index".format(self.filepath)]:
+            if os.path.exists(path):
+                os.remove(path)
+
+class AnalysisArchive(object):
+    '''
+    a directory of analysis results that are partitioned by time: each day's analysis is appended
+    as a partition of its own, and compact() merges the partitions of past weeks or months into one,
+    so that queries over long time ranges open few files
+    '''
+
+    def __init__(self, archive_dir, num_threads=1, memory_budget=None):
+        self.archive_dir = os.path.abspath(os.path.expanduser(archive_dir))
+        # the number of threads that compress the partitions we save
+        self.num_threads = num_threads
+        # if set, the records of the partitions that are compacted are spilled to disk past this many MiB
+        self.memory_budget = memory_budget
+        if not os.path.exists(self.archive_dir):
+            os.makedirs(self.archive_dir)
+
+    def __scan(self):
+        # a partition that is covered by another one is left over from an interrupted compaction
+        partitions = []
+        for name in os.listdir(self.archive_dir):
+            m = PARTITION_RE.match(name)
+            if m is not None:
+                values = [int(v) for v in m.groups()]
+                partitions.append(Partition(self.archive_dir, datetime.date(*values[:3]), datetime.date(*values[3:])))
+
+        # larger partitions come first, so that partitions inside them are found after them
+        partitions.sort(key=lambda p: (p.first_date, -p.last_date.toordinal()))
+        kept, covered = [], []
+        for partition in partitions:
+            if len(kept) > 0 and kept[-1].contains(partition):
+                covered.append(partition)
+            else:
+                kept.append(partition)
+        return kept, covered
+
+    def get_partitions(self):
+        ''' returns the partitions in the archive ordered by time '''
+        return self.__scan()[0]
+
+    def find_partitions(self, first_date, last_date):
+        ''' returns the partitions that hold any day from first_date to last_date '''
+        return [p for p in self.get_partitions() if p.overlaps(first_date, last_date)]
+
+    def load_range(self, first_date, last_date, sections=None, nodes=None):
+        '''
+        returns the Analysis of each partition that holds any day from first_date to last_date;
+        see Analysis.load for sections and nodes
+        '''
+        analyses = []
+        for partition in self.find_partitions(first_date, last_date):
+            analysis = partition.load(sections=sections, nodes=nodes)
+            if analysis is not None:
+                analyses.append(analysis)
+        return analyses
+
+    def __save_partition(self, analysis, partition):
+        # write to a temporary name first, so a crash never leaves a half-written partition
+        tmp_filename = "tmp.{0}".format(partition.filename)
+        analysis.save(filename=tmp_filename, output_prefix=self.archive_dir, do_compress=True, do_index=True, num_threads=self.num_threads)
+        tmp_filepath = os.path.join(self.archive_dir, tmp_filename)
+        os.rename("{0}.index".format(tmp_filepath), "{0}.index".format(partition.filepath))
+        os.rename(tmp_filepath, partition.filepath)
+
+    def __get_day_partition(self, date):
+        # returns None if the day was already compacted into a longer partition
+        for partition in self.find_partitions(date, date):
+            if partition.first_date != partition.last_date:
+                logging.warning("not archiving the analysis of {0}, which is already in partition {1}".format(date, partition.filename))
+                return None
+
+        partition = Partition(self.archive_dir, date, date)
+        logging.info("archiving the analysis of {0} in partition {1}".format(date, partition.filename))
+        return partition
+
+    def append(self, analysis, date):
+        '''
+        adds the analysis of the day date to the archive, replacing an earlier analysis of that day;
+        returns False if the day was already compacted into a longer partition
+        '''
+        partition = self.__get_day_partition(date)
+        if partition is None:
+            return False
+        self.__save_partition(analysis, partition)
+        return True
+
+    def append_file(self, filepath, date):
+        '''
+        like append, but copies the analysis that was saved at filepath with do_index, and its index,
+        such as the results of 'onionperf analyze --index', instead of loading it into memory
+        '''
+        partition = self.__get_day_partition(date)
+        if partition is None:
+            return False
+        tmp_filepath = os.path.join(self.archive_dir, "tmp.{0}".format(partition.filename))
+        shutil.copyfile(get_analysis_index_path(filepath), "{0}.index".format(tmp_filepath))
+        shutil.copyfile(filepath, tmp_filepath)
+        os.rename("{0}.index".format(tmp_filepath), "{0}.index".format(partition.filepath))
+        os.rename(tmp_filepath, partition.filepath)
+        return True
+
+    def compact(self, period='week', today=None):
+        '''
+        merges all partitions that lie inside a 'week' or 'month' that ended before today (the current
+        UTC day by default) into a single partition for that period; a partition that started in the
+        previous period and is shorter than a period, such as a week that spans the start of a month,
+        cannot be split by day because its summaries are not kept by day, so it is merged into the
+        period that it ends in, and the partition of the previous period ends the day before it
+        '''
+        if today is None:
+            today = datetime.datetime.utcnow().date()
+
+        partitions, covered = self.__scan()
+        for partition in covered:
+            logging.info("removing archive partition {0} that was already compacted".format(partition.filename))
+            partition.remove()
+
+        groups = {}
+        for partition in partitions:
+            period_range = get_period_range(partition.last_date, period)
+            is_inside = partition.first_date >= period_range[0]
+            is_shorter = partition.last_date - partition.first_date < period_range[1] - period_range[0]
+            if (is_inside or is_shorter) and period_range[1] < today:
+                groups.setdefault(period_range, []).append(partition)
+
+        for ((first_date, last_date), group) in sorted(groups.items()):
+            first_date = min(first_date, group[0].first_date)
+            # the days of the period that other partitions hold are left to them
+            for partition in partitions:
+                if partition not in group and partition.overlaps(first_date, last_date):
+                    if partition.last_date < group[0].first_date:
+                        first_date = partition.last_date + datetime.timedelta(days=1)
+                    else:
+                        last_date = partition.first_date - datetime.timedelta(days=1)
+
+            if len(group) == 1 and (group[0].first_date, group[0].last_date) == (first_date, last_date):
+                continue
+
+            merged = Analysis()
+            for partition in group:
+                # partitions have an index, so their sections are read and merged one at a time
+                analysis = partition.load(sections=[])
+                if analysis is not None:
+                    merged.merge(analysis, memory_budget=self.memory_budget)
+
+            compacted = Partition(self.archive_dir, first_date, last_date)
+            logging.info("compacting {0} archive partitions into {1}".format(len(group), compacted.filename))
+            self.__save_partition(merged, compacted)
+            for partition in group:
+                if partition.filename != compacted.filename:
+                    partition.remove()
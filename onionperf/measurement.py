@@ -4,7 +4,8 @@
   See LICENSE for licensing information
 '''
 
-import os, traceback, subprocess, threading, Queue, logging, time, datetime, re, shlex
+import os, sys, traceback, subprocess, threading, Queue, logging, time, datetime, re, shlex
+from multiprocessing import cpu_count
 from lxml import etree
 
 # stem imports
@@ -14,7 +15,7 @@ from stem.version import Version, Requirement, get_system_tor_version
 from stem import __version__ as stem_version
 
 # onionperf imports
-import analysis, monitor, model, util
+import analysis, archive, monitor, model, util
 
 def generate_docroot_index(docroot_path):
     root = etree.Element("files")
@@ -111,7 +112,53 @@ def watchdog_thread_task(cmd, cwd, writable, done_ev, send_stdin, ready_search_s
     # too many failures, or master asked us to stop, close the writable before exiting thread
     writable.close()
 
-def logrotate_thread_task(writables, tgen_writable, torctl_writable, docroot, nickname, done_ev):
+def get_onionperf_command():
+    ''' returns the command that runs the onionperf script of this process, or None if it is not found '''
+    script = os.path.abspath(sys.argv[0])
+    if os.path.basename(script) != "onionperf":
+        script = util.which("onionperf")
+    return None if script is None else [sys.executable, script]
+
+def get_analyze_command(onionperf_cmd, tgen_filepath, torctl_filepath, docroot, nickname, ip_address, date, memory_budget=None, do_index=False):
+    '''
+    returns the 'onionperf analyze' command that parses the day date of the log files in parallel, and saves
+    the results in onionperf and torperf format in docroot; do_index also saves an index for the archive
+    '''
+    # the tgen and torctl logs are parsed at the same time, and the xz blocks are (de)compressed on all cpus
+    cmd = onionperf_cmd + ["analyze", "--prefix", docroot, "--date-filter", util.date_to_string(date), "--torperf",
+                           "--processes", "2", "--threads", str(cpu_count())]
+    if tgen_filepath is not None:
+        cmd += ["--tgen", tgen_filepath]
+    if torctl_filepath is not None:
+        cmd += ["--torctl", torctl_filepath]
+    if nickname is not None:
+        cmd += ["--nickname", nickname]
+    if ip_address is not None:
+        cmd += ["--address", ip_address]
+    if memory_budget is not None:
+        cmd += ["--memory-budget", str(memory_budget)]
+    if do_index:
+        cmd += ["--index"]
+    return cmd
+
+def run_analyze_command(cmd, done_ev):
+    '''
+    runs cmd and waits for it to finish, or stops it once done_ev is set; returns False if it was stopped,
+    and raises CalledProcessError if it failed
+    '''
+    logging.info("running '{0}'".format(" ".join(cmd)))
+    subp = subprocess.Popen(cmd)
+    while subp.poll() is None:
+        if done_ev.wait(1):
+            subp.terminate()
+            subp.wait()
+            return False
+    if subp.returncode != 0:
+        raise subprocess.CalledProcessError(subp.returncode, cmd)
+    return True
+
+def logrotate_thread_task(writables, tgen_writable, torctl_writable, docroot, nickname, done_ev, live_analysis=None, analysis_archive=None, archive_period='week',
+                          memory_budget=None):
     next_midnight = None
 
     while not done_ev.wait(1):
@@ -138,19 +185,53 @@ def logrotate_thread_task(writables, tgen_writable, torctl_writable, docroot, ni
                     # get our public ip address, do this every night in case it changes
                     public_measurement_ip_guess = util.get_ip_address()
 
-                    # set up the analysis object with our log files
-                    anal = analysis.Analysis(nickname=nickname, ip_address=public_measurement_ip_guess)
-                    if tgen_writable is not None:
-                        anal.add_tgen_file(tgen_writable.rotate_file(filename_datetime=next_midnight))
-                    if torctl_writable is not None:
-                        anal.add_torctl_file(torctl_writable.rotate_file(filename_datetime=next_midnight))
-
-                    # run the analysis, i.e. parse the files
-                    anal.analyze(do_simple=False, date_filter=next_midnight.date())
-
-                    # save the results in onionperf and torperf format in the www docroot
-                    anal.save(output_prefix=docroot, do_compress=True)
-                    anal.export_torperf_version_1_1(output_prefix=docroot, do_compress=False)
+                    onionperf_cmd = get_onionperf_command() if live_analysis is None else None
+                    if live_analysis is not None:
+                        # the lines were parsed as they were written, so collect the results without re-reading the logs
+                        if tgen_writable is not None:
+                            tgen_writable.rotate_file(filename_datetime=next_midnight)
+                        if torctl_writable is not None:
+                            torctl_writable.rotate_file(filename_datetime=next_midnight)
+                        anal = live_analysis.get_rotated_analysis(ip_address=public_measurement_ip_guess)
+                    elif onionperf_cmd is not None:
+                        # this process runs threads that hold locks, such as the flushers and logging, so forking
+                        # worker processes from it could deadlock them; a new onionperf process parses in parallel
+                        tgen_filepath = tgen_writable.rotate_file(filename_datetime=next_midnight) if tgen_writable is not None else None
+                        torctl_filepath = torctl_writable.rotate_file(filename_datetime=next_midnight) if torctl_writable is not None else None
+                        cmd = get_analyze_command(onionperf_cmd, tgen_filepath, torctl_filepath, docroot, nickname, public_measurement_ip_guess,
+                                                  next_midnight.date(), memory_budget=memory_budget, do_index=analysis_archive is not None)
+                        if not run_analyze_command(cmd, done_ev):
+                            break
+
+                        # the saved results are archived as they are, so they are not loaded back into memory
+                        if analysis_archive is not None:
+                            filepath = os.path.join(docroot, "{0}.onionperf.analysis.json.xz".format(util.date_to_string(next_midnight.date())))
+                            analysis_archive.append_file(filepath, next_midnight.date())
+                            os.remove(analysis.get_analysis_index_path(filepath))
+                            analysis_archive.compact(period=archive_period)
+                        anal = None
+                    else:
+                        logging.warning("the onionperf script was not found, so the logs are parsed serially in this process")
+                        # set up the analysis object with our log files
+                        anal = analysis.Analysis(nickname=nickname, ip_address=public_measurement_ip_guess)
+                        if tgen_writable is not None:
+                            anal.add_tgen_file(tgen_writable.rotate_file(filename_datetime=next_midnight))
+                        if torctl_writable is not None:
+                            anal.add_torctl_file(torctl_writable.rotate_file(filename_datetime=next_midnight))
+
+                        # run the analysis, i.e. parse the files, without forking worker processes
+                        anal.analyze(do_simple=False, date_filter=next_midnight.date(), memory_budget=memory_budget)
+
+                    if anal is not None:
+                        # save the results in onionperf and torperf format in the www docroot, the json
+                        # format only, because that is what the collectors fetch
+                        anal.save(output_prefix=docroot, do_compress=True, do_columnar=False, num_threads=cpu_count())
+                        anal.export_torperf_version_1_1(output_prefix=docroot, do_compress=False)
+
+                        # keep the results in the long-term archive, and merge the days of the periods that ended
+                        if analysis_archive is not None:
+                            analysis_archive.append(anal, next_midnight.date())
+                            analysis_archive.compact(period=archive_period)
 
                     # update the xml index in docroot
                     generate_docroot_index(docroot)
@@ -162,11 +243,16 @@ def logrotate_thread_task(writables, tgen_writable, torctl_writable, docroot, ni
 
 class Measurement(object):
 
-    def __init__(self, tor_bin_path, tgen_bin_path, datadir_path, nickname):
+    def __init__(self, tor_bin_path, tgen_bin_path, datadir_path, nickname, do_live_analysis=False, archive_period=None, memory_budget=None):
         self.tor_bin_path = tor_bin_path
         self.tgen_bin_path = tgen_bin_path
         self.datadir_path = datadir_path
         self.nickname = nickname
+        self.do_live_analysis = do_live_analysis
+        self.live_analysis = None
+        self.archive_period = archive_period
+        # if set, the daily analysis spills its records to disk once it uses more than this many MiB
+        self.memory_budget = memory_budget
         self.threads = None
         self.done_event = None
         self.hs_service_id = None
@@ -185,6 +271,8 @@ class Measurement(object):
         '''
         self.threads = []
         self.done_event = threading.Event()
+        if self.do_live_analysis:
+            self.live_analysis = analysis.LiveAnalysis(nickname=self.nickname, do_simple=False, memory_budget=self.memory_budget)
 
         # if ctrl-c is pressed, shutdown child processes properly
         try:
@@ -278,7 +366,11 @@ class Measurement(object):
 
     def __start_log_processors(self, general_writables, tgen_writable, torctl_writable):
         # rotate the log files, and then parse out the torperf measurement data
-        logrotate_args = (general_writables, tgen_writable, torctl_writable, self.www_docroot, self.nickname, self.done_event)
+        analysis_archive = None
+        if self.archive_period is not None:
+            analysis_archive = archive.AnalysisArchive("{0}/archive".format(self.datadir_path), num_threads=cpu_count(), memory_budget=self.memory_budget)
+        logrotate_args = (general_writables, tgen_writable, torctl_writable, self.www_docroot, self.nickname, self.done_event,
+                          self.live_analysis, analysis_archive, self.archive_period, self.memory_budget)
         logrotate = threading.Thread(target=logrotate_thread_task, name="logrotate", args=logrotate_args)
         logrotate.start()
         self.threads.append(logrotate)
@@ -304,8 +396,10 @@ class Measurement(object):
             model.TorperfModel(tgen_port="{0}".format(tgen_port), tgen_servers=server_urls, socksproxy="127.0.0.1:{0}".format(socks_port)).dump_to_file(tgen_confpath)
 
         tgen_logpath = "{0}/onionperf.tgen.log".format(tgen_datadir)
-        tgen_writable = util.FileWritable(tgen_logpath)
+        tgen_writable = util.FileWritable(tgen_logpath, flush_interval=util.FILE_FLUSH_INTERVAL)
         logging.info("Logging TGen {1} process output to {0}".format(tgen_logpath, name))
+        if name == "client" and self.live_analysis is not None:
+            tgen_writable.add_listener(self.live_analysis.tgen_listener)
 
         tgen_cmd = "{0} {1}".format(self.tgen_bin_path, tgen_confpath)
         tgen_args = (tgen_cmd, tgen_datadir, tgen_writable, self.done_event, None, None, None)
@@ -332,7 +426,7 @@ WarnUnsafeSocks 0\nSafeLogging 0\nMaxCircuitDirtiness 60 seconds\nUseEntryGuards
         tor_config = tor_config_template.format(control_port, socks_port, tor_datadir)
 
         tor_logpath = "{0}/onionperf.tor.log".format(tor_datadir)
-        tor_writable = util.FileWritable(tor_logpath)
+        tor_writable = util.FileWritable(tor_logpath, flush_interval=util.FILE_FLUSH_INTERVAL)
         logging.info("Logging Tor {0} process output to {1}".format(name, tor_logpath))
 
         # from stem.process import launch_tor_with_config
@@ -350,8 +444,10 @@ WarnUnsafeSocks 0\nSafeLogging 0\nMaxCircuitDirtiness 60 seconds\nUseEntryGuards
         tor_ready_ev.wait()
 
         torctl_logpath = "{0}/onionperf.torctl.log".format(tor_datadir)
-        torctl_writable = util.FileWritable(torctl_logpath)
+        torctl_writable = util.FileWritable(torctl_logpath, flush_interval=util.FILE_FLUSH_INTERVAL)
         logging.info("Logging Tor {0} control port monitor output to {1}".format(name, torctl_logpath))
+        if name == "client" and self.live_analysis is not None:
+            torctl_writable.add_listener(self.live_analysis.torctl_listener)
 
         # give a few seconds to make sure Tor had time to start listening on the control port
         time.sleep(3)
@@ -0,0 +1,5 @@
+'''
+  OnionPerf
+  Authored by Rob Jansen, 2015
+  See LICENSE for licensing information
+'''
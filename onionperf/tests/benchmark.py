@@ -0,0 +1,78 @@
+'''
+  OnionPerf
+  Authored by Rob Jansen, 2015
+  See LICENSE for licensing information
+
+  measures the parsers and the size of their records on synthetic logs, run as: python -m onionperf.tests.benchmark [NUM_TRANSFERS]
+'''
+
+import sys, time, shutil, tempfile
+from collections import Mapping
+
+from onionperf import analysis, util
+from onionperf.tests.synthetic import write_synthetic_logs
+
+def count_lines(filepath):
+    with open(filepath, 'r') as f:
+        return sum(1 for _ in f)
+
+def time_parse(parser, filepath, do_simple):
+    start = time.time()
+    parser.parse(util.DataSource(filepath), do_simple=do_simple)
+    return time.time() - start
+
+def bench_tgen(tgen_path):
+    num_lines = count_lines(tgen_path)
+    for do_simple in [True, False]:
+        seconds = time_parse(analysis.TGenParser(), tgen_path, do_simple)
+        print "tgen do_simple={0}: {1:.0f} lines/sec".format(do_simple, num_lines / seconds)
+
+def bench_torctl(torctl_path):
+    num_lines = count_lines(torctl_path)
+    for do_simple in [True, False]:
+        seconds = time_parse(analysis.TorCtlParser(), torctl_path, do_simple)
+        print "torctl do_simple={0}: {1:.0f} lines/sec".format(do_simple, num_lines / seconds)
+
+def get_deep_size(obj, seen=None):
+    # the bytes held by obj and everything it refers to, counting shared objects once
+    seen = set() if seen is None else seen
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, basestring):
+        return size
+    elif isinstance(obj, Mapping):
+        return size + sum(get_deep_size(k, seen) + get_deep_size(v, seen) for (k, v) in obj.iteritems())
+    elif isinstance(obj, (list, tuple, set)):
+        return size + sum(get_deep_size(item, seen) for item in obj)
+    for name in getattr(type(obj), '__slots__', ()):
+        if hasattr(obj, name):
+            size += get_deep_size(getattr(obj, name), seen)
+    if hasattr(obj, '__dict__'):
+        size += get_deep_size(obj.__dict__, seen)
+    return size
+
+def bench_records(tgen_path, torctl_path):
+    # the bytes that the parsers retain per finished record, interned strings are counted once
+    tgen_parser, torctl_parser = analysis.TGenParser(), analysis.TorCtlParser()
+    tgen_parser.parse(util.DataSource(tgen_path), do_simple=False)
+    torctl_parser.parse(util.DataSource(torctl_path), do_simple=False)
+    for (name, records) in [("transfer", tgen_parser.transfers), ("circuit", torctl_parser.circuits), ("stream", torctl_parser.streams)]:
+        seen = set()
+        total = sum(get_deep_size(record, seen) for record in records.values())
+        print "{0}: {1:.0f} bytes/record".format(name, total / float(max(len(records), 1)))
+
+def main():
+    num_transfers = int(sys.argv[1]) if len(sys.argv) > 1 else 3000
+    log_dir = tempfile.mkdtemp(prefix="onionperf.bench.")
+    try:
+        tgen_path, torctl_path = write_synthetic_logs(log_dir, num_transfers=num_transfers)
+        bench_tgen(tgen_path)
+        bench_torctl(torctl_path)
+        bench_records(tgen_path, torctl_path)
+    finally:
+        shutil.rmtree(log_dir)
+
+if __name__ == '__main__':
+    main()
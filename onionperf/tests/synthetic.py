@@ -0,0 +1,107 @@
+'''
+  OnionPerf
+  Authored by Rob Jansen, 2015
+  See LICENSE for licensing information
+'''
+
+import os, random, datetime
+
+# the first line of the synthetic logs, four hours before midnight of 2016-02-04 UTC
+SYNTHETIC_START_TS = 1454544000.0 - 3600 * 4
+
+# the days that the synthetic logs cover
+SYNTHETIC_DATES = [datetime.date(2016, 2, 3), datetime.date(2016, 2, 4)]
+
+STEP_KEYS = ['socket-create', 'socket-connect', 'proxy-init', 'proxy-choice', 'proxy-request',
+             'proxy-response', 'command', 'response', 'first-byte', 'last-byte', 'checksum']
+
+def format_date(ts):
+    return datetime.datetime.utcfromtimestamp(ts).strftime("%Y-%m-%d %H:%M:%S")
+
+def write_synthetic_logs(directory, num_transfers=80, seed=1, nickname="op-ab"):
+    '''
+    writes onionperf.tgen.log and onionperf.torctl.log to directory, holding num_transfers
+    transfers over tor that span midnight, and returns their paths; the logs include failed
+    transfers, streams, and circuits, circuits that fail before their first hop, circuits that
+    are built without EXTENDED events, events that the parsers skip, and a malformed BW event
+    '''
+    rand = random.Random(seed)
+    tgen_path = os.path.join(directory, "onionperf.tgen.log")
+    torctl_path = os.path.join(directory, "onionperf.torctl.log")
+    tg, tc = open(tgen_path, 'w'), open(torctl_path, 'w')
+
+    ts = SYNTHETIC_START_TS
+    tg.write("{0} {1:.6f} [message] [shd-tgen-main.c:100] [_tgenmain_run] Initializing traffic generator on host {2} process id 42\n".format(format_date(ts), ts, nickname))
+    tc.write("{0} {1:.2f} Starting torctl program on host {2} using Tor version 0.2.7.6 status=recommended\n".format(format_date(ts), ts, nickname))
+    tc.write("{0} {1:.2f} NOTICE BOOTSTRAP PROGRESS=100 TAG=done SUMMARY=\"Done\"\n".format(format_date(ts), ts))
+    fingerprints = ["%040X" % rand.getrandbits(160) for _ in range(20)]
+    circ_flags = "BUILD_FLAGS=NEED_CAPACITY PURPOSE=GENERAL TIME_CREATED=2016-02-04T00:00:01.000000"
+
+    for i in range(num_transfers):
+        ts += rand.uniform(60, 600)
+        t = ts
+        size = rand.choice([51200, 1048576, 5242880])
+        tid = "(null),{0},{1},GET,{2},(null),0".format(i + 1, nickname, size)
+        port = rand.randint(30000, 60000)
+        cid, sid = i + 1, i + 1
+        # some circuits fail before their first hop, and the stream on them fails too
+        is_hopless = rand.random() < 0.1
+        # and for some, the log starts after their hops were extended
+        is_unextended = not is_hopless and rand.random() < 0.1
+        is_error = is_hopless or rand.random() < 0.1
+
+        def torctl(event):
+            tc.write("{0} {1:.2f} 650 {2}\r\n".format(format_date(t), t, event))
+
+        def circ(status, extra=""):
+            # tor leaves out the path of a circuit that has no hops yet
+            fields = [str(cid), status] + ([",".join(path)] if len(path) > 0 else []) + [circ_flags]
+            torctl("CIRC {0}{1}".format(" ".join(fields), extra))
+
+        torctl("BUILDTIMEOUT_SET COMPUTED TOTAL_TIMES=1000 TIMEOUT_MS={0} XM=500 ALPHA=1.5 CUTOFF_QUANTILE=0.8 TIMEOUT_RATE=0.1 CLOSE_MS=60000 CLOSE_RATE=0.0".format(rand.randint(1000, 3000)))
+        path = []
+        circ("LAUNCHED")
+        if not is_hopless:
+            for fingerprint in rand.sample(fingerprints, 3):
+                t += rand.uniform(0.1, 0.5)
+                path.append("${0}~n{1}".format(fingerprint, fingerprint[:4]))
+                if not is_unextended:
+                    circ("EXTENDED")
+            circ("BUILT")
+            if rand.random() < 0.2:
+                torctl("CIRC_MINOR {0} PURPOSE_CHANGED {1} BUILD_FLAGS=NEED_CAPACITY PURPOSE=HS_CLIENT_REND HS_STATE=HSCR_CONNECTING TIME_CREATED=2016-02-04T00:00:01.000000 OLD_PURPOSE=GENERAL".format(cid, ",".join(path)))
+        torctl("STREAM {0} NEW 0 1.2.3.4:8080 SOURCE_ADDR=127.0.0.1:{1} PURPOSE=USER".format(sid, port))
+        torctl("STREAM {0} SENTCONNECT {1} 1.2.3.4:8080".format(sid, cid))
+        if not is_hopless:
+            torctl("ORCONN {0}~x CONNECTED ID={1}".format(path[0].split('~')[0], cid))
+            torctl("STREAM {0} SUCCEEDED {1} 1.2.3.4:8080".format(sid, cid))
+        if i == num_transfers / 2:
+            torctl("BW 12 not-a-number")
+
+        tg.write("{0} {1:.6f} [info] [shd-tgen-transfer.c:10] [_tgentransfer_changeState] transfer {2},state=RESPONSE,error=NONE moving from state RESPONSE to state PAYLOAD\n".format(format_date(t), t, tid))
+        for k in range(10):
+            t2 = t + k * 0.3
+            if k > 0:
+                tg.write("{0} {1:.6f} [message] [shd-tgen-driver.c:10] [_tgendriver_onHeartbeat] [driver-heartbeat] transfers-total={2}\n".format(format_date(t2), t2, i))
+            tg.write("{0} {1:.6f} [info] [shd-tgen-transfer.c:803] [_tgentransfer_log] [transfer-status] transport TCP,12,localhost:127.0.0.1:{2},localhost:127.0.0.1:9050,host:1.2.3.4:8080,state=SUCCESS,error=NONE transfer {3},state=PAYLOAD,error=NONE total-bytes-read={4} total-bytes-write=38 payload-progress={4}/{5}\n".format(format_date(t2), t2, port, tid, size * k / 10, size))
+            tc.write("{0} {1:.2f} 650 BW {2} {3}\r\n".format(format_date(t2), t2, rand.randint(0, 1000000), rand.randint(0, 100000)))
+            tc.write("{0} {1:.2f} 650 CIRC_BW ID={2} READ=10 WRITTEN=20\r\n".format(format_date(t2), t2, cid))
+
+        t += 3.5
+        times = sorted(rand.randint(0, 3000000) for _ in STEP_KEYS)
+        time_info = " ".join("usecs-to-{0}={1}".format(k, v) for (k, v) in zip(STEP_KEYS, times))
+        kind, error_code = ("transfer-error", "READ") if is_error else ("transfer-complete", "NONE")
+        tg.write("{0} {1:.6f} [message] [shd-tgen-transfer.c:803] [_tgentransfer_log] [{2}] transport TCP,12,localhost:127.0.0.1:{3},localhost:127.0.0.1:9050,host:1.2.3.4:8080,state=SUCCESS,error=NONE transfer {4},state=DONE,error={5} total-bytes-read={6} total-bytes-write=38 payload-progress={6}/{6} time-info {7}\n".format(format_date(t), t, kind, port, tid, error_code, size, time_info))
+        if is_error:
+            torctl("STREAM {0} FAILED {1} 1.2.3.4:8080 REASON=END REMOTE_REASON=TIMEOUT".format(sid, cid))
+        else:
+            torctl("STREAM {0} CLOSED {1} 1.2.3.4:8080 REASON=DONE".format(sid, cid))
+        t += 1
+        if is_hopless or rand.random() < 0.1:
+            circ("FAILED", " REASON=DESTROYED REMOTE_REASON=FINISHED")
+        else:
+            circ("CLOSED", " REASON=FINISHED")
+
+    tg.close()
+    tc.close()
+    return tgen_path, torctl_path
@@ -0,0 +1,206 @@
+'''
+  OnionPerf
+  Authored by Rob Jansen, 2015
+  See LICENSE for licensing information
+'''
+
+import os, sys, shutil, tempfile, unittest, calendar, threading
+from datetime import date, timedelta
+
+from onionperf import analysis, archive, util
+from onionperf.tests.synthetic import SYNTHETIC_DATES
+from onionperf.tests.test_parsers import SyntheticLogsTestCase, load_expected, to_json
+
+try:
+    from onionperf import measurement
+except ImportError:
+    measurement = None
+
+def get_day_ts(day):
+    return calendar.timegm(day.timetuple())
+
+def make_day_analysis(day):
+    # one bandwidth sample at the start of the day tells which days a partition holds
+    a = analysis.Analysis(nickname="op-ab", ip_address='10.0.0.1')
+    a.json_db['data']['op-ab'] = {'measurement_ip': '10.0.0.1',
+        'tgen': {'transfers': {"transfer{0}".format(i): {'unix_ts_start': get_day_ts(day) + i} for i in xrange(5)}},
+        'tor': {'bandwidth_summary': {'bytes_read': {get_day_ts(day): 1}, 'bytes_written': {get_day_ts(day): 2}}}}
+    return a
+
+def get_days(first_date, last_date):
+    return [first_date + timedelta(days=i) for i in xrange((last_date - first_date).days + 1)]
+
+class TestCompact(unittest.TestCase):
+
+    def setUp(self):
+        self.archive_dir = tempfile.mkdtemp(prefix="onionperf.test.")
+        self.archive = archive.AnalysisArchive(self.archive_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.archive_dir)
+
+    def append_days(self, first_date, last_date):
+        for day in get_days(first_date, last_date):
+            self.assertTrue(self.archive.append(make_day_analysis(day), day))
+
+    def get_ranges(self):
+        return [(p.first_date, p.last_date) for p in self.archive.get_partitions()]
+
+    def assert_days_kept(self, first_date, last_date):
+        # every day is in one partition, whose range holds it
+        days = []
+        for partition in self.archive.get_partitions():
+            partition_days = [int(ts) for ts in partition.load().get_tor_bandwidth_summary("op-ab", 'bytes_read').keys()]
+            for ts in partition_days:
+                self.assertIn(ts, [get_day_ts(d) for d in get_days(partition.first_date, partition.last_date)])
+            days.extend(partition_days)
+        self.assertEqual(sorted(days), [get_day_ts(d) for d in get_days(first_date, last_date)])
+
+    def test_weeks(self):
+        # 2016-02-01 is a monday
+        self.append_days(date(2016, 2, 1), date(2016, 2, 16))
+        self.archive.compact(period='week', today=date(2016, 2, 17))
+        self.assertEqual(self.get_ranges(), [(date(2016, 2, 1), date(2016, 2, 7)), (date(2016, 2, 8), date(2016, 2, 14)),
+                                             (date(2016, 2, 15), date(2016, 2, 15)), (date(2016, 2, 16), date(2016, 2, 16))])
+        self.assert_days_kept(date(2016, 2, 1), date(2016, 2, 16))
+
+    def test_weeks_into_months(self):
+        # the week from 2016-02-29 to 2016-03-06 spans the start of march
+        self.append_days(date(2016, 2, 1), date(2016, 4, 1))
+        self.archive.compact(period='week', today=date(2016, 3, 15))
+        self.assertIn((date(2016, 2, 29), date(2016, 3, 6)), self.get_ranges())
+
+        # march has not ended yet, so the week is left until it has
+        self.archive.compact(period='month', today=date(2016, 3, 15))
+        self.assertEqual(self.get_ranges()[:2], [(date(2016, 2, 1), date(2016, 2, 28)), (date(2016, 2, 29), date(2016, 3, 6))])
+        self.assert_days_kept(date(2016, 2, 1), date(2016, 4, 1))
+
+        self.archive.compact(period='month', today=date(2016, 4, 2))
+        self.assertEqual(self.get_ranges(), [(date(2016, 2, 1), date(2016, 2, 28)), (date(2016, 2, 29), date(2016, 3, 31)),
+                                             (date(2016, 4, 1), date(2016, 4, 1))])
+        self.assert_days_kept(date(2016, 2, 1), date(2016, 4, 1))
+
+        # months are left alone when compacting weeks, and the week that starts in march begins after it
+        self.archive.compact(period='week', today=date(2016, 4, 20))
+        self.assertEqual(self.get_ranges(), [(date(2016, 2, 1), date(2016, 2, 28)), (date(2016, 2, 29), date(2016, 3, 31)),
+                                             (date(2016, 4, 1), date(2016, 4, 3))])
+        self.assert_days_kept(date(2016, 2, 1), date(2016, 4, 1))
+
+    def test_append_file(self):
+        day = date(2016, 2, 1)
+        make_day_analysis(day).save(filename="day.json.xz", output_prefix=self.archive_dir, do_index=True)
+        filepath = os.path.join(self.archive_dir, "day.json.xz")
+        self.assertTrue(self.archive.append_file(filepath, day))
+        partition = self.archive.get_partitions()[0]
+        self.assertEqual(partition.filename, "2016-02-01.2016-02-01{0}".format(archive.PARTITION_SUFFIX))
+        self.assertIsNotNone(analysis.load_analysis_index(partition.filepath))
+        self.assertEqual(to_json(partition.load().json_db), to_json(make_day_analysis(day).json_db))
+
+        # a day that was compacted is not archived again
+        self.append_days(date(2016, 2, 2), date(2016, 2, 7))
+        self.archive.compact(period='week', today=date(2016, 2, 8))
+        self.assertFalse(self.archive.append_file(filepath, day))
+        self.assert_days_kept(date(2016, 2, 1), date(2016, 2, 7))
+
+class TestMemoryBudget(unittest.TestCase):
+
+    def setUp(self):
+        self.archive_dirs = [tempfile.mkdtemp(prefix="onionperf.test.") for i in xrange(2)]
+        self.spill_check_interval = analysis.SPILL_CHECK_INTERVAL
+        analysis.SPILL_CHECK_INTERVAL = 1
+
+    def tearDown(self):
+        analysis.SPILL_CHECK_INTERVAL = self.spill_check_interval
+        for archive_dir in self.archive_dirs:
+            shutil.rmtree(archive_dir)
+
+    def test_merge(self):
+        merged = make_day_analysis(date(2016, 2, 1))
+        for day in get_days(date(2016, 2, 2), date(2016, 2, 7)):
+            merged.merge(make_day_analysis(day), memory_budget=0)
+        transfers = merged.json_db['data']['op-ab']['tgen']['transfers']
+        # the records are on disk, and the ids that repeat on every day get new ones
+        self.assertIsInstance(transfers, analysis.SpilledRecords)
+        self.assertEqual(len(transfers.records), 0)
+        self.assertEqual(len(transfers), 35)
+        self.assertEqual(transfers["transfer1-6"], {'unix_ts_start': get_day_ts(date(2016, 2, 7)) + 1})
+
+    def test_compact(self):
+        # the partitions that are compacted with and without a budget are the same
+        for (archive_dir, memory_budget) in zip(self.archive_dirs, [None, 0]):
+            a = archive.AnalysisArchive(archive_dir, memory_budget=memory_budget)
+            for day in get_days(date(2016, 2, 1), date(2016, 2, 7)):
+                a.append(make_day_analysis(day), day)
+            a.compact(period='week', today=date(2016, 2, 8))
+        partitions = [archive.AnalysisArchive(archive_dir).get_partitions() for archive_dir in self.archive_dirs]
+        self.assertEqual([p.filename for p in partitions[0]], [p.filename for p in partitions[1]])
+        self.assertEqual(len(partitions[0]), 1)
+        self.assertEqual(partitions[0][0].load().json_db, partitions[1][0].load().json_db)
+
+    def test_compact_sections(self):
+        # compacting reads the indexed partitions a section at a time, never a whole partition
+        a = archive.AnalysisArchive(self.archive_dirs[0], memory_budget=0)
+        for day in get_days(date(2016, 2, 1), date(2016, 2, 7)):
+            a.append(make_day_analysis(day), day)
+        node_ranges = [analysis.load_analysis_index(p.filepath)['nodes']['op-ab']['range'] for p in a.get_partitions()]
+        reads, read = [], util.ByteRangeReader.read
+        def record_read(reader, start, end):
+            reads.append((start, end))
+            return read(reader, start, end)
+        util.ByteRangeReader.read = record_read
+        try:
+            a.compact(period='week', today=date(2016, 2, 8))
+        finally:
+            util.ByteRangeReader.read = read
+        # the two sections of each day, whose measurement_ip is kept in the index
+        self.assertEqual(len(reads), 7 * 2)
+        for (start, end) in node_ranges:
+            self.assertNotIn((start, end), reads)
+
+        merged = make_day_analysis(date(2016, 2, 1))
+        for day in get_days(date(2016, 2, 2), date(2016, 2, 7)):
+            merged.merge(make_day_analysis(day))
+        self.assertEqual(to_json(a.get_partitions()[0].load().json_db), to_json(merged.json_db))
+
+@unittest.skipUnless(measurement is not None, "the measurement dependencies are not installed")
+class TestNightlyAnalysis(SyntheticLogsTestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix="onionperf.test.")
+        self.pythonpath = os.environ.get('PYTHONPATH')
+        # the analyze process imports this tree
+        os.environ['PYTHONPATH'] = os.path.dirname(os.path.dirname(os.path.abspath(analysis.__file__)))
+
+    def tearDown(self):
+        if self.pythonpath is None:
+            del os.environ['PYTHONPATH']
+        else:
+            os.environ['PYTHONPATH'] = self.pythonpath
+        shutil.rmtree(self.work_dir)
+
+    def test_analyze_command(self):
+        docroot = os.path.join(self.work_dir, "htdocs")
+        analysis_archive = archive.AnalysisArchive(os.path.join(self.work_dir, "archive"))
+        onionperf_cmd = [sys.executable, os.path.join(os.path.dirname(analysis.__file__), "onionperf")]
+        day = SYNTHETIC_DATES[1]
+        cmd = measurement.get_analyze_command(onionperf_cmd, self.tgen_path, self.torctl_path, docroot, "op-ab", '10.0.0.1', day,
+                                              memory_budget=0, do_index=True)
+        self.assertTrue(measurement.run_analyze_command(cmd, threading.Event()))
+
+        expected = load_expected("baseline.full.{0}.json.xz".format(day.isoformat()))
+        filepath = os.path.join(docroot, "{0}.onionperf.analysis.json.xz".format(day.isoformat()))
+        self.assertEqual(to_json(analysis.Analysis.load(filename=filepath).json_db), expected)
+        self.assertTrue(any(name.endswith("-{0}.tpf".format(day.isoformat())) for name in os.listdir(docroot)))
+
+        # the results that were saved with an index go into the archive as they are
+        self.assertTrue(analysis_archive.append_file(filepath, day))
+        self.assertEqual(to_json(analysis_archive.load_range(day, day)[0].json_db), expected)
+
+        # a failed analysis raises, and a stopped one returns False
+        self.assertRaises(measurement.subprocess.CalledProcessError, measurement.run_analyze_command, onionperf_cmd + ["analyze", "--bogus"], threading.Event())
+        done_ev = threading.Event()
+        done_ev.set()
+        self.assertFalse(measurement.run_analyze_command(cmd, done_ev))
+
+if __name__ == '__main__':
+    unittest.main()
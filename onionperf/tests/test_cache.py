@@ -0,0 +1,86 @@
+'''
+  OnionPerf
+  Authored by Rob Jansen, 2015
+  See LICENSE for licensing information
+'''
+
+import os, shutil, tempfile, unittest, cPickle
+
+from onionperf import analysis
+from onionperf.tests.test_parsers import SyntheticLogsTestCase, to_json
+
+def split_file(filepath, directory):
+    # writes the first and second half of the lines of filepath to two files in directory
+    with open(filepath, 'rb') as f:
+        lines = f.readlines()
+    name = os.path.basename(filepath)
+    paths = [os.path.join(directory, "{0}.{1}".format(name, i)) for i in [1, 2]]
+    for (path, part) in zip(paths, [lines[:len(lines) / 2], lines[len(lines) / 2:]]):
+        with open(path, 'wb') as f:
+            f.writelines(part)
+    return paths
+
+class TestParseCache(SyntheticLogsTestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix="onionperf.test.")
+        self.cache_dir = os.path.join(self.work_dir, "cache")
+        self.tgen_paths = split_file(self.tgen_path, self.work_dir)
+        self.torctl_paths = split_file(self.torctl_path, self.work_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def analyze_split(self, **kwargs):
+        a = analysis.Analysis(ip_address='10.0.0.1')
+        for path in self.tgen_paths:
+            a.add_tgen_file(path)
+        for path in self.torctl_paths:
+            a.add_torctl_file(path)
+        a.analyze(do_simple=False, **kwargs)
+        return to_json(a.json_db)
+
+    def get_entries(self):
+        # the modification time of the entry of each log file
+        entries = {}
+        for name in os.listdir(self.cache_dir):
+            entry_path = os.path.join(self.cache_dir, name)
+            with open(entry_path, 'rb') as f:
+                header = cPickle.load(f)
+            entries[header['file'][0]] = os.stat(entry_path).st_mtime
+        return entries
+
+    def test_one_entry_per_file(self):
+        expected = self.analyze_split()
+        self.assertEqual(self.analyze_split(parse_cache=analysis.ParseCache(self.cache_dir)), expected)
+        cold = self.get_entries()
+        self.assertEqual(sorted(cold.keys()), sorted(self.tgen_paths + self.torctl_paths))
+
+        # backdate the entries, so that we see which ones are written again
+        for name in os.listdir(self.cache_dir):
+            os.utime(os.path.join(self.cache_dir, name), (0, 0))
+        self.assertEqual(self.analyze_split(parse_cache=analysis.ParseCache(self.cache_dir)), expected)
+        self.assertEqual(set(self.get_entries().values()), set([0]))
+
+        # a changed file is parsed again, and only its entry is replaced
+        os.utime(self.tgen_paths[1], (1454544000, 1454544000))
+        self.assertEqual(self.analyze_split(parse_cache=analysis.ParseCache(self.cache_dir)), expected)
+        warm = self.get_entries()
+        self.assertEqual(len(warm), 4)
+        self.assertEqual([path for path in sorted(warm.keys()) if warm[path] != 0], [self.tgen_paths[1]])
+
+    def test_num_procs(self):
+        expected = self.analyze_split()
+        for i in xrange(2):
+            self.assertEqual(self.analyze_split(parse_cache=analysis.ParseCache(self.cache_dir), num_procs=2), expected)
+        self.assertEqual(len(self.get_entries()), 4)
+
+    def test_prune(self):
+        parse_cache = analysis.ParseCache(self.cache_dir)
+        self.analyze_split(parse_cache=parse_cache)
+        os.remove(self.torctl_paths[0])
+        self.assertEqual(parse_cache.prune(), 1)
+        self.assertEqual(sorted(self.get_entries().keys()), sorted(self.tgen_paths + self.torctl_paths[1:]))
+
+if __name__ == '__main__':
+    unittest.main()
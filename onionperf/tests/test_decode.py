@@ -0,0 +1,112 @@
+'''
+  OnionPerf
+  Authored by Rob Jansen, 2015
+  See LICENSE for licensing information
+'''
+
+import unittest
+
+from stem.response import ControlMessage, convert
+
+from onionperf import analysis
+from onionperf.tests.test_parsers import SyntheticLogsTestCase
+
+PREFIX = "2016-02-03 20:00:00 1454529600.25"
+
+# well-formed and malformed BW events, as the monitor logs them and otherwise
+BW_LINES = ["{0} 650 BW 1234 5678\r\n", "{0} 650 BW 0 0\r\n", "{0} 650 BW 123456789012 98765\r\n",
+            "{0} 650 BW 10 20 TCP=1,2\r\n", "{0} 650 BW 1234 5678\n", "{0} 650 BW 1234 5678",
+            "{0} 650 BW 12  34\r\n", "{0} 650 BW 12\t34\r\n", "{0} 650  BW 12 34\r\n",
+            "{0} 650 BW 12 not-a-number\r\n", "{0} 650 BW -1 5\r\n", "{0} 650 BW +1 5\r\n",
+            "{0} 650 BW 12\r\n", "{0} 650 BW\r\n", "{0} 650 BWX 1 2\r\n", "{0} 650 BW 1.5 2\r\n",
+            "{0} 650 CIRC_BW ID=1 READ=10 WRITTEN=20\r\n", "{0} 651 BW 1 2\r\n",
+            "2016-02-03 20:00:00 abc 650 BW 1 2\r\n", "2016-02-03 20:00:00 650 BW 1 2\r\n"]
+
+def decode_bw_line_with_stem(line):
+    # what TorCtlParser does with a line when it decodes it with stem
+    timestamps, sep, raw_event_str = line.partition(" 650 ")
+    if sep == '':
+        return None
+    try:
+        unix_ts = float(timestamps.strip().split()[2])
+        event = ControlMessage.from_str("{0} {1}".format(sep.strip(), raw_event_str))
+        convert('EVENT', event)
+    except Exception:
+        return None
+    if event.type != 'BW':
+        return None
+    return unix_ts, event.read, event.written
+
+class TestDecodeBWLine(unittest.TestCase):
+
+    def test_same_as_stem(self):
+        # lines that we decode must decode to the same values with stem, the others are left to stem
+        num_decoded = 0
+        for line in [l.format(PREFIX) for l in BW_LINES]:
+            decoded = analysis.decode_bw_line(line)
+            if decoded is not None:
+                num_decoded += 1
+                self.assertEqual(decoded, decode_bw_line_with_stem(line), repr(line))
+        self.assertEqual(num_decoded, 3)
+
+    def test_malformed(self):
+        for line in [l.format(PREFIX) for l in BW_LINES[9:]]:
+            self.assertIsNone(analysis.decode_bw_line(line), repr(line))
+            self.assertIsNone(decode_bw_line_with_stem(line), repr(line))
+
+    def test_parser(self):
+        # the bandwidth of a full parse is the same as if stem had decoded every line
+        parser = analysis.TorCtlParser()
+        expected = {'bytes_read': {}, 'bytes_written': {}}
+        for (i, line) in enumerate([l.format(PREFIX) for l in BW_LINES]):
+            # give each line its own second, as the bandwidth is kept per second
+            line = line.replace("1454529600.25", "{0}.25".format(1454529600 + i))
+            try:
+                parser.parse_line(line, do_simple=False)
+            except Exception:
+                # parse() skips the lines that stem fails to decode
+                pass
+            decoded = decode_bw_line_with_stem(line)
+            if decoded is not None:
+                expected['bytes_read'][int(decoded[0])] = decoded[1]
+                expected['bytes_written'][int(decoded[0])] = decoded[2]
+        self.assertEqual(parser.get_data()['bandwidth_summary'], expected)
+
+# events that the synthetic logs do not have, as tor writes them
+TORCTL_EVENTS = ["CIRC 7 BUILT $C386BBC4CD613E30D8F16ADF91B7584A2265B1F5=nC386,$C324C9859B810E766EC9D28663CA828DD5F4B3B2~nC324,nEDE BUILD_FLAGS=IS_INTERNAL,NEED_CAPACITY PURPOSE=HS_CLIENT_REND HS_STATE=HSCR_JOINED REND_QUERY=abcdefghijklmnop TIME_CREATED=2016-02-04T00:00:01.000000",
+                 "CIRC 8 EXTENDED $C386BBC4CD613E30D8F16ADF91B7584A2265B1F5 BUILD_FLAGS=NEED_CAPACITY PURPOSE=HS_SERVICE_INTRO HS_STATE=HSSI_CONNECTING",
+                 "CIRC 9 FAILED REASON=TIMEOUT",
+                 "CIRC_MINOR 7 CANNIBALIZED $C386BBC4CD613E30D8F16ADF91B7584A2265B1F5~nC386 BUILD_FLAGS=NEED_CAPACITY PURPOSE=HS_CLIENT_INTRO HS_STATE=HSCI_CONNECTING OLD_PURPOSE=GENERAL",
+                 "STREAM 12 NEWRESOLVE 0 www.torproject.org:0 SOURCE_ADDR=127.0.0.1:45678 PURPOSE=DNS_REQUEST",
+                 "STREAM 12 CLOSED 7 www.torproject.org:443 REASON=END REMOTE_REASON=DONE",
+                 "STREAM 13 NEW 0 1.2.3.4:80 SOURCE_ADDR=\"127.0.0.1:1\" PURPOSE=USER",
+                 "BUILDTIMEOUT_SET RESET TOTAL_TIMES=0 TIMEOUT_MS=60000 XM=0 ALPHA=0.000000 CUTOFF_QUANTILE=0.800000 TIMEOUT_RATE=0.000000 CLOSE_MS=60000 CLOSE_RATE=0.000000",
+                 "BUILDTIMEOUT_SET COMPUTED TIMEOUT_MS=1500"]
+
+def decode_torctl_event_with_stem(raw_event_str):
+    event = ControlMessage.from_str("650 {0}\r\n".format(raw_event_str))
+    convert('EVENT', event)
+    return event
+
+class TestDecodeTorCtlEvent(SyntheticLogsTestCase):
+
+    def test_same_as_stem(self):
+        with open(self.torctl_path, 'r') as f:
+            raw_events = [line.partition(" 650 ")[2].rstrip() for line in f if " 650 " in line]
+        num_decoded = 0
+        for raw_event_str in raw_events + TORCTL_EVENTS:
+            event = analysis.decode_torctl_event(raw_event_str)
+            if event is None:
+                continue
+            num_decoded += 1
+            stem_event = decode_torctl_event_with_stem(raw_event_str)
+            self.assertEqual(event.type, stem_event.type)
+            positional_names, keyword_names = analysis.TORCTL_EVENT_FIELDS[event.type]
+            for name in list(positional_names) + [name for (keyword, name) in keyword_names]:
+                self.assertEqual(getattr(event, name), getattr(stem_event, name), "{0} of {1}".format(name, raw_event_str))
+        # quoted values are left to stem
+        self.assertIsNone(analysis.decode_torctl_event(TORCTL_EVENTS[6]))
+        self.assertTrue(num_decoded > len(TORCTL_EVENTS))
+
+if __name__ == '__main__':
+    unittest.main()
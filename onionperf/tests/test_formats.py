@@ -0,0 +1,307 @@
+'''
+  OnionPerf
+  Authored by Rob Jansen, 2015
+  See LICENSE for licensing information
+'''
+
+import os, json, shutil, tempfile, unittest, subprocess
+from cStringIO import StringIO
+
+from onionperf import analysis, util
+from onionperf.tests.synthetic import SYNTHETIC_DATES
+from onionperf.tests.test_parsers import SyntheticLogsTestCase, load_expected, to_json
+from onionperf.tests.test_xz import has_xz_tool, read_source
+
+class SavedAnalysisTestCase(SyntheticLogsTestCase):
+    ''' gives its tests an analysis of the synthetic logs and a directory to save it in '''
+
+    @classmethod
+    def setUpClass(cls):
+        SyntheticLogsTestCase.setUpClass()
+        cls.expected = load_expected("baseline.full.json.xz")
+
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp(prefix="onionperf.test.")
+        self.anal = self.analyze(do_simple=False)
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+class TestColumnar(SavedAnalysisTestCase):
+
+    def test_round_trip(self):
+        self.anal.save(output_prefix=self.output_dir, do_columnar=True)
+        # only the requested format is written
+        self.assertEqual(os.listdir(self.output_dir), ["onionperf.analysis.npz"])
+        loaded = analysis.Analysis.load(filename="onionperf.analysis.npz", input_prefix=self.output_dir)
+        self.assertEqual(loaded.get_nodes(), ["op-ab"])
+        self.assertEqual(to_json(loaded.get_tgen_transfers_summary("op-ab")), self.expected['data']['op-ab']['tgen']['transfers_summary'])
+        self.assertEqual(to_json(loaded.get_tor_bandwidth_summary("op-ab", 'bytes_read')), self.expected['data']['op-ab']['tor']['bandwidth_summary']['bytes_read'])
+        self.assertEqual(to_json(loaded.json_db), self.expected)
+
+class ListWritable(object):
+    ''' collects the messages written to it '''
+
+    def __init__(self):
+        self.msgs = []
+
+    def write(self, msg):
+        self.msgs.append(msg)
+
+def dump_json(obj, sort_keys=True, buffer_size=None):
+    # the output of util.write_json, written in chunks of about buffer_size bytes
+    write_buffer_size = util.JSON_WRITE_BUFFER_SIZE
+    if buffer_size is not None:
+        util.JSON_WRITE_BUFFER_SIZE = buffer_size
+    try:
+        writable = ListWritable()
+        util.write_json(obj, writable, sort_keys=sort_keys, indent=2)
+    finally:
+        util.JSON_WRITE_BUFFER_SIZE = write_buffer_size
+    return writable.msgs
+
+class TestWriteJSON(SavedAnalysisTestCase):
+
+    def test_analysis(self):
+        for do_simple in [False, True]:
+            db = self.analyze(do_simple=do_simple).json_db
+            for sort_keys in [True, False]:
+                expected = json.dumps(db, sort_keys=sort_keys, separators=(',', ': '), indent=2)
+                self.assertEqual(''.join(dump_json(db, sort_keys=sort_keys)), expected)
+            # the output is written in chunks of about the buffer size
+            msgs = dump_json(db, buffer_size=4096)
+            self.assertTrue(len(msgs) > 1)
+            self.assertEqual(''.join(msgs), json.dumps(db, sort_keys=True, separators=(',', ': '), indent=2))
+
+    def test_values(self):
+        db = {'type': 'onionperf', 'data': {1.5: {2: {'a': {'b': {'c': {'d': [1, {}, []]}}}}, -3: {}},
+              'empty': {}, u'caf\xe9': {u'line\none': u'\u2603', 'list': [], 'none': None}, True: 1e100}}
+        for sort_keys in [True, False]:
+            expected = json.dumps(db, sort_keys=sort_keys, separators=(',', ': '), indent=2)
+            self.assertEqual(''.join(dump_json(db, sort_keys=sort_keys)), expected)
+
+    def test_save(self):
+        self.anal.save(filename="onionperf.analysis.json", output_prefix=self.output_dir, do_compress=False)
+        with open(os.path.join(self.output_dir, "onionperf.analysis.json"), 'rb') as f:
+            self.assertEqual(f.read(), json.dumps(self.anal.json_db, sort_keys=True, separators=(',', ': '), indent=2))
+
+def read_stream(reader):
+    # decodes the next value of reader one object member at a time
+    if reader.peek() == '{':
+        return {key: read_stream(reader) for key in reader.iter_object()}
+    return reader.read_value()
+
+class TwoNodesTestCase(SavedAnalysisTestCase):
+    ''' adds a second node to the analysis, so that there is one to leave out when loading '''
+
+    def setUp(self):
+        SavedAnalysisTestCase.setUp(self)
+        self.anal.json_db['data']['op-cd'] = json.loads(json.dumps(self.anal.json_db['data']['op-ab']))
+        self.db = to_json(self.anal.json_db)
+
+    def get_node_db(self, node):
+        # the database as it is loaded with only node
+        db = dict(self.db)
+        db['data'] = {node: self.db['data'][node]}
+        return db
+
+class TestSections(TwoNodesTestCase):
+
+    def test_stream_reader(self):
+        text = json.dumps(self.db, sort_keys=True, separators=(',', ': '), indent=2)
+        for buffer_size in [1, 7, 4096, 1024 * 1024]:
+            self.assertEqual(read_stream(util.JSONStreamReader(StringIO(text), buffer_size=buffer_size)), self.db)
+            reader = util.JSONStreamReader(StringIO(text), buffer_size=buffer_size)
+            kept = {}
+            for key in reader.iter_object():
+                if key == 'data':
+                    reader.skip_value()
+                else:
+                    kept[key] = reader.read_value()
+            self.assertEqual(kept, {k: self.db[k] for k in self.db if k != 'data'})
+
+    def test_load(self):
+        for (filename, do_compress) in [("onionperf.analysis.json", False), ("onionperf.analysis.json.xz", True)]:
+            self.anal.save(filename=filename, output_prefix=self.output_dir, do_compress=do_compress)
+            loaded = analysis.Analysis.load(filename=filename, input_prefix=self.output_dir, sections=analysis.SUMMARY_SECTIONS, nodes=["op-cd"])
+            self.assertIsInstance(loaded.section_db, analysis.JSONSectionDB)
+            self.assertEqual(loaded.get_nodes(), ["op-cd"])
+            # only the requested sections were read
+            self.assertEqual(sorted(loaded.section_db.data['op-cd'].keys()), ['measurement_ip', 'tgen', 'tor'])
+            self.assertEqual(loaded.section_db.data['op-cd']['tgen'].keys(), ['transfers_summary'])
+            self.assertEqual(loaded.section_db.data['op-cd']['tor'].keys(), ['bandwidth_summary'])
+            node_db = self.db['data']['op-cd']
+            for (parent_key, section_key) in analysis.SUMMARY_SECTIONS + [('tgen', 'transfers'), ('tor', 'circuits')]:
+                self.assertEqual(loaded.get_section("op-cd", parent_key, section_key), node_db[parent_key][section_key])
+            self.assertEqual(loaded.get_tgen_transfers_summary("op-ab"), None)
+            # the whole database is read on demand, still without the other node
+            self.assertEqual(loaded.json_db, self.get_node_db("op-cd"))
+
+@unittest.skipUnless(has_xz_tool(), "the xz tool is not installed")
+class TestIndex(TwoNodesTestCase):
+
+    def setUp(self):
+        TwoNodesTestCase.setUp(self)
+        # the analysis is small, so use small blocks to have several of them
+        self.xz_block_size = util.XZ_BLOCK_SIZE
+        util.XZ_BLOCK_SIZE = 65536
+        self.lzma = util.lzma
+
+    def tearDown(self):
+        util.XZ_BLOCK_SIZE = self.xz_block_size
+        util.lzma = self.lzma
+        TwoNodesTestCase.tearDown(self)
+
+    def save(self, filename, do_compress, do_index, name=""):
+        # uncompressed saves append to an existing file, so every save goes to a new directory
+        output_prefix = os.path.join(self.output_dir, name, "indexed" if do_index else "plain")
+        self.anal.save(filename=filename, output_prefix=output_prefix, do_compress=do_compress, do_index=do_index)
+        return os.path.join(output_prefix, filename)
+
+    def test_load(self):
+        # None writes and reads the blocks with the xz tool
+        for lzma in ([self.lzma] if self.lzma is not None else []) + [None]:
+            util.lzma = lzma
+            for (filename, do_compress) in [("onionperf.analysis.json", False), ("onionperf.analysis.json.xz", True)]:
+                name = "lzma" if lzma is not None else "xz"
+                plain_path = self.save(filename, do_compress, False, name=name)
+                indexed_path = self.save(filename, do_compress, True, name=name)
+                self.assertFalse(os.path.exists(analysis.get_analysis_index_path(plain_path)))
+                self.assertTrue(os.path.exists(analysis.get_analysis_index_path(indexed_path)))
+                text = read_source(plain_path)
+                self.assertEqual(read_source(indexed_path), text)
+                if do_compress and self.lzma is not None:
+                    self.assertTrue(len(util.find_xz_blocks(indexed_path)) > 1)
+
+                reader = util.ByteRangeReader(indexed_path)
+                for (start, end) in [(0, 10), (65530, 65600), (100, 200000), (len(text) - 5, len(text))]:
+                    self.assertEqual(reader.read(start, end), text[start:end])
+                reader.close()
+
+                loaded = analysis.Analysis.load(filename=indexed_path, sections=analysis.SUMMARY_SECTIONS, nodes=["op-cd"])
+                self.assertIsInstance(loaded.section_db, analysis.IndexedJSONDB)
+                self.assertEqual(loaded.get_nodes(), ["op-cd"])
+                node_db = self.db['data']['op-cd']
+                for (parent_key, section_key) in analysis.SUMMARY_SECTIONS + [('tgen', 'transfers'), ('tor', 'circuits')]:
+                    self.assertEqual(loaded.get_section("op-cd", parent_key, section_key), node_db[parent_key][section_key])
+                self.assertEqual(loaded.json_db, self.get_node_db("op-cd"))
+
+    def test_stale_index(self):
+        filepath = self.save("onionperf.analysis.json.xz", True, True)
+        # the file is replaced by one without blocks, whose size differs from the indexed one
+        self.anal.save(filename=os.path.basename(filepath), output_prefix=os.path.dirname(filepath), do_compress=True)
+        loaded = analysis.Analysis.load(filename=filepath, sections=analysis.SUMMARY_SECTIONS)
+        self.assertIsInstance(loaded.section_db, analysis.JSONSectionDB)
+        self.assertEqual(loaded.json_db, self.db)
+
+def sort_pairs(pairs):
+    return sorted(pairs, key=lambda (node, record): (node, json.dumps(record, sort_keys=True)))
+
+class TestSQLite(TwoNodesTestCase):
+
+    def walk(self, db, section_key, node=None, start=None, end=None, match=lambda record: True):
+        # the (node, record) pairs that the query methods should find
+        parent_key = 'tgen' if section_key == 'transfers' else 'tor'
+        return sort_pairs([(name, record) for name in db['data'] if node is None or name == node
+                           for record in db['data'][name][parent_key][section_key].values()
+                           if (start is None or record['unix_ts_start'] >= start) and (end is None or record['unix_ts_start'] < end) and match(record)])
+
+    def check_queries(self, anal, db):
+        start, end = util.date_to_timestamp_range(SYNTHETIC_DATES[1])
+        checks = [
+            (anal.query_transfers(node="op-cd", start=start, end=end, filesize=5242880, is_error=True),
+             self.walk(db, 'transfers', "op-cd", start, end, lambda r: r['filesize_bytes'] == 5242880 and r['is_error'])),
+            (anal.query_transfers(error_code="READ"), self.walk(db, 'transfers', match=lambda r: r['error_code'] == "READ")),
+            (anal.query_transfers(start=start, is_error=False), self.walk(db, 'transfers', start=start, match=lambda r: not r['is_error'])),
+            (anal.query_circuits(node="op-ab", is_failed=True), self.walk(db, 'circuits', "op-ab", match=lambda r: 'failure_reason_local' in r)),
+            (anal.query_streams(target="1.2.3.4:8080", is_failed=False), self.walk(db, 'streams', match=lambda r: r['target'] == "1.2.3.4:8080" and 'failure_reason_local' not in r)),
+            (anal.query_streams(circuit_id=56), self.walk(db, 'streams', match=lambda r: r['circuit_id'] == "56"))]
+        # a relay is found by its fingerprint or by its nickname
+        relay = db['data']['op-ab']['tor']['circuits']['56']['path'][1][0]
+        on_relay = lambda r: relay in [name for (name, elapsed) in r.get('path', [])]
+        checks.append((anal.query_circuits(relay=relay.split('~')[0]), self.walk(db, 'circuits', match=on_relay)))
+        checks.append((anal.query_circuits(relay=relay.split('~')[1], end=end), self.walk(db, 'circuits', end=end, match=on_relay)))
+        for (found, expected) in checks:
+            self.assertTrue(len(expected) > 0)
+            self.assertEqual(sort_pairs(found), expected)
+
+        bandwidth = db['data']['op-cd']['tor']['bandwidth_summary']
+        expected = sorted([("op-cd", int(ts), bandwidth['bytes_read'].get(ts), bandwidth['bytes_written'].get(ts))
+                           for ts in set(bandwidth['bytes_read']) | set(bandwidth['bytes_written']) if start <= int(ts) < end])
+        self.assertTrue(len(expected) > 0)
+        self.assertEqual(anal.query_bandwidth(node="op-cd", start=start, end=end), expected)
+
+    def test_round_trip(self):
+        simple = self.analyze(do_simple=True)
+        for (anal, db) in [(self.anal, self.db), (simple, to_json(simple.json_db))]:
+            anal.save(filename="onionperf.analysis.sqlite", output_prefix=self.output_dir, do_sqlite=True)
+            loaded = analysis.Analysis.load(filename="onionperf.analysis.sqlite", input_prefix=self.output_dir)
+            self.assertIsInstance(loaded.section_db, analysis.SQLiteDB)
+            self.assertEqual(loaded.get_nodes(), sorted(db['data'].keys()))
+            self.assertEqual(loaded.get_section("op-ab", 'tgen', 'transfers_summary'), db['data']['op-ab']['tgen']['transfers_summary'])
+            self.assertEqual(loaded.json_db, db)
+
+    def test_queries(self):
+        self.anal.save(filename="onionperf.analysis.sqlite", output_prefix=self.output_dir, do_sqlite=True)
+        # the queries of a loaded file and of an analysis in memory find the same records
+        self.check_queries(analysis.Analysis.load(filename="onionperf.analysis.sqlite", input_prefix=self.output_dir), self.db)
+        self.check_queries(self.anal, self.db)
+
+        loaded = analysis.Analysis.load(filename="onionperf.analysis.sqlite", input_prefix=self.output_dir, nodes=["op-cd"])
+        self.assertEqual(set(node for (node, record) in loaded.query_transfers()), set(["op-cd"]))
+
+        # the in-memory copy is dropped when the data changes
+        other = analysis.Analysis()
+        other.json_db['data']['op-ef'] = self.db['data']['op-ab']
+        self.anal.merge(other)
+        self.assertEqual(len(self.anal.query_transfers(node="op-ef")), len(self.db['data']['op-ab']['tgen']['transfers']))
+
+@unittest.skipUnless(has_xz_tool(), "the xz tool is not installed")
+class TestThreadedSave(TwoNodesTestCase):
+
+    def setUp(self):
+        TwoNodesTestCase.setUp(self)
+        self.xz_block_size = util.XZ_BLOCK_SIZE
+        util.XZ_BLOCK_SIZE = 65536
+        self.lzma = util.lzma
+
+    def tearDown(self):
+        util.XZ_BLOCK_SIZE = self.xz_block_size
+        util.lzma = self.lzma
+        TwoNodesTestCase.tearDown(self)
+
+    def save(self, name, **kwargs):
+        output_prefix = os.path.join(self.output_dir, name)
+        self.anal.save(filename="onionperf.analysis.json.xz", output_prefix=output_prefix, **kwargs)
+        return os.path.join(output_prefix, "onionperf.analysis.json.xz")
+
+    @unittest.skipIf(util.lzma is None, "no lzma module")
+    def test_blocks(self):
+        # the blocks are compressed in any order, and written in the order of their data
+        single_path = self.save("single", do_index=True)
+        indexed_path = self.save("threaded", do_index=True, num_threads=4)
+        with open(single_path, 'rb') as f:
+            single = f.read()
+        with open(indexed_path, 'rb') as f:
+            self.assertEqual(f.read(), single)
+        self.assertTrue(len(util.find_xz_blocks(indexed_path)) > 4)
+        loaded = analysis.Analysis.load(filename=indexed_path, sections=analysis.SUMMARY_SECTIONS)
+        self.assertIsInstance(loaded.section_db, analysis.IndexedJSONDB)
+        self.assertEqual(loaded.get_section("op-cd", 'tor', 'circuits'), self.db['data']['op-cd']['tor']['circuits'])
+
+        # without an index, the threaded file is also made of blocks
+        threaded_path = self.save("threaded_noindex", num_threads=4)
+        self.assertTrue(len(util.find_xz_blocks(threaded_path)) > 4)
+        self.assertEqual(subprocess.call(["xz", "-t", threaded_path]), 0)
+        self.assertEqual(subprocess.check_output(["xz", "-dc", threaded_path]), subprocess.check_output(["xz", "-dc", single_path]))
+        self.assertEqual(analysis.Analysis.load(filename=threaded_path).json_db, self.db)
+
+    def test_xz_tool(self):
+        # without lzma, the xz tool compresses on the threads
+        util.lzma = None
+        threaded_path = self.save("threaded", num_threads=4)
+        self.assertEqual(subprocess.call(["xz", "-t", threaded_path]), 0)
+        self.assertEqual(analysis.Analysis.load(filename=threaded_path).json_db, self.db)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,236 @@
+'''
+  OnionPerf
+  Authored by Rob Jansen, 2015
+  See LICENSE for licensing information
+'''
+
+import os, shutil, tempfile, unittest, datetime, random, cPickle
+
+from onionperf import analysis, util
+from onionperf.tests.synthetic import SYNTHETIC_DATES
+from onionperf.tests.test_parsers import SyntheticLogsTestCase, load_expected, to_json
+
+def parse_serially(parser, filepath, do_simple):
+    parser.parse(util.DataSource(filepath), do_simple=do_simple)
+    return to_json(parser.get_data())
+
+class CountingParser(object):
+    ''' wraps the parse method of parser, to count the parses that it runs itself '''
+
+    def __init__(self, parser):
+        self.num_parses = 0
+        self.parse = parser.parse
+        parser.parse = self
+
+    def __call__(self, *args, **kwargs):
+        self.num_parses += 1
+        return self.parse(*args, **kwargs)
+
+class TestChunkedParse(SyntheticLogsTestCase):
+
+    def test_analyze(self):
+        for num_chunks in [2, 3, 7, 16]:
+            self.assertEqual(to_json(self.analyze(do_simple=False, num_chunks=num_chunks).json_db), load_expected("baseline.full.json.xz"))
+            self.assertEqual(to_json(self.analyze(do_simple=True, num_chunks=num_chunks).json_db), load_expected("baseline.simple.json.xz"))
+
+    def test_date_filter(self):
+        for date in SYNTHETIC_DATES:
+            for (parser_class, filepath) in [(analysis.TGenParser, self.tgen_path), (analysis.TorCtlParser, self.torctl_path)]:
+                expected = parse_serially(parser_class(date_filter=date), filepath, False)
+                parser = parser_class(date_filter=date)
+                parser.parse_chunked(filepath, do_simple=False, num_chunks=3)
+                self.assertEqual(to_json(parser.get_data()), expected)
+
+    def test_memory_budget(self):
+        spill_check_interval = analysis.SPILL_CHECK_INTERVAL
+        analysis.SPILL_CHECK_INTERVAL = 1
+        try:
+            for (parser_class, filepath) in [(analysis.TGenParser, self.tgen_path), (analysis.TorCtlParser, self.torctl_path)]:
+                # every segment of a chunk spills its records, also after the first cut, and through the pool
+                (start, end) = util.find_line_chunks(filepath, 3)[1]
+                chunk = analysis.subproc_parse_chunk_func((parser_class(memory_budget=0), filepath, start, end, False))
+                chunk = cPickle.loads(cPickle.dumps(chunk, cPickle.HIGHEST_PROTOCOL))
+                self.assertTrue(len(chunk.segments) > 1)
+                for segment in chunk.segments:
+                    for name in parser_class.RECORD_ATTRIBUTES:
+                        self.assertIsInstance(segment['data'][name], analysis.SpilledRecords)
+                        self.assertEqual(len(segment['data'][name].records), 0)
+
+                parser = parser_class(memory_budget=0)
+                parser.parse_chunked(filepath, do_simple=False, num_chunks=3)
+                self.assertEqual(to_json(parser.get_data()), parse_serially(parser_class(), filepath, False))
+        finally:
+            analysis.SPILL_CHECK_INTERVAL = spill_check_interval
+
+    def test_reused_id(self):
+        # circuit 70 is launched at the start of the log and again in the last chunk, while it is still open
+        work_dir = tempfile.mkdtemp(prefix="onionperf.test.")
+        try:
+            filepath = os.path.join(work_dir, "onionperf.torctl.log")
+            with open(self.torctl_path, 'rb') as f:
+                lines = f.readlines()
+            prefix = " ".join(lines[0].split()[:3])
+            lines.insert(2, "{0} 650 CIRC 70 LAUNCHED BUILD_FLAGS=NEED_CAPACITY PURPOSE=GENERAL TIME_CREATED=2016-02-04T00:00:01.000000\r\n".format(prefix))
+            with open(filepath, 'wb') as f:
+                f.writelines(lines)
+
+            expected = parse_serially(analysis.TorCtlParser(), filepath, False)
+            parser = analysis.TorCtlParser()
+            counter = CountingParser(parser)
+            parser.parse_chunked(filepath, do_simple=False, num_chunks=2)
+            self.assertEqual(to_json(parser.get_data()), expected)
+            # the last chunk was parsed again serially
+            self.assertEqual(counter.num_parses, 1)
+        finally:
+            shutil.rmtree(work_dir)
+
+class TestDateSeek(SyntheticLogsTestCase):
+
+    def setUp(self):
+        # the synthetic logs are small, so seek past the head that is always parsed
+        self.head_bytes = analysis.DATE_SEEK_HEAD_BYTES
+        analysis.DATE_SEEK_HEAD_BYTES = 1000
+
+    def tearDown(self):
+        analysis.DATE_SEEK_HEAD_BYTES = self.head_bytes
+
+    def test_find_timestamp_offset(self):
+        with open(self.tgen_path, 'rb') as f:
+            lines = f.readlines()
+        offsets = [sum(len(line) for line in lines[:i]) for i in xrange(len(lines) + 1)]
+        timestamps = [float(line.split()[2]) for line in lines]
+        for ts in [0, timestamps[0], timestamps[1] - 0.5, timestamps[len(lines) / 2], timestamps[-1], timestamps[-1] + 1]:
+            # the first line at or after ts, or the end of the file
+            expected = ([offset for (offset, line_ts) in zip(offsets, timestamps) if line_ts >= ts] + [offsets[-1]])[0]
+            self.assertEqual(util.find_timestamp_offset(self.tgen_path, ts), expected)
+
+    def test_parse(self):
+        # days without data before and after the logs give the same empty results
+        dates = [SYNTHETIC_DATES[0] - datetime.timedelta(1)] + SYNTHETIC_DATES + [SYNTHETIC_DATES[-1] + datetime.timedelta(1)]
+        for date in dates:
+            for do_simple in [True, False]:
+                for (parser_class, filepath) in [(analysis.TGenParser, self.tgen_path), (analysis.TorCtlParser, self.torctl_path)]:
+                    serial_parser = parser_class(date_filter=date)
+                    expected = parse_serially(serial_parser, filepath, do_simple)
+                    parser = parser_class(date_filter=date)
+                    parser.parse_date_seek(filepath, do_simple=do_simple)
+                    self.assertEqual(to_json(parser.get_data()), expected)
+                    # the name is logged at the start of the file, before the days
+                    self.assertEqual(parser.get_name(), serial_parser.get_name())
+                    self.assertIsNotNone(parser.get_name())
+
+class TestResume(SyntheticLogsTestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix="onionperf.test.")
+        self.tgen_copy = os.path.join(self.work_dir, "onionperf.tgen.log")
+        self.torctl_copy = os.path.join(self.work_dir, "onionperf.torctl.log")
+        self.contents = []
+        for filepath in [self.tgen_path, self.torctl_path]:
+            with open(filepath, 'rb') as f:
+                self.contents.append(f.read())
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def append(self, start, end):
+        # appends the bytes between the fractions start and end of each log to its copy
+        for (filepath, content) in zip([self.tgen_copy, self.torctl_copy], self.contents):
+            with open(filepath, 'ab') as f:
+                f.write(content[int(len(content) * start):int(len(content) * end)])
+
+    def analyze_copy(self, **kwargs):
+        a = analysis.Analysis(ip_address='10.0.0.1')
+        a.add_tgen_file(self.tgen_copy)
+        a.add_torctl_file(self.torctl_copy)
+        a.analyze(do_resume=True, **kwargs)
+        return to_json(a.json_db)
+
+    def test_growing_logs(self):
+        # the appends split lines, whose rest is parsed on the next run
+        for (start, end) in [(0, 0.3), (0.3, 0.55), (0.55, 1)]:
+            self.append(start, end)
+            result = self.analyze_copy(do_simple=False)
+        self.assertEqual(result, load_expected("baseline.full.json.xz"))
+        self.assertTrue(os.path.exists(util.get_checkpoint_path(self.tgen_copy)))
+        self.assertTrue(os.path.exists(util.get_checkpoint_path(self.torctl_copy)))
+
+        # a checkpoint made with other settings is ignored
+        self.assertEqual(self.analyze_copy(do_simple=True), load_expected("baseline.simple.json.xz"))
+
+    def test_memory_budget(self):
+        spill_check_interval = analysis.SPILL_CHECK_INTERVAL
+        analysis.SPILL_CHECK_INTERVAL = 1
+        try:
+            # the parsers that resume keep their own budget, also from a checkpoint made without one
+            for (start, end, memory_budget) in [(0, 0.3, None), (0.3, 0.55, 0), (0.55, 1, 0)]:
+                self.append(start, end)
+                parsers = [analysis.TGenParser(memory_budget=memory_budget), analysis.TorCtlParser(memory_budget=memory_budget)]
+                for (parser, filepath) in zip(parsers, [self.tgen_copy, self.torctl_copy]):
+                    parser.parse_resumable(filepath, do_simple=False)
+                    for name in parser.RECORD_ATTRIBUTES:
+                        records = getattr(parser, name)
+                        if memory_budget is None:
+                            self.assertIsInstance(records, dict)
+                        else:
+                            self.assertIsInstance(records, analysis.SpilledRecords)
+                            self.assertEqual(len(records.records), 0)
+                    self.assertEqual(parser.memory_budget, memory_budget)
+            for (parser, filepath) in zip(parsers, [self.tgen_path, self.torctl_path]):
+                self.assertEqual(to_json(parser.get_data()), parse_serially(parser.__class__(), filepath, False))
+        finally:
+            analysis.SPILL_CHECK_INTERVAL = spill_check_interval
+
+    def test_rotated_logs(self):
+        self.append(0, 0.5)
+        self.analyze_copy(do_simple=False)
+        # a rotated log is a new file that starts from the beginning
+        for filepath in [self.tgen_copy, self.torctl_copy]:
+            os.rename(filepath, filepath + ".1")
+        self.append(0, 1)
+        self.assertEqual(self.analyze_copy(do_simple=False), load_expected("baseline.full.json.xz"))
+
+class TestLiveAnalysis(SyntheticLogsTestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix="onionperf.test.")
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def test_rotations(self):
+        live = analysis.LiveAnalysis(nickname="op-ab")
+        writables = []
+        for (filepath, listener) in [(self.tgen_path, live.tgen_listener), (self.torctl_path, live.torctl_listener)]:
+            writable = util.FileWritable(os.path.join(self.work_dir, os.path.basename(filepath)), flush_interval=0.05)
+            writable.add_listener(listener)
+            # the listeners start on the first day of the logs
+            listener.rotate_file(filename_datetime=datetime.datetime.combine(SYNTHETIC_DATES[0] - datetime.timedelta(1), datetime.time()))
+            listener.take_rotated_parser()
+            with open(filepath, 'rb') as f:
+                writables.append((writable, f.readlines()))
+
+        rand = random.Random(1)
+        for date in SYNTHETIC_DATES:
+            end_ts = util.date_to_timestamp_range(date)[1]
+            for (writable, lines) in writables:
+                # the lines of the day go out in writes that split and join lines at random
+                day_lines = []
+                while len(lines) > 0 and float(lines[0].split()[2]) < end_ts:
+                    day_lines.append(lines.pop(0))
+                data = ''.join(day_lines)
+                offset = 0
+                while offset < len(data):
+                    size = rand.randint(1, 4096)
+                    writable.write(data[offset:offset + size])
+                    offset += size
+                writable.rotate_file(filename_datetime=datetime.datetime.combine(date, datetime.time(23, 59, 59)))
+            a = live.get_rotated_analysis(ip_address='10.0.0.1')
+            self.assertEqual(to_json(a.json_db), load_expected("baseline.full.{0}.json.xz".format(date.isoformat())))
+
+        for (writable, lines) in writables:
+            self.assertEqual(lines, [])
+            writable.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,205 @@
+'''
+  OnionPerf
+  Authored by Rob Jansen, 2015
+  See LICENSE for licensing information
+'''
+
+import os, shutil, tempfile, unittest
+
+from onionperf import analysis, util
+from onionperf.tests.synthetic import write_synthetic_logs, SYNTHETIC_DATES
+from onionperf.tests.test_parsers import to_json, load_expected
+
+def write_rotated_logs(node_dir, num_transfers, seed, nickname, role="client"):
+    # the logs of a measurement, rotated in the middle: data directories with a log_archive in each
+    paths = []
+    for (log_path, name) in zip(write_synthetic_logs(node_dir, num_transfers=num_transfers, seed=seed, nickname=nickname), ["tgen", "tor"]):
+        data_dir = os.path.join(node_dir, "{0}-{1}".format(name, role))
+        os.makedirs(os.path.join(data_dir, "log_archive"))
+        with open(log_path, 'rb') as f:
+            lines = f.readlines()
+        base = os.path.basename(log_path)
+        rotated_path = os.path.join(data_dir, "log_archive", base.replace(".log", "_2016-02-03_22:00:00.log"))
+        current_path = os.path.join(data_dir, base)
+        for (path, part) in [(rotated_path, lines[:len(lines) / 2]), (current_path, lines[len(lines) / 2:])]:
+            with open(path, 'wb') as f:
+                f.writelines(part)
+        os.remove(log_path)
+        paths.append([rotated_path, current_path])
+    return paths
+
+class TestParallelAnalysis(unittest.TestCase):
+
+    def setUp(self):
+        # two directories of logs of the same node, so the order of the merges decides the record ids
+        self.search_dir = tempfile.mkdtemp(prefix="onionperf.test.")
+        self.log_paths = []
+        for (name, num_transfers, seed) in [("a", 20, 2), ("b", 80, 1)]:
+            os.makedirs(os.path.join(self.search_dir, name))
+            self.log_paths.append(write_synthetic_logs(os.path.join(self.search_dir, name), num_transfers=num_transfers, seed=seed))
+
+    def tearDown(self):
+        shutil.rmtree(self.search_dir)
+
+    def analyze_serially(self):
+        merged = analysis.Analysis()
+        for (tgen_path, torctl_path) in self.log_paths:
+            a = analysis.Analysis()
+            a.add_tgen_file(tgen_path)
+            a.add_torctl_file(torctl_path)
+            a.analyze(do_simple=False)
+            merged.merge(a)
+        return to_json(merged.json_db)
+
+    def test_merge_order(self):
+        expected = self.analyze_serially()
+        # the larger job in b starts first, and the results of a are still merged first
+        for num_subprocs in [1, 2]:
+            a = analysis.ParallelAnalysis()
+            a.analyze(self.search_dir, do_simple=False, num_subprocs=num_subprocs)
+            self.assertEqual(to_json(a.json_db), expected)
+
+    def test_spill_files(self):
+        # the spill directory is made in the temporary directory, and removed with every spill file
+        tmp_dir = tempfile.mkdtemp(prefix="onionperf.test.")
+        tempdir = tempfile.tempdir
+        tempfile.tempdir = tmp_dir
+        try:
+            a = analysis.ParallelAnalysis()
+            a.analyze(self.search_dir, do_simple=False, num_subprocs=2)
+            self.assertEqual(os.listdir(tmp_dir), [])
+
+            # also when a worker fails
+            with open(os.path.join(self.search_dir, "b", "onionperf.tgen.log.xz"), 'wb') as f:
+                f.write("not xz")
+            a = analysis.ParallelAnalysis()
+            self.assertRaises(Exception, a.analyze, self.search_dir, do_simple=False, num_subprocs=2)
+            self.assertEqual(os.listdir(tmp_dir), [])
+        finally:
+            tempfile.tempdir = tempdir
+            shutil.rmtree(tmp_dir)
+
+class TestNodes(unittest.TestCase):
+
+    def setUp(self):
+        self.search_dir = tempfile.mkdtemp(prefix="onionperf.test.")
+        self.node_paths = []
+        for (nickname, num_transfers, seed) in [("op-ab", 80, 1), ("op-cd", 30, 3)]:
+            node_dir = os.path.join(self.search_dir, nickname)
+            os.makedirs(node_dir)
+            self.node_paths.append(write_rotated_logs(node_dir, num_transfers, seed, nickname))
+
+    def tearDown(self):
+        shutil.rmtree(self.search_dir)
+
+    def test_find_pairs(self):
+        # the tgen and torctl logs of a node are in different directories
+        pairs = util.find_file_paths_pairs(self.search_dir, ["tgen.*\.log"], ["torctl.*\.log"])
+        self.assertEqual(pairs, [tuple(paths) for paths in self.node_paths])
+
+    def test_analyze(self):
+        expected = analysis.Analysis()
+        for (tgen_paths, torctl_paths) in self.node_paths:
+            a = analysis.Analysis()
+            for path in tgen_paths:
+                a.add_tgen_file(path)
+            for path in torctl_paths:
+                a.add_torctl_file(path)
+            a.analyze(do_simple=False)
+            expected.merge(a)
+        expected = to_json(expected.json_db)
+        self.assertEqual(sorted(expected['data'].keys()), ["op-ab", "op-cd"])
+        # the logs of the first node were rotated, and its results are still those of the whole logs
+        baseline = load_expected("baseline.full.json.xz")['data']['op-ab']
+        self.assertEqual(expected['data']['op-ab']['tgen'], baseline['tgen'])
+        self.assertEqual(expected['data']['op-ab']['tor'], baseline['tor'])
+
+        cache_dir = os.path.join(self.search_dir, "cache")
+        for (num_subprocs, cache) in [(1, None), (2, None), (2, cache_dir), (2, cache_dir)]:
+            a = analysis.ParallelAnalysis()
+            a.analyze(self.search_dir, do_simple=False, num_subprocs=num_subprocs, cache_dir=cache)
+            self.assertEqual(to_json(a.json_db), expected)
+
+def analyze_files(tgen_paths, torctl_paths):
+    a = analysis.Analysis()
+    for path in tgen_paths:
+        a.add_tgen_file(path)
+    for path in torctl_paths:
+        a.add_torctl_file(path)
+    a.analyze(do_simple=False)
+    return a
+
+class TestClientServer(unittest.TestCase):
+
+    def setUp(self):
+        # the layout of measure: the client and server data directories are next to each other, and name the same host
+        self.search_dir = tempfile.mkdtemp(prefix="onionperf.test.")
+        data_dir = os.path.join(self.search_dir, "onionperf-data")
+        os.makedirs(data_dir)
+        self.client_paths = write_rotated_logs(data_dir, 40, 1, "op-ab", role="client")
+        self.server_paths = write_rotated_logs(data_dir, 30, 4, "op-ab", role="server")
+
+    def tearDown(self):
+        shutil.rmtree(self.search_dir)
+
+    def test_find_pairs(self):
+        pairs = util.find_file_paths_pairs(self.search_dir, ["tgen.*\.log"], ["torctl.*\.log"])
+        self.assertEqual(pairs, [tuple(self.client_paths), tuple(self.server_paths)])
+
+    def test_analyze(self):
+        client = to_json(analyze_files(*self.client_paths).json_db)['data']['op-ab']
+        server = to_json(analyze_files(*self.server_paths).json_db)['data']['op-ab']
+        for num_subprocs in [1, 2]:
+            a = analysis.ParallelAnalysis()
+            a.analyze(self.search_dir, do_simple=False, num_subprocs=num_subprocs)
+            self.assertEqual(to_json(a.json_db)['data'], {'op-ab': client, 'op-ab-server': server})
+
+def sort_lists(obj):
+    # the summaries of merged analyses only keep the order of their lists within each analysis
+    if isinstance(obj, dict):
+        return {k: sort_lists(v) for (k, v) in obj.items()}
+    elif isinstance(obj, list):
+        return sorted(sort_lists(v) for v in obj)
+    return obj
+
+class TestMerge(unittest.TestCase):
+
+    def test_days(self):
+        expected = load_expected("baseline.full.json.xz")['data']['op-ab']
+        merged = analysis.Analysis()
+        for date in SYNTHETIC_DATES:
+            a = analysis.Analysis()
+            a.json_db = load_expected("baseline.full.{0}.json.xz".format(date.isoformat()))
+            merged.merge(a)
+        node_db = merged.json_db['data']['op-ab']
+        self.assertEqual(node_db['measurement_ip'], expected['measurement_ip'])
+        self.assertEqual(node_db['tgen']['transfers'], expected['tgen']['transfers'])
+        # no circuit of the synthetic logs spans midnight, which the per-day filter would drop
+        self.assertEqual(node_db['tor']['circuits'], expected['tor']['circuits'])
+        self.assertEqual(node_db['tor']['streams'], expected['tor']['streams'])
+        for (parent_key, section_key) in [('tgen', 'transfers_summary'), ('tor', 'bandwidth_summary'),
+                                          ('tor', 'circuits_summary'), ('tor', 'streams_summary')]:
+            self.assertEqual(sort_lists(node_db[parent_key][section_key]), sort_lists(expected[parent_key][section_key]))
+
+    def test_records(self):
+        dst = {'measurement_ip': '10.0.0.1', 'tor': {'circuits': {'1': {'a': 1}, '2': {'a': 2}},
+               'bandwidth_summary': {'bytes_read': {'100': 1, '101': 2}}, 'circuits_summary': {'lifetimes': [1.0]}}}
+        src = {'measurement_ip': '10.0.0.2', 'tor': {'circuits': {'1': {'a': 1}, '2': {'a': 3}, '3': {'a': 4}},
+               'bandwidth_summary': {'bytes_read': {'101': 5, '102': 6}}, 'circuits_summary': {'lifetimes': [2.0]}}}
+        analysis.merge_node_db(dst, src)
+        # node values are kept, an identical record is not added twice, and a different one gets a new id
+        self.assertEqual(dst, {'measurement_ip': '10.0.0.1', 'tor': {'circuits': {'1': {'a': 1}, '2': {'a': 2}, '2-1': {'a': 3}, '3': {'a': 4}},
+                               'bandwidth_summary': {'bytes_read': {'100': 1, '101': 5, '102': 6}}, 'circuits_summary': {'lifetimes': [1.0, 2.0]}}})
+        analysis.merge_node_db(dst, {'tor': {'circuits': {'2': {'a': 5}}}})
+        self.assertEqual(dst['tor']['circuits']['2-2'], {'a': 5})
+
+        # a stream of the renamed circuit refers to its new id, also when the sections are merged one at a time
+        dst = {'tor': {'circuits': {1: {'a': 1}}, 'streams': {7: {'circuit_id': '1'}}}}
+        new_ids = {}
+        analysis.merge_node_db(dst, {'tor': {'circuits': {1: {'a': 2}}}}, new_ids=new_ids)
+        analysis.merge_node_db(dst, {'tor': {'streams': {7: {'circuit_id': '1'}, 8: {'circuit_id': None}}}}, new_ids=new_ids)
+        self.assertEqual(dst['tor'], {'circuits': {1: {'a': 1}, '1-1': {'a': 2}},
+                                      'streams': {7: {'circuit_id': '1'}, '7-1': {'circuit_id': '1-1'}, 8: {'circuit_id': None}}})
+
+if __name__ == '__main__':
+    unittest.main()
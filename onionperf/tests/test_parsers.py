@@ -0,0 +1,192 @@
+'''
+  OnionPerf
+  Authored by Rob Jansen, 2015
+  See LICENSE for licensing information
+'''
+
+import os, json, shutil, tempfile, unittest, datetime
+
+from onionperf import analysis, util
+from onionperf.tests.synthetic import write_synthetic_logs, SYNTHETIC_DATES
+
+# the results of the parsers before they were optimized, for the logs of write_synthetic_logs()
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+
+def load_expected(name):
+    source = util.DataSource(os.path.join(DATA_DIR, name))
+    source.open()
+    db = json.load(source.get_file_handle())
+    source.close()
+    return db
+
+def to_json(db):
+    # compare dbs the way they are saved, e.g., with string keys and spilled records read back
+    return json.loads(json.dumps(db, default=analysis.json_encode_mapping))
+
+class SyntheticLogsTestCase(unittest.TestCase):
+    ''' gives its tests the paths of a fresh copy of the synthetic logs '''
+
+    @classmethod
+    def setUpClass(cls):
+        cls.log_dir = tempfile.mkdtemp(prefix="onionperf.test.")
+        cls.tgen_path, cls.torctl_path = write_synthetic_logs(cls.log_dir)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.log_dir)
+
+    def analyze(self, **kwargs):
+        a = analysis.Analysis(ip_address='10.0.0.1')
+        a.add_tgen_file(self.tgen_path)
+        a.add_torctl_file(self.torctl_path)
+        a.analyze(**kwargs)
+        return a
+
+class TestBaselineOutput(SyntheticLogsTestCase):
+
+    def test_full(self):
+        self.assertEqual(to_json(self.analyze(do_simple=False).json_db), load_expected("baseline.full.json.xz"))
+
+    def test_simple(self):
+        self.assertEqual(to_json(self.analyze(do_simple=True).json_db), load_expected("baseline.simple.json.xz"))
+
+    def test_date_filter(self):
+        for date in SYNTHETIC_DATES:
+            expected = load_expected("baseline.full.{0}.json.xz".format(date.isoformat()))
+            self.assertEqual(to_json(self.analyze(do_simple=False, date_filter=date).json_db), expected)
+
+class TestFastDecode(SyntheticLogsTestCase):
+
+    def test_full(self):
+        self.assertEqual(to_json(self.analyze(do_simple=False, fast_decode=True).json_db), load_expected("baseline.full.json.xz"))
+
+    def test_date_filter(self):
+        for date in SYNTHETIC_DATES:
+            expected = load_expected("baseline.full.{0}.json.xz".format(date.isoformat()))
+            self.assertEqual(to_json(self.analyze(do_simple=False, date_filter=date, fast_decode=True).json_db), expected)
+
+def export_torperf(a):
+    # returns the entries of each exported file, which are written in the order of a dict
+    output_dir = tempfile.mkdtemp(prefix="onionperf.test.")
+    try:
+        a.export_torperf_version_1_1(output_prefix=output_dir)
+        exports = {}
+        for name in os.listdir(output_dir):
+            with open(os.path.join(output_dir, name), 'rb') as f:
+                exports[name] = sorted(f.read().split("@type torperf 1.1\r\n"))
+        return exports
+    finally:
+        shutil.rmtree(output_dir)
+
+class TestTorperfExport(SyntheticLogsTestCase):
+
+    def test_baseline(self):
+        exports = export_torperf(self.analyze(do_simple=False))
+        self.assertEqual(sorted(exports.keys()), ["op-ab-1048576.tpf", "op-ab-51200.tpf", "op-ab-5242880.tpf"])
+        for (name, entries) in exports.items():
+            source = util.DataSource(os.path.join(DATA_DIR, "baseline.{0}.xz".format(name)))
+            source.open()
+            expected = source.get_file_handle().read()
+            source.close()
+            self.assertEqual(entries, sorted(expected.split("@type torperf 1.1\r\n")))
+
+    def test_merged_ids(self):
+        expected = export_torperf(self.analyze(do_simple=False))
+        self.assertTrue(any("PATH=" in entry for entries in expected.values() for entry in entries))
+
+        # every circuit id is taken by a different circuit of an earlier run, so the circuits get new ids
+        merged = analysis.Analysis(nickname="op-ab", ip_address='10.0.0.1')
+        circuits = self.analyze(do_simple=False).json_db['data']['op-ab']['tor']['circuits']
+        merged.json_db['data']['op-ab'] = {'measurement_ip': '10.0.0.1',
+            'tor': {'circuits': {cid: dict(circuit, unix_ts_start=0) for (cid, circuit) in circuits.iteritems()}}}
+        merged.merge(self.analyze(do_simple=False))
+        merged_circuits = merged.json_db['data']['op-ab']['tor']['circuits']
+        self.assertEqual(len(merged_circuits), 2 * len(circuits))
+        # the streams refer to the new ids, and none to a circuit of the earlier run
+        linked = [analysis.find_circuit(merged_circuits, stream['circuit_id']) for stream in merged.json_db['data']['op-ab']['tor']['streams'].values()]
+        self.assertTrue(len([circuit for circuit in linked if circuit is not None]) > 0)
+        self.assertNotIn(0, [circuit['unix_ts_start'] for circuit in linked if circuit is not None])
+        # the transfers are still linked to their own circuits, also with the string ids of a saved analysis
+        self.assertEqual(export_torperf(merged), expected)
+        work_dir = tempfile.mkdtemp(prefix="onionperf.test.")
+        try:
+            merged.save(output_prefix=work_dir)
+            self.assertEqual(export_torperf(analysis.Analysis.load(input_prefix=work_dir)), expected)
+        finally:
+            shutil.rmtree(work_dir)
+
+class TestRecords(SyntheticLogsTestCase):
+
+    def test_slots(self):
+        # records keep no per-instance dict
+        tgen_parser, torctl_parser = analysis.TGenParser(), analysis.TorCtlParser()
+        tgen_parser.parse(util.DataSource(self.tgen_path), do_simple=False)
+        torctl_parser.parse(util.DataSource(self.torctl_path), do_simple=False)
+        records = tgen_parser.transfers.values() + torctl_parser.circuits.values() + torctl_parser.streams.values()
+        self.assertTrue(len(records) > 0)
+        for record in records:
+            self.assertFalse(hasattr(record, '__dict__'))
+
+    def test_circuit_built_without_hops(self):
+        # a circuit whose hops were extended before the log started has no data, as before
+        prefix = "2016-02-03 20:00:00 1454529600.00"
+        flags = "BUILD_FLAGS=NEED_CAPACITY PURPOSE=GENERAL TIME_CREATED=2016-02-04T00:00:01.000000"
+        path = "$C386BBC4CD613E30D8F16ADF91B7584A2265B1F5~nC386"
+        parser = analysis.TorCtlParser()
+        for line in ["{0} Starting torctl program on host op-ab using Tor version 0.2.7.6 status=recommended",
+                     "{0} NOTICE BOOTSTRAP PROGRESS=100 TAG=done SUMMARY=\"Done\"",
+                     "{0} 650 CIRC 1 LAUNCHED {2}", "{0} 650 CIRC 1 BUILT {1} {2}", "{0} 650 CIRC 1 CLOSED {1} {2} REASON=FINISHED",
+                     "{0} 650 CIRC 2 LAUNCHED {2}", "{0} 650 CIRC 2 FAILED {2} REASON=DESTROYED"]:
+            parser.parse_line(line.format(prefix, path, flags) + "\r\n", do_simple=False)
+        data = parser.get_data()
+        self.assertEqual(data['circuits'].keys(), [2])
+        self.assertEqual(len(data['circuits_summary']['lifetimes']), 1)
+        self.assertNotIn('path', data['circuits'][2])
+
+class TestSkipEvents(SyntheticLogsTestCase):
+
+    def test_counts_per_parse(self):
+        # each parse counts the events that it skipped in its own source
+        parser = analysis.TorCtlParser()
+        parser.parse(util.DataSource(self.torctl_path), do_simple=False)
+        first = dict(parser.skipped_events)
+        self.assertTrue(len(first) > 0)
+        parser.parse(util.DataSource(self.torctl_path), do_simple=False)
+        self.assertEqual(parser.skipped_events, first)
+
+    def test_analyze(self):
+        a = self.analyze(do_simple=False, skip_events=['BW'])
+        self.assertEqual(a.get_nodes(), ["op-ab"])
+        self.assertEqual(a.get_tor_bandwidth_summary("op-ab", 'bytes_read'), {})
+        expected = load_expected("baseline.full.json.xz")
+        self.assertEqual(to_json(a.json_db)['data']['op-ab']['tgen'], expected['data']['op-ab']['tgen'])
+        self.assertNotEqual(expected['data']['op-ab']['tor']['bandwidth_summary']['bytes_read'], {})
+
+class TestLiveAnalysis(unittest.TestCase):
+
+    def test_memory_budget(self):
+        # the parsers of every day get the budget
+        live = analysis.LiveAnalysis(nickname="op-ab", memory_budget=64)
+        for i in xrange(2):
+            self.assertIsInstance(live.tgen_listener.parser.transfers, analysis.SpilledRecords)
+            self.assertIsInstance(live.torctl_listener.parser.circuits, analysis.SpilledRecords)
+            for listener in [live.tgen_listener, live.torctl_listener]:
+                listener.rotate_file(filename_datetime=datetime.datetime(2016, 2, 3, 23, 59, 59))
+
+class TestTGenParser(unittest.TestCase):
+
+    def test_keyword_dispatch(self):
+        # the event keyword is the first token of the message, so the same word elsewhere does not count
+        prefix = "2016-02-03 20:00:00 1454529600.000000 [message] [shd-tgen-transfer.c:803] [_tgentransfer_log]"
+        parser = analysis.TGenParser()
+        self.assertTrue(parser.parse_line("{0} heartbeat [transfer-complete] [transfer-error]".format(prefix), do_simple=False))
+        self.assertTrue(parser.parse_line("{0}".format(prefix), do_simple=False))
+        self.assertEqual(parser.get_data(), {'transfers': {}, 'transfers_summary': {'time_to_first_byte': {}, 'time_to_last_byte': {}, 'errors': {}}})
+
+    def test_name(self):
+        parser = analysis.TGenParser()
+        parser.parse_line("2016-02-03 20:00:00 1454529600.000000 [message] [shd-tgen-main.c:100] [_tgenmain_run] Initializing traffic generator on host op-cd process id 42")
+        self.assertEqual(parser.get_name(), "op-cd")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,176 @@
+'''
+  OnionPerf
+  Authored by Rob Jansen, 2015
+  See LICENSE for licensing information
+'''
+
+import os, re, time, shutil, tempfile, unittest
+
+from onionperf import util
+
+class FailingFile(object):
+    ''' a file whose writes raise IOError while is_failing is set '''
+
+    def __init__(self, f):
+        self.f = f
+        self.is_failing = True
+
+    def write(self, msg):
+        if self.is_failing:
+            raise IOError("no space left on device")
+        self.f.write(msg)
+
+    def flush(self):
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+class TestFileWritable(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix="onionperf.test.")
+        self.filepath = os.path.join(self.tmp_dir, "onionperf.tgen.log")
+        self.check_interval = util.FILE_FLUSH_CHECK_INTERVAL
+        util.FILE_FLUSH_CHECK_INTERVAL = 0.05
+        self.msgs = ["line {0}\n".format(i) for i in xrange(5000)]
+
+    def tearDown(self):
+        util.FILE_FLUSH_CHECK_INTERVAL = self.check_interval
+        shutil.rmtree(self.tmp_dir)
+
+    def read(self):
+        with open(self.filepath, 'r') as f:
+            return f.read()
+
+    def test_close(self):
+        writable = util.FileWritable(self.filepath, flush_interval=0.05)
+        for msg in self.msgs:
+            writable.write(msg)
+        writable.close()
+        self.assertEqual(self.read(), ''.join(self.msgs))
+        # a closed writable stops its flusher and is no longer kept for the exit hook
+        self.assertIsNone(writable.flusher)
+        self.assertNotIn(writable, util.flushing_writables)
+
+    def test_dead_flusher(self):
+        writable = util.FileWritable(self.filepath, flush_interval=0.05)
+        flusher = writable.flusher
+        writable.write(self.msgs[0])
+        def fail():
+            raise RuntimeError("flusher bug")
+        writable._FileWritable__flush_queue = fail
+        for msg in self.msgs[1:10]:
+            writable.write(msg)
+        flusher.join(5)
+        self.assertFalse(flusher.is_alive())
+        # writes are synchronous now, after the messages the flusher left queued
+        for msg in self.msgs[10:]:
+            writable.write(msg)
+        writable.close()
+        self.assertEqual(self.read(), ''.join(self.msgs))
+
+    def test_write_error(self):
+        writable = util.FileWritable(self.filepath, flush_interval=0.05)
+        writable.open()
+        failing = FailingFile(writable.file)
+        writable.file = failing
+        for msg in self.msgs:
+            writable.write(msg)
+        # the messages stay queued, and waiting for them raises the error
+        self.assertRaises(IOError, writable.close)
+        self.assertTrue(writable.flusher.is_alive())
+        failing.is_failing = False
+        writable.close()
+        self.assertEqual(self.read(), ''.join(self.msgs))
+
+class CountingListDirectory(object):
+    ''' counts the directories that the manifest lists with util.list_directory '''
+
+    def __init__(self):
+        self.num_listed = 0
+        self.list_directory = util.list_directory
+
+    def __call__(self, path):
+        self.num_listed += 1
+        return self.list_directory(path)
+
+class TestFileTree(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix="onionperf.test.")
+        self.search_dir = os.path.join(self.tmp_dir, "search")
+        self.manifest_path = os.path.join(self.tmp_dir, "manifest.json")
+        for node in ["op-cd", "op-ab", "op-ef"]:
+            for data_dir in ["tgen-client", "tor-client"]:
+                os.makedirs(os.path.join(self.search_dir, node, data_dir, "log_archive"))
+                name = "onionperf.{0}.log".format("tgen" if data_dir.startswith("tgen") else "torctl")
+                for path in [os.path.join(self.search_dir, node, data_dir, name),
+                             os.path.join(self.search_dir, node, data_dir, "log_archive", name.replace(".log", "_2016-02-03_23:59:59.log"))]:
+                    open(path, 'w').close()
+            open(os.path.join(self.search_dir, node, "onionperf.analysis.json.xz"), 'w').close()
+        # like os.walk, a symlink to a directory is neither walked into nor a file
+        os.symlink(os.path.join(self.search_dir, "op-ab"), os.path.join(self.search_dir, "op-link"))
+        self.list_directory = util.list_directory
+        self.scandir = util.scandir
+
+    def tearDown(self):
+        util.list_directory = self.list_directory
+        util.scandir = self.scandir
+        shutil.rmtree(self.tmp_dir)
+
+    def walk(self, **kwargs):
+        return [(root, sorted(files)) for (root, files) in util.walk_file_tree(self.search_dir, **kwargs)]
+
+    def os_walk(self):
+        tree = []
+        for (root, dirs, files) in os.walk(self.search_dir):
+            dirs.sort()
+            tree.append((root, sorted(files)))
+        return tree
+
+    def backdate(self):
+        # changes that are older than the slack are trusted to show in the mtime of their directory
+        for (root, files) in self.os_walk():
+            os.utime(root, (time.time() - 100, time.time() - 100))
+
+    def test_walk(self):
+        expected = self.os_walk()
+        self.assertEqual(self.walk(), expected)
+        util.scandir = None
+        self.assertEqual(self.walk(), expected)
+
+    def test_find_file_paths(self):
+        patterns = ["tgen.*\.log", "torctl.*\.log"]
+        expected = [os.path.join(root, name) for (root, files) in self.os_walk() for name in files
+                    if any(re.search(pattern, name) for pattern in patterns)]
+        self.assertEqual(sorted(util.find_file_paths(self.search_dir, patterns)), sorted(expected))
+        self.assertEqual(len(expected), 12)
+
+    def test_manifest(self):
+        counter = CountingListDirectory()
+        util.list_directory = counter
+        self.backdate()
+        self.assertEqual(self.walk(manifest_path=self.manifest_path), self.os_walk())
+        self.assertEqual(counter.num_listed, len(self.os_walk()))
+
+        # a warm manifest lists nothing
+        counter.num_listed = 0
+        self.assertEqual(self.walk(manifest_path=self.manifest_path), self.os_walk())
+        self.assertEqual(counter.num_listed, 0)
+
+        # only the changed directories are listed again
+        open(os.path.join(self.search_dir, "op-cd", "tgen-client", "onionperf.tgen.log.1"), 'w').close()
+        os.remove(os.path.join(self.search_dir, "op-ef", "tor-client", "onionperf.torctl.log"))
+        shutil.rmtree(os.path.join(self.search_dir, "op-ab", "tor-client"))
+        counter.num_listed = 0
+        self.assertEqual(self.walk(manifest_path=self.manifest_path), self.os_walk())
+        self.assertEqual(counter.num_listed, 3)
+
+        # a directory that changed shortly before the manifest was saved is listed again
+        counter.num_listed = 0
+        self.assertEqual(self.walk(manifest_path=self.manifest_path), self.os_walk())
+        self.assertEqual(counter.num_listed, 3)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+'''
+  OnionPerf
+  Authored by Rob Jansen, 2015
+  See LICENSE for licensing information
+'''
+
+import os, shutil, tempfile, unittest, cPickle, multiprocessing
+
+from onionperf import analysis
+from onionperf.tests.test_parsers import SyntheticLogsTestCase, load_expected, to_json
+from onionperf.tests.test_cache import split_file
+
+class TestWorkers(SyntheticLogsTestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix="onionperf.test.")
+        self.tgen_paths = split_file(self.tgen_path, self.work_dir)
+        self.torctl_paths = split_file(self.torctl_path, self.work_dir)
+        self.spill_check_interval = analysis.SPILL_CHECK_INTERVAL
+        self.result_timeout = analysis.WORKER_RESULT_TIMEOUT
+
+    def tearDown(self):
+        analysis.SPILL_CHECK_INTERVAL = self.spill_check_interval
+        analysis.WORKER_RESULT_TIMEOUT = self.result_timeout
+        shutil.rmtree(self.work_dir)
+
+    def analyze_split(self, tgen_paths, **kwargs):
+        a = analysis.Analysis(ip_address='10.0.0.1')
+        for path in tgen_paths:
+            a.add_tgen_file(path)
+        for path in self.torctl_paths:
+            a.add_torctl_file(path)
+        a.analyze(do_simple=False, **kwargs)
+        return to_json(a.json_db)
+
+    def test_memory_budget(self):
+        # the workers spill every record, and the results are still those of a serial parse
+        analysis.SPILL_CHECK_INTERVAL = 1
+        self.assertEqual(self.analyze_split(self.tgen_paths, num_procs=2, memory_budget=0), load_expected("baseline.full.json.xz"))
+        self.assertEqual(self.analyze_split(self.tgen_paths, num_procs=2), load_expected("baseline.full.json.xz"))
+        self.assertEqual(multiprocessing.active_children(), [])
+
+    def test_new_chunk_parser(self):
+        for parser in [analysis.TGenParser(memory_budget=0), analysis.TorCtlParser(memory_budget=0)]:
+            chunk_parser = parser.new_chunk_parser()
+            self.assertEqual(chunk_parser.memory_budget, 0)
+
+    def test_worker_fails(self):
+        # a file that is not xz compressed fails in its worker, and the pool is stopped
+        bad_path = os.path.join(self.work_dir, "onionperf.tgen.log.xz")
+        with open(bad_path, 'wb') as f:
+            f.write("not xz compressed\n" * 100)
+        self.assertRaises(Exception, self.analyze_split, [bad_path] + self.tgen_paths, num_procs=2)
+        self.assertEqual(multiprocessing.active_children(), [])
+
+    def test_worker_hangs(self):
+        # a worker that never returns its result, here one that waits for a writer to its fifo
+        analysis.WORKER_RESULT_TIMEOUT = 2
+        fifo_path = os.path.join(self.work_dir, "onionperf.tgen.fifo.log")
+        os.mkfifo(fifo_path)
+        self.assertRaises(multiprocessing.TimeoutError, self.analyze_split, [fifo_path] + self.tgen_paths, num_procs=2)
+        self.assertEqual(multiprocessing.active_children(), [])
+
+class TestSpilledRecords(unittest.TestCase):
+
+    def setUp(self):
+        self.spill_check_interval = analysis.SPILL_CHECK_INTERVAL
+        analysis.SPILL_CHECK_INTERVAL = 1
+
+    def tearDown(self):
+        analysis.SPILL_CHECK_INTERVAL = self.spill_check_interval
+
+    def test_pickle(self):
+        records = analysis.SpilledRecords(0)
+        for i in xrange(2500):
+            records[i] = {'unix_ts_start': i}
+        self.assertEqual(len(records.records), 0)
+        # a loaded pickle, e.g., of a checkpoint or a cached chunk, spills its records with the same budget
+        loaded = cPickle.loads(cPickle.dumps(records, cPickle.HIGHEST_PROTOCOL))
+        self.assertIsInstance(loaded, analysis.SpilledRecords)
+        self.assertEqual(loaded.memory_budget, 0)
+        self.assertEqual(len(loaded.records), 0)
+        self.assertEqual(dict(loaded.iteritems()), dict(records.iteritems()))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+'''
+  OnionPerf
+  Authored by Rob Jansen, 2015
+  See LICENSE for licensing information
+'''
+
+import os, shutil, tempfile, unittest, subprocess
+
+from onionperf import analysis, util
+from onionperf.tests.test_parsers import SyntheticLogsTestCase, load_expected, to_json
+
+def has_xz_tool():
+    try:
+        return subprocess.call(["xz", "--version"], stdout=open(os.devnull, 'w')) == 0
+    except OSError:
+        return False
+
+def run_xz(args, in_path, out_path):
+    with open(in_path, 'rb') as inf:
+        with open(out_path, 'wb') as outf:
+            subprocess.check_call(["xz", "--stdout"] + args, stdin=inf, stdout=outf)
+
+def read_source(filepath, num_threads=1):
+    source = util.DataSource(filepath, num_threads=num_threads)
+    source.open()
+    data = ''.join(source)
+    source.close()
+    return data
+
+@unittest.skipUnless(has_xz_tool(), "the xz tool is not installed")
+class XZTestCase(SyntheticLogsTestCase):
+    ''' gives its tests a directory for compressed files, and runs them with and without the lzma module '''
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix="onionperf.test.")
+        self.lzma = util.lzma
+
+    def tearDown(self):
+        util.lzma = self.lzma
+        shutil.rmtree(self.work_dir)
+
+    def get_lzma_modules(self):
+        # None runs the xz tool instead
+        return [None] if self.lzma is None else [self.lzma, None]
+
+class TestDataSource(XZTestCase):
+
+    def write_xz_files(self, filepath):
+        # the same log as a multi-block, a single-block, and a two-stream file
+        name = os.path.basename(filepath)
+        paths = {}
+        paths['multi'] = os.path.join(self.work_dir, name + ".multi.xz")
+        run_xz(["-T3", "--block-size=65536"], filepath, paths['multi'])
+        paths['single'] = os.path.join(self.work_dir, name + ".single.xz")
+        run_xz(["-T1"], filepath, paths['single'])
+
+        with open(filepath, 'rb') as f:
+            data = f.read()
+        parts = [os.path.join(self.work_dir, name + ".part{0}".format(i)) for i in [1, 2]]
+        for (path, part) in zip(parts, [data[:len(data) / 3], data[len(data) / 3:]]):
+            with open(path, 'wb') as f:
+                f.write(part)
+        paths['concat'] = os.path.join(self.work_dir, name + ".concat.xz")
+        with open(paths['concat'], 'wb') as f:
+            for path in parts:
+                run_xz([], path, path + ".xz")
+                with open(path + ".xz", 'rb') as partf:
+                    f.write(partf.read())
+        return paths
+
+    def test_decompress(self):
+        for filepath in [self.tgen_path, self.torctl_path]:
+            with open(filepath, 'rb') as f:
+                expected = f.read()
+            paths = self.write_xz_files(filepath)
+            if self.lzma is not None:
+                self.assertTrue(len(util.find_xz_blocks(paths['multi'])) > 1)
+                self.assertEqual(len(util.find_xz_blocks(paths['concat'])), 2)
+            for lzma in self.get_lzma_modules():
+                util.lzma = lzma
+                for path in paths.values():
+                    for num_threads in [1, 3]:
+                        self.assertEqual(read_source(path, num_threads=num_threads), expected)
+
+    def test_analyze(self):
+        for (filepath, args) in [(self.tgen_path, ["-T3", "--block-size=65536"]), (self.torctl_path, ["-T1"])]:
+            run_xz(args, filepath, os.path.join(self.work_dir, os.path.basename(filepath) + ".xz"))
+        for lzma in self.get_lzma_modules():
+            util.lzma = lzma
+            for (num_chunks, num_threads) in [(1, 1), (1, 3), (3, 1)]:
+                a = analysis.Analysis(ip_address='10.0.0.1')
+                a.add_tgen_file(os.path.join(self.work_dir, "onionperf.tgen.log.xz"))
+                a.add_torctl_file(os.path.join(self.work_dir, "onionperf.torctl.log.xz"))
+                sources = []
+                data_source = util.DataSource
+                def record_source(filepath, **kwargs):
+                    sources.append(kwargs.get('num_threads', 1))
+                    return data_source(filepath, **kwargs)
+                util.DataSource = record_source
+                try:
+                    a.analyze(do_simple=False, num_chunks=num_chunks, num_threads=num_threads)
+                finally:
+                    util.DataSource = data_source
+                self.assertEqual(to_json(a.json_db), load_expected("baseline.full.json.xz"))
+                # the compressed files are not split, and decompress on their own number of threads
+                self.assertEqual(sources, [num_threads, num_threads])
+
+class TestFileWritable(XZTestCase):
+
+    def test_compress(self):
+        with open(self.torctl_path, 'rb') as f:
+            expected = f.read()
+        for lzma in self.get_lzma_modules():
+            util.lzma = lzma
+            filepath = os.path.join(self.work_dir, "onionperf.torctl.log.xz")
+            writable = util.FileWritable(filepath, do_truncate=True)
+            for line in expected.splitlines(True):
+                writable.write(line)
+            writable.close()
+            self.assertEqual(subprocess.call(["xz", "-t", filepath]), 0)
+            self.assertEqual(subprocess.check_output(["xz", "-dc", filepath]), expected)
+            os.remove(filepath)
+
+if __name__ == '__main__':
+    unittest.main()
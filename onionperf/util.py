@@ -4,12 +4,41 @@
   See LICENSE for licensing information
 '''
 
-import sys, os, socket, logging, random, re, shutil, datetime, urllib
+import sys, os, io, socket, logging, random, re, shutil, datetime, urllib, calendar, struct, zlib, json, bisect, hashlib, atexit, time, resource, weakref
 from subprocess import Popen, PIPE, STDOUT
-from threading import Lock
+from threading import Lock, Thread, Event
+from collections import deque, Mapping
+from multiprocessing.pool import ThreadPool
 from cStringIO import StringIO
 from abc import ABCMeta, abstractmethod
 
+# xz files are compressed and decompressed in-process if the lzma module (python 3)
+# or backports.lzma (python 2) is available, otherwise we run the xz tool
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+# directories are listed without a stat call per entry if os.scandir (python 3.5)
+# or the scandir module (python 2) is available
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+# size of the buffers used when reading and writing xz files in-process
+XZ_BUFFER_SIZE = 1024 * 1024
+# the amount of uncompressed data in each block of a seekable xz file
+XZ_BLOCK_SIZE = 1024 * 1024
+XZ_HEADER_MAGIC = '\xfd7zXZ\x00'
+XZ_FOOTER_MAGIC = 'YZ'
+
 LINEFORMATS = "k-,r-,b-,g-,c-,m-,y-,k--,r--,b--,g--,c--,m--,y--,k:,r:,b:,g:,c:,m:,y:,k-.,r-.,b-.,g-.,c-.,m-.,y-."
 
 def make_dir_path(path):
@@ -17,46 +46,162 @@ def make_dir_path(path):
     if not os.path.exists(p):
         os.makedirs(p)
 
-def find_file_paths(searchpath, patterns):
+def compile_patterns(patterns):
+    # a single alternation is searched once per file name, instead of once per pattern
+    if len(patterns) == 0:
+        return None
+    return re.compile("|".join(["(?:{0})".format(pattern) for pattern in patterns]))
+
+def list_directory(path):
+    '''
+    returns the names of the (subdirectories, files) in the directory at path; like os.walk,
+    symlinks to directories are not walked into, and are not files either
+    '''
+    subdirs, files = [], []
+    if scandir is not None:
+        for entry in scandir(path):
+            if not entry.is_dir():
+                files.append(entry.name)
+            elif not entry.is_symlink():
+                subdirs.append(entry.name)
+    else:
+        for name in os.listdir(path):
+            fpath = os.path.join(path, name)
+            if not os.path.isdir(fpath):
+                files.append(name)
+            elif not os.path.islink(fpath):
+                subdirs.append(name)
+    return subdirs, files
+
+# incremented when the format of directory manifests changes
+DIRECTORY_MANIFEST_VERSION = 1
+# a directory that was modified this many seconds before its manifest was saved is listed again,
+# since a change within the same tick of its mtime would not be noticed
+DIRECTORY_MANIFEST_SLACK = 2.0
+
+class DirectoryManifest(object):
+    '''
+    the listings of the directories below a search path, saved in a json file at filepath so that
+    later walks only list the directories whose mtime changed since the manifest was saved
+    '''
+
+    def __init__(self, filepath):
+        self.filepath = os.path.abspath(os.path.expanduser(filepath))
+        self.listings = {}
+        self.saved_at = 0.0
+        self.walked = {}
+        self.num_listed = 0
+        if os.path.exists(self.filepath):
+            try:
+                with open(self.filepath, 'r') as f:
+                    manifest = json.load(f)
+            except ValueError:
+                manifest = {}
+            if manifest.get('type') == 'onionperf-manifest' and manifest.get('version') == DIRECTORY_MANIFEST_VERSION:
+                self.listings = manifest['directories']
+                self.saved_at = manifest['saved_at']
+            else:
+                logging.warning("ignoring directory manifest {0} with unsupported version".format(self.filepath))
+
+    def list_directory(self, path):
+        abspath = os.path.abspath(path)
+        mtime = os.stat(abspath).st_mtime
+        listing = self.listings.get(abspath)
+        if listing is None or listing['mtime'] != mtime or mtime > self.saved_at - DIRECTORY_MANIFEST_SLACK:
+            subdirs, files = list_directory(abspath)
+            listing = {'mtime': mtime, 'subdirs': subdirs, 'files': files}
+            self.num_listed += 1
+        self.walked[abspath] = listing
+        return listing['subdirs'], listing['files']
+
+    def save(self):
+        # only the directories of the last walk are kept, so removed directories are dropped
+        if self.num_listed == 0 and len(self.walked) == len(self.listings):
+            return
+        logging.info("saving directory manifest with {0} listings, {1} of them new, to {2}".format(len(self.walked), self.num_listed, self.filepath))
+        manifest = {'type': 'onionperf-manifest', 'version': DIRECTORY_MANIFEST_VERSION,
+                    'saved_at': time.time(), 'directories': self.walked}
+        tmp_filepath = "{0}.tmp".format(self.filepath)
+        with open(tmp_filepath, 'w') as f:
+            # dumps uses the c encoder, which json.dump does not
+            f.write(json.dumps(manifest))
+        os.rename(tmp_filepath, self.filepath)
+
+def walk_file_tree(searchpath, manifest_path=None):
+    '''
+    returns a (dirpath, filenames) pair for searchpath and every directory below it, in the
+    order of os.walk with the subdirectories of each directory sorted by name, so that the order
+    does not depend on the file system; if manifest_path is set, directory listings are reused from and saved to
+    a DirectoryManifest there
+    '''
+    manifest = DirectoryManifest(manifest_path) if manifest_path is not None else None
+    tree = []
+    pending = [searchpath]
+    while len(pending) > 0:
+        dirpath = pending.pop()
+        try:
+            subdirs, files = manifest.list_directory(dirpath) if manifest is not None else list_directory(dirpath)
+        except OSError:
+            # like os.walk, skip directories that we cannot list
+            continue
+        tree.append((dirpath, files))
+        pending.extend([os.path.join(dirpath, name) for name in sorted(subdirs, reverse=True)])
+    if manifest is not None:
+        manifest.save()
+    return tree
+
+def find_file_paths(searchpath, patterns, manifest_path=None):
     paths = []
     if searchpath.endswith("/-"): paths.append("-")
     else:
-        for root, dirs, files in os.walk(searchpath):
-            for name in files:
-                found = False
-                fpath = os.path.join(root, name)
-                fbase = os.path.basename(fpath)
-                for pattern in patterns:
-                    if re.search(pattern, fbase): found = True
-                if found: paths.append(fpath)
+        pattern_re = compile_patterns(patterns)
+        for (root, files) in walk_file_tree(searchpath, manifest_path=manifest_path):
+            if pattern_re is None: break
+            paths.extend([os.path.join(root, name) for name in files if pattern_re.search(name)])
     return paths
 
-def find_file_paths_pairs(searchpath, patterns_a, patterns_b):
-    paths = []
-    for root, dirs, files in os.walk(searchpath):
+def get_log_node(filepath):
+    '''
+    returns the (directory, role) of the node that wrote the log file at filepath: a measurement writes the logs
+    of its processes to tgen-<role> and tor-<role> data directories, e.g., tgen-client and tor-client, and rotates
+    them to a log_archive directory inside those, so a node is the directory that holds the data directories and
+    the role in their names; the role is None for a log that is not in a data directory
+    '''
+    dirpath = os.path.dirname(filepath)
+    if os.path.basename(dirpath) == "log_archive":
+        dirpath = os.path.dirname(dirpath)
+    match = re.match(r"(tgen|tor)-(.+)$", os.path.basename(dirpath))
+    if match is not None:
+        return (os.path.dirname(dirpath), match.group(2))
+    return (dirpath, None)
+
+def find_file_paths_pairs(searchpath, patterns_a, patterns_b, manifest_path=None, get_node_key=get_log_node):
+    '''
+    returns a (paths_a, paths_b) pair for each node below searchpath that wrote files matching patterns_a
+    or patterns_b, e.g., the tgen and torctl logs of a node, in the order in which the nodes were found;
+    get_node_key maps the path of a file to its node, get_log_node by default, so that the client and the
+    server of a measurement are separate nodes; the paths of a node are
+    sorted, which orders the logs of each data directory by time, the rotated ones first
+    '''
+    pairs, node_pairs = [], {}
+    pattern_a_re, pattern_b_re = compile_patterns(patterns_a), compile_patterns(patterns_b)
+    for (root, files) in walk_file_tree(searchpath, manifest_path=manifest_path):
         for name in files:
-            fpath = os.path.join(root, name)
-            fbase = os.path.basename(fpath)
-
-            paths_a = []
-            found = False
-            for pattern in patterns_a:
-                if re.search(pattern, fbase):
-                    found = True
-            if found:
-                paths_a.append(fpath)
-
-            paths_b = []
-            found = False
-            for pattern in patterns_b:
-                if re.search(pattern, fbase):
-                    found = True
-            if found:
-                paths_b.append(fpath)
-
-            if len(paths_a) > 0 or len(paths_b) > 0:
-                paths.append((paths_a, paths_b))
-    return paths
+            is_a = pattern_a_re is not None and pattern_a_re.search(name) is not None
+            is_b = pattern_b_re is not None and pattern_b_re.search(name) is not None
+            if not is_a and not is_b:
+                continue
+            path = os.path.join(root, name)
+            key = get_node_key(path)
+            if key not in node_pairs:
+                node_pairs[key] = ([], [])
+                pairs.append(node_pairs[key])
+            if is_a: node_pairs[key][0].append(path)
+            if is_b: node_pairs[key][1].append(path)
+    for (paths_a, paths_b) in pairs:
+        paths_a.sort()
+        paths_b.sort()
+    return pairs
 
 def find_path(binpath, defaultname):
     # find the path to tor
@@ -101,6 +246,11 @@ def date_to_string(date_object):
     else:
         return ""
 
+def date_to_timestamp_range(date_object):
+    # the [start, end) unix timestamps of the given UTC day
+    start = calendar.timegm(date_object.timetuple())
+    return start, start + 86400
+
 def do_dates_match(date1, date2):
     year_matches = True if date1.year == date2.year else False
     month_matches = True if date1.month == date2.month else False
@@ -136,10 +286,405 @@ def get_random_free_port():
         if rc != 0: # error connecting, port is available
             return port
 
+def find_line_chunks(filename, num_chunks):
+    '''
+    splits the file into at most num_chunks (start, end) byte ranges of roughly equal size,
+    where each range starts at the beginning of a line
+    '''
+    size = os.path.getsize(filename)
+    offsets = [0]
+    with open(filename, 'rb') as f:
+        for i in range(1, num_chunks):
+            target = size * i / num_chunks
+            if target <= offsets[-1]:
+                continue
+            # move to the start of the first line that begins at or after target
+            f.seek(target - 1)
+            f.readline()
+            offset = f.tell()
+            if offset >= size:
+                break
+            if offset > offsets[-1]:
+                offsets.append(offset)
+    offsets.append(size)
+    return zip(offsets[:-1], offsets[1:])
+
+def is_seekable_file(filename):
+    # compressed files and stdin can only be read from start to end
+    return filename != '-' and not filename.endswith(".xz") and os.path.isfile(filename)
+
+def find_timestamp_offset(filename, unix_ts, ts_index=2):
+    '''
+    returns the byte offset of the first line of a time-ordered log file whose timestamp,
+    the whitespace-separated token at ts_index, is at least unix_ts; lines without a
+    timestamp are skipped over
+    '''
+    def get_first_timestamp(f, offset):
+        # the timestamp of the first timestamped line that starts at or after offset
+        if offset > 0:
+            f.seek(offset - 1)
+            f.readline()
+        else:
+            f.seek(0)
+        for line in iter(f.readline, ''):
+            parts = line.split(None, ts_index + 1)
+            if len(parts) > ts_index:
+                try:
+                    return float(parts[ts_index])
+                except ValueError:
+                    pass
+        return None
+
+    with open(filename, 'rb') as f:
+        # binary search for the smallest offset whose next timestamp is at or after unix_ts
+        low, high = 0, os.path.getsize(filename)
+        while low < high:
+            mid = (low + high) / 2
+            ts = get_first_timestamp(f, mid)
+            if ts is None or ts >= unix_ts:
+                high = mid
+            else:
+                low = mid + 1
+        # round up to the start of a line
+        if low > 0:
+            f.seek(low - 1)
+            f.readline()
+            low = f.tell()
+    return low
+
+def find_last_line_end(filename):
+    # the byte offset just past the last newline, where a partially written line would start
+    with open(filename, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        end = f.tell()
+        while end > 0:
+            start = max(0, end - 65536)
+            f.seek(start)
+            i = f.read(end - start).rfind('\n')
+            if i >= 0:
+                return start + i + 1
+            end = start
+    return 0
+
+def hash_file(filename):
+    ''' returns the hex sha1 digest of the contents of filename '''
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for data in iter(lambda: f.read(1024 * 1024), ''):
+            h.update(data)
+    return h.hexdigest()
+
+def get_rss():
+    ''' returns the resident set size of this process in bytes, or its peak if the current size is unknown '''
+    try:
+        with open("/proc/self/statm", 'r') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (IOError, IndexError, ValueError):
+        # linux reports the peak in KiB
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def get_checkpoint_path(filename):
+    # drop the '.log' suffix so that log file search patterns do not match the checkpoint
+    base = os.path.basename(filename)
+    if base.endswith(".log"):
+        base = base[:-len(".log")]
+    return os.path.join(os.path.dirname(os.path.abspath(filename)), "{0}.checkpoint".format(base))
+
+class LineRangeReader(object):
+    ''' iterates over the lines of an open file until the given byte offset is reached '''
+    def __init__(self, fileobj, end_offset):
+        self.fileobj = fileobj
+        self.offset = fileobj.tell()
+        self.end_offset = end_offset
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        return self.__next__()
+
+    def __next__(self):  # python 3
+        if self.end_offset is not None and self.offset >= self.end_offset:
+            raise StopIteration
+        line = self.fileobj.readline()
+        if line == '':
+            raise StopIteration
+        self.offset += len(line)
+        return line
+
+    def close(self):
+        self.fileobj.close()
+
+def crc32_bytes(data):
+    return struct.pack('<I', zlib.crc32(data) & 0xffffffff)
+
+def encode_xz_varint(value):
+    data = ''
+    while value >= 0x80:
+        data += chr((value & 0x7f) | 0x80)
+        value >>= 7
+    return data + chr(value)
+
+def decode_xz_varint(data, pos):
+    ''' returns the value of the variable length integer at pos, and the position after it '''
+    value, shift = 0, 0
+    while True:
+        byte = ord(data[pos])
+        value |= (byte & 0x7f) << shift
+        pos += 1
+        if byte & 0x80 == 0:
+            return value, pos
+        shift += 7
+
+def find_xz_blocks(filename):
+    '''
+    reads the indexes of the (possibly concatenated) xz streams in filename, and returns a
+    (stream_flags, offset, unpadded_size, uncompressed_size) tuple for each block in file order;
+    raises ValueError if the file is not a valid xz file
+    '''
+    blocks = []
+    with open(filename, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        pos = f.tell()
+        while pos > 0:
+            if pos < 24:
+                raise ValueError("truncated xz stream in {0}".format(filename))
+            f.seek(pos - 4)
+            if f.read(4) == '\x00\x00\x00\x00':
+                # stream padding
+                pos -= 4
+                continue
+
+            f.seek(pos - 12)
+            footer = f.read(12)
+            if footer[10:12] != XZ_FOOTER_MAGIC or crc32_bytes(footer[4:10]) != footer[0:4]:
+                raise ValueError("invalid xz stream footer in {0}".format(filename))
+            stream_flags = footer[8:10]
+            index_size = (struct.unpack('<I', footer[4:8])[0] + 1) * 4
+            index_offset = pos - 12 - index_size
+            if index_offset < 12:
+                raise ValueError("invalid xz index size in {0}".format(filename))
+
+            f.seek(index_offset)
+            index = f.read(index_size)
+            if index[0] != '\x00' or crc32_bytes(index[:-4]) != index[-4:]:
+                raise ValueError("invalid xz index in {0}".format(filename))
+            num_records, i = decode_xz_varint(index, 1)
+            records = []
+            for _ in xrange(num_records):
+                unpadded_size, i = decode_xz_varint(index, i)
+                uncompressed_size, i = decode_xz_varint(index, i)
+                records.append((unpadded_size, uncompressed_size))
+
+            # blocks are padded to a multiple of four bytes
+            stream_offset = index_offset - sum([(r[0] + 3) & ~3 for r in records]) - 12
+            if stream_offset < 0:
+                raise ValueError("invalid xz index in {0}".format(filename))
+            f.seek(stream_offset)
+            header = f.read(12)
+            if header[0:6] != XZ_HEADER_MAGIC or header[6:8] != stream_flags:
+                raise ValueError("invalid xz stream header in {0}".format(filename))
+
+            offset = stream_offset + 12
+            stream_blocks = []
+            for (unpadded_size, uncompressed_size) in records:
+                stream_blocks.append((stream_flags, offset, unpadded_size, uncompressed_size))
+                offset += (unpadded_size + 3) & ~3
+            blocks = stream_blocks + blocks
+            pos = stream_offset
+
+    return blocks
+
+def decompress_xz_block(stream_flags, block, unpadded_size, uncompressed_size):
+    ''' decompresses a single block of an xz file by wrapping it into a stream of its own '''
+    header = XZ_HEADER_MAGIC + stream_flags + crc32_bytes(stream_flags)
+    index = '\x00' + encode_xz_varint(1) + encode_xz_varint(unpadded_size) + encode_xz_varint(uncompressed_size)
+    index += '\x00' * (-len(index) % 4)
+    index += crc32_bytes(index)
+    backward_size = struct.pack('<I', len(index) / 4 - 1)
+    footer = crc32_bytes(backward_size + stream_flags) + backward_size + stream_flags + XZ_FOOTER_MAGIC
+    return lzma.decompress(header + block + index + footer)
+
+class XZBlockReader(object):
+    '''
+    iterates over the lines of an xz file whose blocks are listed in blocks (see find_xz_blocks),
+    decompressing the independent blocks in a pool of num_threads threads; at most two blocks
+    per thread are held in memory at once
+    '''
+
+    def __init__(self, filename, blocks, num_threads):
+        self.fileobj = open(filename, 'rb')
+        self.blocks = blocks
+        self.num_threads = num_threads
+        self.pool = ThreadPool(num_threads)
+        self.lines = self.__iter_lines()
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        return self.__next__()
+
+    def __next__(self):  # python 3
+        return next(self.lines)
+
+    def __iter_lines(self):
+        pending = deque()
+        partial = ''
+        num_blocks = len(self.blocks)
+        for i, (stream_flags, offset, unpadded_size, uncompressed_size) in enumerate(self.blocks):
+            self.fileobj.seek(offset)
+            block = self.fileobj.read((unpadded_size + 3) & ~3)
+            pending.append(self.pool.apply_async(decompress_xz_block, (stream_flags, block, unpadded_size, uncompressed_size)))
+
+            # keep the pool busy, but drain everything after the last block
+            keep = self.num_threads if i < num_blocks - 1 else 0
+            if len(pending) < self.num_threads * 2 and keep > 0:
+                continue
+            while len(pending) > keep:
+                # lines may span blocks, so keep the text after the last newline for the next block
+                data = partial + pending.popleft().get()
+                end = data.rfind('\n') + 1
+                partial = data[end:]
+                for line in StringIO(data[:end]):
+                    yield line
+        if len(partial) > 0:
+            yield partial
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+        self.fileobj.close()
+
+def compress_xz_block(data):
+    return lzma.compress(data, format=lzma.FORMAT_XZ)
+
+class XZBlockWriter(object):
+    '''
+    a file that compresses every block_size bytes written to it into an xz stream of its own,
+    so that find_xz_blocks can locate the blocks and each of them can be read without the others;
+    num_threads > 1 compresses the blocks in a pool of that many threads, and at most two blocks
+    per thread are held in memory at once
+    '''
+
+    def __init__(self, filename, block_size=XZ_BLOCK_SIZE, num_threads=1):
+        self.fileobj = open(filename, 'wb')
+        self.block_size = block_size
+        self.pending = []
+        self.pending_size = 0
+        self.num_blocks = 0
+        self.num_threads = num_threads
+        # lzma releases the GIL while it compresses, so threads compress blocks in parallel
+        self.pool = ThreadPool(num_threads) if num_threads > 1 else None
+        self.compressing = deque()
+
+    def write(self, data):
+        self.pending.append(data)
+        self.pending_size += len(data)
+        if self.pending_size >= self.block_size:
+            data = ''.join(self.pending)
+            end = len(data) - len(data) % self.block_size
+            for start in xrange(0, end, self.block_size):
+                self.__write_block(data[start:start + self.block_size])
+            self.pending = [data[end:]]
+            self.pending_size = len(data) - end
+
+    def __write_block(self, data):
+        if self.pool is None:
+            self.fileobj.write(compress_xz_block(data))
+        else:
+            # the compressed blocks are written in the order of their data
+            self.compressing.append(self.pool.apply_async(compress_xz_block, (data,)))
+            while len(self.compressing) >= self.num_threads * 2:
+                self.fileobj.write(self.compressing.popleft().get())
+        self.num_blocks += 1
+
+    def flush(self):
+        self.fileobj.flush()
+
+    def close(self):
+        # an empty file still needs a stream to be valid xz
+        if self.pending_size > 0 or self.num_blocks == 0:
+            self.__write_block(''.join(self.pending))
+        self.pending = []
+        while len(self.compressing) > 0:
+            self.fileobj.write(self.compressing.popleft().get())
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        self.fileobj.close()
+
+class ByteRangeReader(object):
+    '''
+    reads ranges of uncompressed bytes from a file; for an xz file, only the blocks that hold
+    the range are decompressed, so files written with XZBlockWriter can be read at random
+    '''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.is_xz = filename.endswith(".xz")
+        self.fileobj = None
+        self.blocks = None
+        self.block_starts = None
+        self.cached_block = (None, None)
+
+    def read(self, start, end):
+        if not self.is_xz:
+            if self.fileobj is None: self.fileobj = open(self.filename, 'rb')
+            self.fileobj.seek(start)
+            return self.fileobj.read(end - start)
+        elif lzma is None:
+            # the xz tool can only decompress from the beginning
+            source = DataSource(self.filename)
+            source.open()
+            inf = source.get_file_handle()
+            skipped = 0
+            while skipped < start:
+                skipped += len(inf.read(min(start - skipped, XZ_BUFFER_SIZE)))
+            data = inf.read(end - start)
+            source.close()
+            return data
+
+        if self.blocks is None:
+            self.fileobj = open(self.filename, 'rb')
+            self.blocks = find_xz_blocks(self.filename)
+            self.block_starts = [0]
+            for block in self.blocks:
+                self.block_starts.append(self.block_starts[-1] + block[3])
+
+        pieces = []
+        i = max(bisect.bisect_right(self.block_starts, start) - 1, 0)
+        while i < len(self.blocks) and self.block_starts[i] < end:
+            data = self.__get_block(i)
+            block_start = self.block_starts[i]
+            pieces.append(data[max(start - block_start, 0):end - block_start])
+            i += 1
+        return ''.join(pieces)
+
+    def __get_block(self, i):
+        # neighbouring ranges often share a block
+        if self.cached_block[0] != i:
+            (stream_flags, offset, unpadded_size, uncompressed_size) = self.blocks[i]
+            self.fileobj.seek(offset)
+            block = self.fileobj.read((unpadded_size + 3) & ~3)
+            self.cached_block = (i, decompress_xz_block(stream_flags, block, unpadded_size, uncompressed_size))
+        return self.cached_block[1]
+
+    def close(self):
+        if self.fileobj is not None: self.fileobj.close()
+
 class DataSource(object):
-    def __init__(self, filename, compress=False):
+    def __init__(self, filename, compress=False, start_offset=None, end_offset=None, num_threads=1):
+        '''
+        start_offset and end_offset restrict reading to a byte range of an uncompressed file,
+        num_threads > 1 decompresses the blocks of a multi-block xz file on that many threads
+        '''
         self.filename = filename
         self.compress = compress
+        self.start_offset = start_offset
+        self.end_offset = end_offset
+        self.num_threads = num_threads
         self.source = None
         self.xzproc = None
 
@@ -160,21 +705,192 @@ class DataSource(object):
                 self.source = sys.stdin
             elif self.compress or self.filename.endswith(".xz"):
                 self.compress = True
-                cmd = "xz --decompress --stdout {0}".format(self.filename)
-                xzproc = Popen(cmd.split(), stdout=PIPE)
-                self.source = xzproc.stdout
+                if lzma is not None:
+                    self.__open_lzma()
+                else:
+                    cmd = "xz --decompress --stdout {0}".format(self.filename)
+                    self.xzproc = Popen(cmd.split(), stdout=PIPE)
+                    self.source = self.xzproc.stdout
+            elif self.start_offset is not None or self.end_offset is not None:
+                f = open(self.filename, 'r')
+                f.seek(self.start_offset or 0)
+                self.source = LineRangeReader(f, self.end_offset)
             else:
                 self.source = open(self.filename, 'r')
 
+    def __open_lzma(self):
+        blocks = None
+        if self.num_threads > 1:
+            try:
+                blocks = find_xz_blocks(self.filename)
+            except (ValueError, IndexError, IOError) as e:
+                logging.warning("decompressing {0} on a single thread: {1}".format(self.filename, e))
+
+        if blocks is not None and len(blocks) > 1:
+            self.source = XZBlockReader(self.filename, blocks, self.num_threads)
+        else:
+            self.source = io.BufferedReader(lzma.LZMAFile(self.filename, 'r'), XZ_BUFFER_SIZE)
+
     def get_file_handle(self):
         if self.source is None:
             self.open()
         return self.source
 
+    def get_offset(self):
+        # the byte offset just past the last line read, if reading a byte range
+        return self.source.offset if isinstance(self.source, LineRangeReader) else None
+
     def close(self):
         if self.source is not None: self.source.close()
         if self.xzproc is not None: self.xzproc.wait()
 
+# the amount of encoded json that is collected before writing it out
+JSON_WRITE_BUFFER_SIZE = 1024 * 1024
+
+def write_json(obj, writable, sort_keys=True, indent=2, stream_depth=5, index=None, index_depth=0):
+    '''
+    writes the same bytes as json.dump(obj, writable, sort_keys=sort_keys, separators=(',', ': '), indent=indent),
+    but walks the outer stream_depth levels of dicts itself, encodes the values below them one at a time,
+    and writes the output in chunks of about JSON_WRITE_BUFFER_SIZE bytes;
+    if index is a dict, it is filled with the [start, end) byte offsets of the values that are at most
+    index_depth keys deep (and at most stream_depth + 1), keyed by the tuple of keys leading to them
+    '''
+    encoder = json.JSONEncoder(sort_keys=sort_keys, separators=(',', ': '), indent=indent)
+    chunks, size = [], 0
+    offset, starts = 0, {}
+    for chunk in iter_json_chunks(obj, encoder, (), stream_depth, index_depth if index is not None else 0):
+        if type(chunk) is tuple:
+            # (path, is_start) marks where a value of interest starts and ends
+            (path, is_start) = chunk
+            if is_start: starts[path] = offset
+            else: index[path] = (starts.pop(path), offset)
+            continue
+        offset += len(chunk)
+        chunks.append(chunk)
+        size += len(chunk)
+        if size >= JSON_WRITE_BUFFER_SIZE:
+            writable.write(''.join(chunks))
+            chunks, size = [], 0
+    if size > 0:
+        writable.write(''.join(chunks))
+
+def iter_json_chunks(obj, encoder, path, depth, index_depth):
+    level = len(path)
+    if depth <= 0 or not isinstance(obj, Mapping) or len(obj) == 0:
+        # other mappings, such as records that were spilled to disk, are encoded like dicts
+        if isinstance(obj, Mapping) and not isinstance(obj, dict):
+            obj = dict(obj.iteritems())
+        encoded = encoder.encode(obj)
+        # the encoder indents as if the value was at the top level
+        if level > 0 and encoder.indent is not None:
+            encoded = encoded.replace('\n', '\n' + ' ' * (encoder.indent * level))
+        yield encoded
+        return
+
+    # values are only looked up when they are encoded
+    keys = sorted(obj.keys()) if encoder.sort_keys else obj.keys()
+    if encoder.indent is not None:
+        item_start = '\n' + ' ' * (encoder.indent * (level + 1))
+        dict_end = '\n' + ' ' * (encoder.indent * level) + '}'
+    else:
+        item_start, dict_end = '', '}'
+
+    yield '{'
+    separator = item_start
+    for key in keys:
+        value = obj[key]
+        # json converts keys that are not strings in the same way as values
+        if not isinstance(key, basestring):
+            key = encoder.encode(key)
+        yield separator + encoder.encode(key) + encoder.key_separator
+        separator = encoder.item_separator + item_start
+        child_path = path + (key,)
+        if level < index_depth: yield (child_path, True)
+        for chunk in iter_json_chunks(value, encoder, child_path, depth - 1, index_depth):
+            yield chunk
+        if level < index_depth: yield (child_path, False)
+    yield dict_end
+
+# the amount of json text that is read from the file at a time
+JSON_READ_BUFFER_SIZE = 1024 * 1024
+JSON_WHITESPACE_RE = re.compile(r'[ \t\n\r]*')
+JSON_DELIMITERS = ' \t\n\r,:]}'
+
+class JSONStreamReader(object):
+    '''
+    reads a json document from a file handle a piece at a time, so that values that are not
+    needed are decoded and dropped one at a time instead of building the whole document
+    '''
+
+    def __init__(self, fileobj, buffer_size=JSON_READ_BUFFER_SIZE):
+        self.fileobj = fileobj
+        self.buffer_size = buffer_size
+        self.decoder = json.JSONDecoder()
+        self.buf = ''
+        self.pos = 0
+
+    def __extend(self):
+        # grow geometrically so that retrying to decode a large value stays linear
+        data = self.fileobj.read(max(self.buffer_size, len(self.buf) - self.pos))
+        self.buf = self.buf[self.pos:] + data
+        self.pos = 0
+        return len(data) > 0
+
+    def peek(self):
+        ''' returns the next character that is not whitespace, without consuming it '''
+        while True:
+            self.pos = JSON_WHITESPACE_RE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.__extend():
+                raise ValueError("unexpected end of json document")
+
+    def __expect(self, chars):
+        c = self.peek()
+        if c not in chars:
+            raise ValueError("expected one of '{0}' but found '{1}' in json document".format(chars, c))
+        self.pos += 1
+        return c
+
+    def iter_object(self):
+        '''
+        iterates over the keys of the object that comes next; the caller must consume the
+        value of each key with read_value, skip_value, or iter_object before the next key
+        '''
+        self.__expect('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            self.peek()
+            key = self.read_value()
+            self.__expect(':')
+            yield key
+            if self.__expect(',}') == '}':
+                return
+
+    def read_value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+            except ValueError:
+                # the value may continue past the end of the buffer
+                if self.__extend():
+                    continue
+                raise
+            # a number that is cut off by the end of the buffer may still decode
+            if (end < len(self.buf) and self.buf[end] in JSON_DELIMITERS) or not self.__extend():
+                self.pos = end
+                return value
+
+    def skip_value(self):
+        if self.peek() == '{':
+            # the members are dropped one at a time, so a large object is never held in memory
+            for key in self.iter_object():
+                self.read_value()
+        else:
+            self.read_value()
 
 class Writable(object):
     __metaclass__ = ABCMeta
@@ -187,16 +903,57 @@ class Writable(object):
     def close(self):
         pass
 
+# a buffered FileWritable writes out its queued messages after this many seconds or messages
+FILE_FLUSH_INTERVAL = 1.0
+FILE_FLUSH_COUNT = 1000
+# the number of messages a buffered FileWritable queues before writers wait for the disk
+FILE_QUEUE_SIZE = 100000
+# how often a writer that waits for the flusher checks that it is still alive and writing, in seconds
+FILE_FLUSH_CHECK_INTERVAL = 1.0
+
+# the buffered FileWritables that are not closed yet, whose flushers write out their queues at exit
+flushing_writables = weakref.WeakSet()
+
+def stop_file_flushers():
+    for writable in list(flushing_writables):
+        try:
+            writable.stop_flusher()
+        except IOError as e:
+            logging.warning("failed to write the queued messages to {0} at exit: {1}".format(writable.filename, e))
+
+# daemon threads would otherwise be killed at exit with messages still queued
+atexit.register(stop_file_flushers)
+
 class FileWritable(Writable):
 
-    def __init__(self, filename, do_compress=False, do_truncate=False):
+    def __init__(self, filename, do_compress=False, do_truncate=False, xz_block_size=None, flush_interval=None, num_threads=1):
+        '''
+        if xz_block_size is set, compressed data is written in independent blocks of that many
+        uncompressed bytes, so that ByteRangeReader can read parts of it; num_threads > 1 compresses
+        blocks of xz_block_size (XZ_BLOCK_SIZE by default) bytes on that many threads;
+        if flush_interval is set, write() only queues the message, and a background thread writes the
+        queued messages in batches, at most flush_interval seconds or FILE_FLUSH_COUNT messages apart;
+        close() and rotate_file() first wait for everything that was queued before them to be written,
+        and raise the IOError of the flusher if it cannot write; messages that fail to be written stay queued
+        and are written again at the next interval, and if the flusher thread dies, writes become synchronous
+        '''
         self.filename = filename
         self.do_compress = do_compress
         self.do_truncate = do_truncate
+        self.xz_block_size = xz_block_size
+        self.flush_interval = flush_interval
+        self.num_threads = num_threads
         self.file = None
         self.xzproc = None
         self.ddproc = None
         self.lock = Lock()
+        self.listeners = []
+        # appending to a deque is atomic, so writers only take a lock when they wake the flusher
+        self.queue = deque()
+        self.wakeup_ev = Event()
+        self.flusher = None
+        # the error of the last batch that the flusher failed to write, until it writes one
+        self.write_error = None
 
         if self.filename == '-':
             self.file = sys.stdout
@@ -205,11 +962,138 @@ class FileWritable(Writable):
             if not self.filename.endswith(".xz"):
                 self.filename += ".xz"
 
+        if self.flush_interval is not None:
+            self.flusher = Thread(target=self.__flush_task, name="flusher_{0}".format(os.path.basename(self.filename)))
+            self.flusher.setDaemon(True)
+            self.flusher.start()
+            flushing_writables.add(self)
+
+    def add_listener(self, listener):
+        '''
+        listener.write(msg) will be called with everything written to this file, and
+        listener.rotate_file(filename_datetime) every time the file is rotated, while holding
+        our lock; the listener must not raise exceptions
+        '''
+        self.lock.acquire()
+        self.listeners.append(listener)
+        self.lock.release()
+
     def write(self, msg):
+        flusher = self.flusher
+        if flusher is not None and flusher.is_alive():
+            self.queue.append(msg)
+            # while the flusher fails to write, it only tries again at its interval
+            if len(self.queue) >= FILE_FLUSH_COUNT and not self.wakeup_ev.is_set() and self.write_error is None:
+                self.wakeup_ev.set()
+            if len(self.queue) >= FILE_QUEUE_SIZE:
+                self.__wait_flushed()
+            return
         self.lock.acquire()
+        try:
+            # the messages that a dead flusher left in the queue come first
+            self.__write_queued_nolock()
+            self.__write_nolock(msg)
+        finally:
+            self.lock.release()
+
+    def __write_nolock(self, msg):
         if self.file is None: self.__open_nolock()
         if self.file is not None: self.file.write(msg)
-        self.lock.release()
+        for listener in self.listeners: listener.write(msg)
+
+    def __flush_task(self):
+        try:
+            while self.flusher is not None or len(self.queue) > 0:
+                self.wakeup_ev.wait(self.flush_interval)
+                self.wakeup_ev.clear()
+                try:
+                    self.__flush_queue()
+                except IOError as e:
+                    # the writers that wait for the failed messages see the error, and we try again later
+                    logging.warning("failed to write {0} queued messages to {1}: {2}".format(len(self.queue), self.filename, e))
+                    self.write_error = e
+                    if self.flusher is None:
+                        logging.warning("stopping with {0} messages to {1} still queued".format(len(self.queue), self.filename))
+                        return
+        except Exception as e:
+            # writers see that we are gone and write the queued messages themselves
+            logging.error("the flusher of {0} failed, writing synchronously from now on: {1}".format(self.filename, repr(e)))
+
+    def __flush_queue(self):
+        batch = []
+        while len(self.queue) > 0:
+            item = self.queue.popleft()
+            batch.append(item)
+            if isinstance(item, basestring) and len(batch) < FILE_FLUSH_COUNT:
+                continue
+            self.__write_batch(batch)
+            batch = []
+        self.__write_batch(batch)
+
+    def __write_batch(self, batch):
+        # an event instead of a message asks us to set it once the messages before it are written
+        msgs = [item for item in batch if isinstance(item, basestring)]
+        if len(msgs) > 0:
+            self.lock.acquire()
+            try:
+                self.__write_nolock(''.join(msgs))
+                if self.file is not None: self.file.flush()
+            except:
+                # the batch goes back to the front of the queue, to be written again
+                self.queue.extendleft(reversed(batch))
+                raise
+            finally:
+                self.lock.release()
+        self.write_error = None
+        for item in batch:
+            if not isinstance(item, basestring):
+                item.set()
+
+    def __write_queued_nolock(self):
+        msgs = []
+        while len(self.queue) > 0:
+            item = self.queue.popleft()
+            if isinstance(item, basestring):
+                msgs.append(item)
+            else:
+                item.set()
+        if len(msgs) > 0:
+            self.__write_nolock(''.join(msgs))
+            if self.file is not None: self.file.flush()
+
+    def __wait_flushed(self):
+        flusher = self.flusher
+        if flusher is None:
+            return
+        flushed_ev = Event()
+        self.queue.append(flushed_ev)
+        self.wakeup_ev.set()
+        # the flusher may be unable to write, or dead, so we never wait for it blindly
+        while not flushed_ev.wait(FILE_FLUSH_CHECK_INTERVAL):
+            if self.write_error is not None:
+                raise self.write_error
+            if not flusher.is_alive():
+                self.lock.acquire()
+                try:
+                    self.__write_queued_nolock()
+                finally:
+                    self.lock.release()
+                return
+
+    def stop_flusher(self):
+        ''' writes out the queued messages and stops the flusher thread, after which writes are synchronous '''
+        flusher = self.flusher
+        if flusher is not None:
+            self.flusher = None
+            self.wakeup_ev.set()
+            flusher.join()
+            flushing_writables.discard(self)
+            # anything still queued was left by a flusher that died or could not write
+            self.lock.acquire()
+            try:
+                self.__write_queued_nolock()
+            finally:
+                self.lock.release()
 
     def open(self):
         self.lock.acquire()
@@ -217,17 +1101,27 @@ class FileWritable(Writable):
         self.lock.release()
 
     def __open_nolock(self):
-        if self.do_compress:
-            self.xzproc = Popen("xz --threads=3 -".split(), stdin=PIPE, stdout=PIPE)
+        if self.do_compress and lzma is not None and (self.xz_block_size is not None or self.num_threads > 1):
+            block_size = self.xz_block_size if self.xz_block_size is not None else XZ_BLOCK_SIZE
+            self.file = XZBlockWriter(self.filename, block_size=block_size, num_threads=self.num_threads)
+        elif self.do_compress and lzma is not None:
+            self.file = io.BufferedWriter(lzma.LZMAFile(self.filename, 'w'), XZ_BUFFER_SIZE)
+        elif self.do_compress:
+            xz_cmd = "xz --threads={0} -".format(self.num_threads if self.num_threads > 1 else 3)
+            if self.xz_block_size is not None: xz_cmd += " --block-size={0}".format(self.xz_block_size)
+            self.xzproc = Popen(xz_cmd.split(), stdin=PIPE, stdout=PIPE)
             dd_cmd = "dd of={0}".format(self.filename)
             # # note: its probably not a good idea to append to finalized compressed files
             # if not self.do_truncate: dd_cmd += " oflag=append conv=notrunc"
             self.ddproc = Popen(dd_cmd.split(), stdin=self.xzproc.stdout, stdout=open(os.devnull, 'w'), stderr=STDOUT)
             self.file = self.xzproc.stdin
         else:
-            self.file = open(self.filename, 'w' if self.do_truncate else 'a', 0)
+            # the flusher writes whole batches, so only unbuffered writes skip the file buffer
+            self.file = open(self.filename, 'w' if self.do_truncate else 'a', 0 if self.flusher is None else -1)
 
     def close(self):
+        self.__wait_flushed()
+        self.stop_flusher()
         self.lock.acquire()
         self.__close_nolock()
         self.lock.release()
@@ -244,6 +1138,8 @@ class FileWritable(Writable):
             self.ddproc = None
 
     def rotate_file(self, filename_datetime=datetime.datetime.now()):
+        # no line that was written before the rotation may end up in the new file
+        self.__wait_flushed()
         self.lock.acquire()
 
         # build up the new filename with an embedded timestamp
@@ -261,6 +1157,7 @@ class FileWritable(Writable):
         # self.file.truncate(0)
         shutil.move(self.filename, new_filename)
         self.__open_nolock()
+        for listener in self.listeners: listener.rotate_file(filename_datetime=filename_datetime)
 
         self.lock.release()
         # return new file name so it can be processed if desired